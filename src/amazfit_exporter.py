@@ -1,15 +1,53 @@
 #!/usr/bin/python3
+import collections
+import concurrent.futures
+import contextvars
+import importlib
 import logging
+import os
 import sqlite3
-import pathlib
+import traceback
 from datetime import datetime
-from lxml import etree
 import amazfit_exporter_config
-from amazfit_exporter_tcx import db_to_tcx
-from amazfit_exporter_gpx import db_to_gpx
+from amazfit_exporter_db import ConnectionPool, SportDatabase, connect, database_uri
+from amazfit_exporter_index import ActivityIndex, is_selective
+from amazfit_exporter_manifest import ExportManifest, get_activity_fingerprint
+from amazfit_exporter_output import ExportOutput, MemoryOutput
+from amazfit_exporter_stats import ExportStats, current_stats, stats
+from amazfit_exporter_summary import AVAILABLE_LAP_SPLITS, close_summary_indexes, merge_summary_updates, pop_summary_updates
 
-# global variable for the database cursor
-cursor = None
+# Connections of the worker process by database URI and the manifests and
+# outputs of the output directories, set by init_export_worker
+worker_databases = {}
+worker_manifests = {}
+worker_outputs = {}
+
+# Map export formats to their writer modules. A writer module is only imported
+# when its format is exported, so e.g. a FIT export never loads lxml. Every
+# module provides create_<format>_dest, activity_to_<format> and db_to_<format>.
+EXPORT_MODULES = {
+    'TCX': 'amazfit_exporter_tcx',
+    'GPX': 'amazfit_exporter_gpx',
+    'FIT': 'amazfit_exporter_fit',
+    'CSV': 'amazfit_exporter_csv'
+}
+
+# The functions of a writer module creating the destination directory,
+# exporting a single activity and exporting all loaded activities
+FormatWriter = collections.namedtuple('FormatWriter', ['create_dest', 'export_activity', 'export_activities'])
+
+# Writers of the imported writer modules by export format
+writers = {}
+
+# Configuration values which have to be passed to the worker processes
+WORKER_CONFIG = ('no_heart_rate', 'no_cadence', 'no_calories', 'heart_rate_tolerance', 'xml_writer', 'csv_partition', 'pretty_print', 'compression', 'bundle', 'simplify_tolerance', 'decimate_interval', 'lap_split')
+
+# Configuration values of the exporters of the library API, the exported files
+# are returned uncompressed and the CSV export has one file per activity
+LIBRARY_CONFIG = ('no_heart_rate', 'no_cadence', 'no_calories', 'heart_rate_tolerance', 'xml_writer', 'pretty_print', 'simplify_tolerance', 'decimate_interval', 'lap_split')
+
+# Idle connections kept by an exporter of the library API
+LIBRARY_CONNECTIONS = 4
 
 logger = logging.getLogger(__name__)
 
@@ -17,54 +55,408 @@ logger = logging.getLogger(__name__)
 def local_date_to_utc(date):
     return datetime.utcfromtimestamp(int(date / 1000))
 
-def get_activities_data(begin_time):
-    # Use begin_time to load only data beyond that time
-    cursor.execute('SELECT track_id, start_time, end_time, calorie, type, content FROM sport_summary WHERE track_id >=' + str(begin_time) + ' AND (type BETWEEN 1 AND 15)')
-    return cursor.fetchall()
+def get_writer(export_format):
+    if export_format not in writers:
+        module = importlib.import_module(EXPORT_MODULES[export_format])
+        name = export_format.lower()
+        writers[export_format] = FormatWriter(
+            getattr(module, "create_" + name + "_dest"),
+            getattr(module, "activity_to_" + name),
+            getattr(module, "db_to_" + name))
+    return writers[export_format]
+
+def get_export_formats():
+    # Keep the order of EXPORT_MODULES independent of the order of the arguments.
+    # CSV month partitions are not exported per activity, see export_csv_months.
+    return [export_format for export_format in EXPORT_MODULES if export_format in amazfit_exporter_config.export_formats and not is_csv_month_export(export_format)]
+
+def is_csv_month_export(export_format):
+    return export_format == 'CSV' and amazfit_exporter_config.csv_partition == 'month'
+
+def print_activity(activity):
+    identifier = activity['track_id']
+    print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other"))
+
+# Activities loaded one after another share a heart_rate_cursor, see
+# amazfit_exporter_db.HeartRateCursor
+def load_activity(database, activity, heart_rate_cursor=None):
+    identifier = activity['track_id']
+    with stats.stage("query.trackpoints"):
+        trackpoints = database.get_activity_trackpoints(identifier)
+    with stats.stage("query.heart_rates"):
+        heart_rate_data = database.get_activity_heart_rates(trackpoints, amazfit_exporter_config.heart_rate_tolerance, heart_rate_cursor)
+    stats.count("trackpoints", len(trackpoints))
+    stats.count("heart_rate_samples", len(heart_rate_data))
+    amazfit_exporter_config.trackpoints = {identifier: trackpoints}
+    amazfit_exporter_config.heart_rate_data = heart_rate_data
+
+def stream_export(database, dest):
+    logger.info("Started streaming export")
+    print("Streaming export:")
+    export_formats = get_export_formats()
+    destinations = {export_format: get_writer(export_format).create_dest(dest) for export_format in export_formats}
+    # Load, write and drop one activity at a time, so memory usage is bounded by
+    # the largest activity instead of the whole selected history
+    heart_rate_cursor = database.open_heart_rate_cursor()
+    try:
+        for activity in amazfit_exporter_config.activities:
+            print_activity(activity)
+            load_activity(database, activity, heart_rate_cursor)
+            for export_format in export_formats:
+                get_writer(export_format).export_activity(destinations[export_format], activity)
+    finally:
+        heart_rate_cursor.close()
+    for export_format in export_formats:
+        mark_exported(export_format, amazfit_exporter_config.activities)
+    amazfit_exporter_config.trackpoints = {}
+    amazfit_exporter_config.heart_rate_data = None
+    logger.info("Finished streaming export")
+
+def init_export_worker(config, manifests):
+    global worker_manifests, worker_outputs
+    for name, value in config.items():
+        setattr(amazfit_exporter_config, name, value)
+    worker_manifests = manifests
+    worker_outputs = {dest: ExportOutput(manifest, worker=True) for dest, manifest in manifests.items()}
+    # Forked worker processes inherit the statistics and summaries of the main process
+    stats.pop_updates()
+    pop_summary_updates()
+
+def get_worker_database(db_uri):
+    # Every worker process uses its own read-only connection to each database
+    if db_uri not in worker_databases:
+        worker_databases[db_uri] = SportDatabase(connect(db_uri))
+    return worker_databases[db_uri]
+
+# Export one activity in all formats, so it is loaded only once. Errors are
+# returned instead of raised, so they are reported per activity and format.
+# Returns (error, bundle members) per format, the manifest entries of the
+# written files, the statistics and the summaries for the main process.
+def export_activity_worker(db_uri, dest, format_dests, track_id):
+    amazfit_exporter_config.manifest = worker_manifests[dest]
+    amazfit_exporter_config.output = worker_outputs[dest]
+    results = []
+    try:
+        database = get_worker_database(db_uri)
+        activity = database.get_activity(track_id)
+        load_activity(database, activity)
+    except Exception:
+        error = traceback.format_exc()
+        results = [(error, []) for _ in format_dests]
+    else:
+        for export_format, format_dest in format_dests:
+            error = None
+            try:
+                get_writer(export_format).export_activity(format_dest, activity)
+            except Exception:
+                error = traceback.format_exc()
+            results.append((error, amazfit_exporter_config.output.pop_members()))
+    finally:
+        amazfit_exporter_config.trackpoints = {}
+        amazfit_exporter_config.heart_rate_data = None
+    return results, amazfit_exporter_config.manifest.pop_updates(), stats.pop_updates(), pop_summary_updates()
+
+# Pool of worker processes, manifests maps the output directories of the
+# exported databases to their manifests
+def create_export_pool(manifests):
+    config = {name: getattr(amazfit_exporter_config, name) for name in WORKER_CONFIG}
+    return concurrent.futures.ProcessPoolExecutor(max_workers=amazfit_exporter_config.jobs, initializer=init_export_worker, initargs=(config, manifests))
+
+# Submit a work unit per activity of a database, which exports all formats
+def submit_exports(executor, db_uri, dest, activities):
+    format_dests = [(export_format, get_writer(export_format).create_dest(dest)) for export_format in get_export_formats()]
+    return [(activity, executor.submit(export_activity_worker, db_uri, dest, format_dests, activity['track_id'])) for activity in activities]
+
+# Wait for the work units and report the results in the same order as the
+# serial export, format by format. Bundle members of the workers are added to
+# the bundle of output, the successful exports are marked in activity_index.
+# Returns the track_id of every failed export.
+def report_exports(units, manifest, output, activity_index):
+    failed = []
+    for index, export_format in enumerate(get_export_formats()):
+        print(export_format + " export:")
+        track_ids = []
+        for activity, future in units:
+            results, manifest_updates, stats_updates, summary_updates = future.result()
+            if index == 0:
+                manifest.merge(manifest_updates)
+                stats.merge(stats_updates)
+                merge_summary_updates(summary_updates)
+            error, bundle_members = results[index]
+            output.merge(bundle_members)
+            print_activity(activity)
+            if error is not None:
+                failed.append(activity['track_id'])
+                logger.error("Error: %s export of activity %d failed:\n%s", export_format, activity['track_id'], error)
+            else:
+                track_ids.append(activity['track_id'])
+        if activity_index is not None:
+            activity_index.mark_exported(export_format, track_ids)
+    return failed
+
+def parallel_export(db_uri, dest):
+    logger.info("Started parallel export with %d jobs", amazfit_exporter_config.jobs)
+    manifest = amazfit_exporter_config.manifest
+    with create_export_pool({dest: manifest}) as executor:
+        units = submit_exports(executor, db_uri, dest, amazfit_exporter_config.activities)
+        failed = report_exports(units, manifest, amazfit_exporter_config.output, amazfit_exporter_config.activity_index)
+    logger.info("Finished parallel export, %d of %d exports failed", len(failed), len(units) * len(get_export_formats()))
+    return failed
 
-def get_track_data(begin_time):
-    cursor.execute('SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id>=' + str(begin_time) + ' AND point_type > 0')
-    return cursor.fetchall()
+# The highest track_id of the exported activities, -1 if there is none. It
+# stays below the first failed activity, so the next export retries it.
+def get_checkpoint(activities, failed_track_ids):
+    first_failed = min(failed_track_ids, default=None)
+    return max([activity['track_id'] for activity in activities if first_failed is None or activity['track_id'] < first_failed], default=-1)
 
-def get_heart_rate_data(begin_time):
-    cursor.execute('SELECT time, rate, step_count from heart_rate where time >=' + str(begin_time))
-    heart_rates = {}
-    for hr in cursor.fetchall():
-        if not hr['time'] in heart_rates:
-            heart_rates[hr['time']] = hr[1:]
-    return heart_rates
+# A CSV month partition contains all activities of the month, so every month
+# with a selected activity is exported again. The activities of one month at a
+# time are loaded from the database, for the fingerprint and for writing.
+def export_csv_months(database, dest, activities):
+    logger.info("Started csv export by month")
+    print("CSV export:")
+    from amazfit_exporter_csv import create_csv_dest, get_month, get_month_fingerprint, get_month_range, month_to_csv
+    csv_dest = create_csv_dest(dest)
+    for month in sorted({get_month(activity) for activity in activities}):
+        month_activities = database.get_activities_between(*get_month_range(month))
+        print("\tMonth: " + month + ", activities: " + str(len(month_activities)))
+        with stats.stage("query.trackpoints"):
+            amazfit_exporter_config.trackpoints = database.get_selected_trackpoints([activity['track_id'] for activity in month_activities])
+        with stats.stage("query.heart_rates"):
+            amazfit_exporter_config.heart_rate_data = database.get_selected_heart_rates(amazfit_exporter_config.trackpoints, amazfit_exporter_config.heart_rate_tolerance)
+        stats.count("trackpoints", sum(len(trackpoints) for trackpoints in amazfit_exporter_config.trackpoints.values()))
+        stats.count("heart_rate_samples", len(amazfit_exporter_config.heart_rate_data))
+        fingerprints = []
+        if amazfit_exporter_config.manifest is not None:
+            with stats.stage("csv.fingerprint"):
+                fingerprints = [get_activity_fingerprint('CSV', activity) for activity in month_activities]
+        month_to_csv(csv_dest, month, month_activities, get_month_fingerprint(fingerprints))
+        mark_exported('CSV', month_activities)
+    amazfit_exporter_config.trackpoints = {}
+    amazfit_exporter_config.heart_rate_data = None
+    logger.info("Finished csv export by month")
 
-def document_to_string(document):
-    return etree.tostring(document.getroot(), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+# Open the sport database, or an indexed working copy of it. Returns the
+# database and the URI the worker processes open.
+def open_database(db, working_copy=None):
+    working_copy = working_copy or amazfit_exporter_config.working_copy
+    db_uri = database_uri(db)
+    database = SportDatabase(connect(db_uri))
+    if working_copy:
+        indexed_database = database.create_working_copy(working_copy)
+        database.close()
+        database = indexed_database
+        # Worker processes can only share a working copy on disk
+        if working_copy != ':memory:':
+            db_uri = database_uri(working_copy)
+    return database, db_uri
+
+def mark_exported(export_format, activities):
+    if amazfit_exporter_config.activity_index is not None:
+        amazfit_exporter_config.activity_index.mark_exported(export_format, [activity['track_id'] for activity in activities])
+
+# The activities since begin_time, or the activities of the selection which
+# are answered from the activity index. The new activities of the database are
+# added to the index first, they are only counted for a selection.
+def get_activities(database, begin_time):
+    activity_index = amazfit_exporter_config.activity_index
+    if not is_selective():
+        if activity_index is not None:
+            with stats.stage("index.update"):
+                activity_index.add(database)
+        with stats.stage("query.activities"):
+            return database.get_activities(begin_time)
+    with stats.stage("index.update"):
+        activity_index.update(database)
+    with stats.stage("index.select"):
+        track_ids = activity_index.select(begin_time)
+    logger.info("Selected %d activities from the activity index", len(track_ids))
+    with stats.stage("query.activities"):
+        return database.get_selected_activities(track_ids)
+
+# Export all activities since begin_time, or the selected activities, and
+# return the new checkpoint, see get_checkpoint. A failed export of the
+# serial export raises, the failed exports of the worker processes are kept
+# in failed_track_ids of the configuration.
+def export_database(database, db_uri, dest, begin_time):
+    amazfit_exporter_config.activities = get_activities(database, begin_time)
+    amazfit_exporter_config.failed_track_ids = []
+    stats.count("activities", len(amazfit_exporter_config.activities))
+    if not get_export_formats():
+        # Only CSV month partitions, which load their data month by month
+        pass
+    elif amazfit_exporter_config.jobs > 1:
+        amazfit_exporter_config.failed_track_ids = parallel_export(db_uri, dest)
+    elif amazfit_exporter_config.streaming:
+        stream_export(database, dest)
+    else:
+        # Only the data of the selected activities is loaded
+        with stats.stage("query.trackpoints"):
+            if is_selective():
+                amazfit_exporter_config.trackpoints = database.get_selected_trackpoints([activity['track_id'] for activity in amazfit_exporter_config.activities])
+            else:
+                amazfit_exporter_config.trackpoints = database.get_trackpoints(begin_time)
+        with stats.stage("query.heart_rates"):
+            if is_selective():
+                amazfit_exporter_config.heart_rate_data = database.get_selected_heart_rates(amazfit_exporter_config.trackpoints, amazfit_exporter_config.heart_rate_tolerance)
+            else:
+                amazfit_exporter_config.heart_rate_data = database.get_heart_rates(begin_time, amazfit_exporter_config.heart_rate_tolerance)
+        stats.count("trackpoints", sum(len(trackpoints) for trackpoints in amazfit_exporter_config.trackpoints.values()))
+        stats.count("heart_rate_samples", len(amazfit_exporter_config.heart_rate_data))
+        for export_format in get_export_formats():
+            get_writer(export_format).export_activities(dest)
+            mark_exported(export_format, amazfit_exporter_config.activities)
+        amazfit_exporter_config.trackpoints = {}
+        amazfit_exporter_config.heart_rate_data = None
+    if 'CSV' in amazfit_exporter_config.export_formats and is_csv_month_export('CSV'):
+        export_csv_months(database, dest, amazfit_exporter_config.activities)
+    # search for highest track_id as new update begin time
+    new_update_begin_time = get_checkpoint(amazfit_exporter_config.activities, amazfit_exporter_config.failed_track_ids)
+    logger.info("Highest track id found %d", new_update_begin_time)
+    if amazfit_exporter_config.failed_track_ids:
+        logger.error("Error: %d exports failed, the next export starts again at activity %d", len(amazfit_exporter_config.failed_track_ids), min(amazfit_exporter_config.failed_track_ids))
+    return new_update_begin_time
 
 def start_export(db,dest,begin_time):
     logger.info("Started export")
 
     new_update_begin_time = -1
 
+    # Fingerprints of the files exported by previous runs
+    amazfit_exporter_config.manifest = ExportManifest(dest, amazfit_exporter_config.force)
+    amazfit_exporter_config.output = ExportOutput(amazfit_exporter_config.manifest)
+    amazfit_exporter_config.activity_index = ActivityIndex(dest)
+
     # Connect to the sport database
+    database = None
     try:
-        db_uri = pathlib.Path(db).as_uri() + "?mode=ro"
-        db_connection = sqlite3.connect(db_uri, uri=True)
-        db_connection.row_factory = sqlite3.Row
-        with db_connection:
-            global cursor
-            global activities
-            global trackpoints
-            global heart_rate_data
-            cursor = db_connection.cursor()
-            amazfit_exporter_config.activities = get_activities_data(begin_time)
-            amazfit_exporter_config.trackpoints = get_track_data(begin_time)
-            amazfit_exporter_config.heart_rate_data = get_heart_rate_data(begin_time)
-            if 'TCX' in amazfit_exporter_config.export_formats:
-                db_to_tcx(dest)
-            if 'GPX' in amazfit_exporter_config.export_formats:
-                db_to_gpx(dest)
-            # search for highest track_id as new update begin time
-            new_update_begin_time = max([act[0] for act in amazfit_exporter_config.activities], default=-1) 
-            logger.info("Highest track id found %d", new_update_begin_time)
+        database, db_uri = open_database(db)
+        new_update_begin_time = export_database(database, db_uri, dest, begin_time)
     except sqlite3.OperationalError:
         logger.error("Error: Database not readable! Check database: '%s'", db)
+    finally:
+        if database is not None:
+            database.close()
+        # Written files which are still compressed in the background are
+        # recorded in the manifest, so the output is finished first
+        try:
+            amazfit_exporter_config.output.close()
+        finally:
+            amazfit_exporter_config.manifest.save()
+            amazfit_exporter_config.activity_index.close()
+            close_summary_indexes()
     
     logger.info("Finished export")
     return new_update_begin_time
+
+# Exporter of a sport database for other programs, e.g.
+#   exporter = Exporter('sport_data.db', ['TCX', 'FIT'], lap_split='km')
+#   data = exporter.export_activity(1546300800137, 'FIT')
+#   for track_id, export_format, data in exporter.iter_exports(): ...
+# The exported files are returned as bytes instead of being written. The
+# configuration is given to the constructor and every call runs with its own
+# copy of it and its own loaded data, so any number of exporters can be used
+# by several threads of a long-lived process. The connections to the database
+# and the last loaded activity are kept between the calls.
+class Exporter:
+
+    def __init__(self, db, export_formats=None, working_copy=None, **options):
+        unknown = sorted(set(options) - set(LIBRARY_CONFIG))
+        if unknown:
+            raise TypeError("Unknown exporter options: " + ", ".join(unknown))
+        self.config = amazfit_exporter_config.get_defaults()
+        self.config.update(options)
+        self.config['export_formats'] = list(export_formats or amazfit_exporter_config.DEFAULT_EXPORT_FORMATS)
+        for export_format in self.config['export_formats']:
+            self.check_export_format(export_format)
+        if self.config['xml_writer'] not in amazfit_exporter_config.AVAILABLE_XML_WRITERS:
+            raise ValueError("Unknown XML writer: " + str(self.config['xml_writer']))
+        if self.config['lap_split'] is not None and self.config['lap_split'] not in AVAILABLE_LAP_SPLITS:
+            raise ValueError("Unknown lap split: " + str(self.config['lap_split']))
+        # Threads can only share a working copy on disk
+        if working_copy == ':memory:':
+            raise ValueError("The working copy of an exporter has to be a file")
+        amazfit_exporter_config.enable_contexts()
+        self.stats = ExportStats()
+        # (activity, trackpoints, heart_rate_data) of the last loaded activity,
+        # replaced as a whole so threads never see a partial update
+        self.loaded = None
+        # File URIs need absolute paths, like the paths of the command line
+        db = os.path.abspath(db)
+        db_uri = database_uri(db)
+        if working_copy is not None:
+            database, db_uri = open_database(db, os.path.abspath(working_copy))
+            database.close()
+        self.pool = ConnectionPool(db_uri, LIBRARY_CONNECTIONS, indexed=working_copy is not None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    def check_export_format(self, export_format):
+        if export_format not in EXPORT_MODULES:
+            raise ValueError("Unknown export format: " + str(export_format))
+
+    # Run function in a new context with a copy of the configuration, an
+    # output in memory and the statistics of this exporter
+    def run(self, function, *args):
+        return contextvars.copy_context().run(self.run_in_context, function, args)
+
+    def run_in_context(self, function, args):
+        config = dict(self.config)
+        config['output'] = MemoryOutput()
+        amazfit_exporter_config.current_config.set(config)
+        current_stats.set(self.stats)
+        return function(*args)
+
+    def load(self, track_id):
+        loaded = self.loaded
+        if loaded is None or loaded[0]['track_id'] != track_id:
+            with self.pool.database() as database:
+                activity = database.get_activity(track_id)
+                if activity is None:
+                    raise KeyError(track_id)
+                load_activity(database, activity)
+            loaded = self.loaded = (activity, amazfit_exporter_config.trackpoints, amazfit_exporter_config.heart_rate_data)
+        else:
+            amazfit_exporter_config.trackpoints = loaded[1]
+            amazfit_exporter_config.heart_rate_data = loaded[2]
+        return loaded[0]
+
+    def export_loaded(self, activity, export_format):
+        writer = get_writer(export_format)
+        writer.export_activity(writer.create_dest("."), activity)
+        (data,) = amazfit_exporter_config.output.pop_files().values()
+        return data
+
+    def export_track(self, track_id, export_formats):
+        activity = self.load(track_id)
+        return [self.export_loaded(activity, export_format) for export_format in export_formats]
+
+    def query_track_ids(self, begin_time):
+        with self.pool.database() as database:
+            return sorted(activity['track_id'] for activity in database.get_activities(begin_time))
+
+    # track_ids of the activities since begin_time
+    def get_track_ids(self, begin_time=0):
+        return self.run(self.query_track_ids, begin_time)
+
+    # The file of an activity in export_format, the first configured format by
+    # default. Raises KeyError for an unknown track_id.
+    def export_activity(self, track_id, export_format=None):
+        export_format = export_format or self.config['export_formats'][0]
+        self.check_export_format(export_format)
+        return self.run(self.export_track, track_id, [export_format])[0]
+
+    # (track_id, export_format, data) of every activity since begin_time in
+    # every configured format. One activity is loaded at a time.
+    def iter_exports(self, begin_time=0):
+        export_formats = [export_format for export_format in EXPORT_MODULES if export_format in self.config['export_formats']]
+        for track_id in self.get_track_ids(begin_time):
+            for export_format, data in zip(export_formats, self.run(self.export_track, track_id, export_formats)):
+                yield track_id, export_format, data
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+import fnmatch
+import glob
+import logging
+import os
+import sqlite3
+import time
+import amazfit_exporter
+import amazfit_exporter_config
+from amazfit_exporter_db import SportDatabase, connect
+from amazfit_exporter_index import ActivityIndex, is_selective
+from amazfit_exporter_manifest import ExportManifest, read_last_update_time, write_last_update_time
+from amazfit_exporter_output import ExportOutput
+from amazfit_exporter_summary import close_summary_indexes
+
+logger = logging.getLogger(__name__)
+
+# Expand glob patterns, since not every shell does it
+def expand_databases(paths):
+    databases = []
+    for path in paths:
+        if glob.has_magic(path):
+            databases.extend(sorted(glob.glob(path)))
+        else:
+            databases.append(path)
+    # keep the first occurrence of every database
+    return list(dict.fromkeys(os.path.abspath(database) for database in databases))
+
+# Several paths or a glob pattern start a batch export, even if the pattern
+# matches a single database today
+def is_batch(paths):
+    return len(paths) > 1 or any(glob.has_magic(path) for path in paths)
+
+# Number of trailing path parts which a glob pattern matches, e.g. 2 for
+# 'fleet/*/sport_data.db'
+def get_pattern_length(pattern):
+    parts = os.path.normpath(os.path.splitext(os.path.abspath(pattern))[0]).split(os.sep)
+    for index, part in enumerate(parts):
+        if glob.has_magic(part):
+            return len(parts) - index
+    return 1
+
+# Name of the output subdirectory of every database. The file name without
+# extension is used, prefixed with parent directories until it is unique,
+# e.g. 'device1_sport_data' and 'device2_sport_data'. A database matched by one
+# of the glob patterns is always prefixed with the directories matched by the
+# pattern, so its name does not change when the pattern matches more databases.
+def get_namespaces(databases, patterns=()):
+    parts = {database: os.path.normpath(os.path.splitext(database)[0]).split(os.sep) for database in databases}
+    minimum_lengths = dict.fromkeys(databases, 1)
+    for pattern in filter(glob.has_magic, patterns):
+        pattern_length = get_pattern_length(pattern)
+        for database in fnmatch.filter(databases, os.path.abspath(pattern)):
+            minimum_lengths[database] = max(minimum_lengths[database], pattern_length)
+    length = 1
+    while True:
+        namespaces = {database: '_'.join(filter(None, parts[database][-max(length, minimum_lengths[database]):])) for database in databases}
+        if len(set(namespaces.values())) == len(databases) or length >= max(len(path) for path in parts.values()):
+            return namespaces
+        length += 1
+
+# A database of the batch with its own output directory, checkpoint, manifest,
+# bundle and activity index
+class BatchDatabase:
+
+    def __init__(self, path, namespace, dest):
+        self.path = path
+        self.namespace = namespace
+        self.dest = os.path.join(dest, namespace)
+        self.manifest = ExportManifest(self.dest, amazfit_exporter_config.force)
+        self.output = ExportOutput(self.manifest)
+        self.activity_index = ActivityIndex(self.dest)
+        self.last_update_time = read_last_update_time(self.dest)
+        self.activities = []
+        self.files = 0
+        self.failed = 0
+        # track_ids of the failed exports
+        self.failed_track_ids = []
+        self.seconds = 0.0
+        self.error = None
+
+    # A file working copy needs a separate file for every database
+    def get_working_copy(self):
+        working_copy = amazfit_exporter_config.working_copy
+        if not working_copy or working_copy == ':memory:':
+            return working_copy
+        root, extension = os.path.splitext(working_copy)
+        return root + "-" + self.namespace + extension
+
+    # A selection is exported regardless of the checkpoint
+    def get_begin_time(self):
+        return 0 if is_selective() else self.last_update_time + 1
+
+    # A selection does not move the checkpoint, older activities would be
+    # skipped by the next export otherwise. The checkpoint stays below the
+    # first failed export.
+    def update_checkpoint(self):
+        self.output.close()
+        self.files = len(self.manifest.updates)
+        self.manifest.save()
+        if is_selective():
+            return
+        new_last_update_time = amazfit_exporter.get_checkpoint(self.activities, self.failed_track_ids)
+        if new_last_update_time >= 0:
+            write_last_update_time(self.dest, new_last_update_time)
+
+def export_serial(batch_databases):
+    for batch_database in batch_databases:
+        print("Exporting database '" + batch_database.path + "' to '" + batch_database.dest + "'.")
+        started = time.monotonic()
+        amazfit_exporter_config.manifest = batch_database.manifest
+        amazfit_exporter_config.output = batch_database.output
+        amazfit_exporter_config.activity_index = batch_database.activity_index
+        database = None
+        try:
+            database, db_uri = amazfit_exporter.open_database(batch_database.path, batch_database.get_working_copy())
+            amazfit_exporter.export_database(database, db_uri, batch_database.dest, batch_database.get_begin_time())
+            batch_database.activities = amazfit_exporter_config.activities
+            batch_database.update_checkpoint()
+        except sqlite3.DatabaseError:
+            batch_database.error = "database not readable"
+            logger.error("Error: Database not readable! Check database: '%s'", batch_database.path)
+        finally:
+            if database is not None:
+                database.close()
+            batch_database.output.close()
+        batch_database.seconds = time.monotonic() - started
+
+# The activities of all databases are exported by one pool of worker
+# processes, so small databases do not leave workers idle
+def export_parallel(batch_databases):
+    logger.info("Started parallel batch export with %d jobs", amazfit_exporter_config.jobs)
+    manifests = {batch_database.dest: batch_database.manifest for batch_database in batch_databases}
+    submitted = []
+    with amazfit_exporter.create_export_pool(manifests) as executor:
+        for batch_database in batch_databases:
+            started = time.monotonic()
+            database = None
+            amazfit_exporter_config.activity_index = batch_database.activity_index
+            try:
+                database, db_uri = amazfit_exporter.open_database(batch_database.path, batch_database.get_working_copy())
+                batch_database.activities = amazfit_exporter.get_activities(database, batch_database.get_begin_time())
+                units = amazfit_exporter.submit_exports(executor, db_uri, batch_database.dest, batch_database.activities)
+                submitted.append((batch_database, started, db_uri, units))
+            except sqlite3.DatabaseError:
+                batch_database.error = "database not readable"
+                batch_database.seconds = time.monotonic() - started
+                logger.error("Error: Database not readable! Check database: '%s'", batch_database.path)
+            finally:
+                if database is not None:
+                    database.close()
+        for batch_database, started, db_uri, units in submitted:
+            print("Exporting database '" + batch_database.path + "' to '" + batch_database.dest + "'.")
+            batch_database.failed_track_ids = amazfit_exporter.report_exports(units, batch_database.manifest, batch_database.output, batch_database.activity_index)
+            batch_database.failed = len(batch_database.failed_track_ids)
+            if 'CSV' in amazfit_exporter_config.export_formats and amazfit_exporter.is_csv_month_export('CSV'):
+                export_csv_months(batch_database, db_uri)
+            batch_database.seconds = time.monotonic() - started
+            batch_database.update_checkpoint()
+    logger.info("Finished parallel batch export")
+
+# The CSV month partitions are exported by the main process
+def export_csv_months(batch_database, db_uri):
+    amazfit_exporter_config.manifest = batch_database.manifest
+    amazfit_exporter_config.output = batch_database.output
+    amazfit_exporter_config.activity_index = batch_database.activity_index
+    database = SportDatabase(connect(db_uri))
+    try:
+        amazfit_exporter.export_csv_months(database, batch_database.dest, batch_database.activities)
+    finally:
+        database.close()
+
+def print_summary(batch_databases, seconds):
+    print("Batch summary:")
+    for batch_database in batch_databases:
+        if batch_database.error is not None:
+            print("\t" + batch_database.namespace + ": " + batch_database.error)
+            continue
+        print("\t%s: %d activities, %d files written, %d failed, %.2f s" % (batch_database.namespace, len(batch_database.activities), batch_database.files, batch_database.failed, batch_database.seconds))
+    print("\tTotal: %d databases, %d activities, %d files written, %d failed, %.2f s" % (
+        len(batch_databases),
+        sum(len(batch_database.activities) for batch_database in batch_databases),
+        sum(batch_database.files for batch_database in batch_databases),
+        sum(batch_database.failed for batch_database in batch_databases),
+        seconds))
+
+# Export every database into its own subdirectory of dest. Each database
+# continues after its own checkpoint, there is no interactive prompt. Returns
+# the number of failed exports. The
+# glob patterns of the command line name the subdirectories, see get_namespaces.
+def batch_export(databases, dest, patterns=()):
+    logger.info("Started batch export of %d databases", len(databases))
+    started = time.monotonic()
+    namespaces = get_namespaces(databases, patterns)
+    batch_databases = [BatchDatabase(database, namespaces[database], dest) for database in databases]
+    try:
+        if amazfit_exporter_config.jobs > 1:
+            export_parallel(batch_databases)
+        else:
+            export_serial(batch_databases)
+    finally:
+        for batch_database in batch_databases:
+            batch_database.activity_index.close()
+        close_summary_indexes()
+    print_summary(batch_databases, time.monotonic() - started)
+    logger.info("Finished batch export")
+    return sum(batch_database.failed for batch_database in batch_databases)
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+import itertools
+import logging
+import amazfit_exporter_config
+
+# Trackpoints are recorded every 1-3 seconds
+# The last 20 values should be sufficient to calculate cadence
+CADENCE_WINDOW = 20
+
+logger = logging.getLogger(__name__)
+
+# Calculate the cadences of a whole activity at once. step_counts contains a
+# step count or None for a missing value for every trackpoint. The window sums
+# are differences of the prefix sums, which gives the same values as a deque of
+# the last step counts, see tools/check_cadence.py. A missing value repeats the
+# cadence of the window and drops its oldest step count.
+def cadence_series(step_counts, window=CADENCE_WINDOW):
+    prefix_sums = list(itertools.accumulate((step_count for step_count in step_counts if step_count is not None), initial=0))
+    cadences = []
+    first = 0
+    last = 0
+    for step_count in step_counts:
+        if step_count is not None:
+            last += 1
+            first = max(first, last - window)
+        elif first == last:
+            cadences.append(None)
+            continue
+        cadences.append(int((prefix_sums[last] - prefix_sums[first]) * (60 / (last - first))))
+        if step_count is None:
+            first += 1
+    return cadences
+
+# Cadence for every heart rate match of an activity, None if there is no
+# cadence value
+def match_cadences(sport_type, heart_rates):
+    # cadence just for sport type 'Running'
+    if amazfit_exporter_config.no_cadence or sport_type != "Running":
+        return [None] * len(heart_rates)
+    step_counts = [None if heart_rate is None else heart_rate[1] for heart_rate in heart_rates]
+    logger.debug("Interpolate %d missing cadence values", step_counts.count(None))
+    return cadence_series(step_counts)
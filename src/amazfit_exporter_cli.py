@@ -1,94 +1,288 @@
 #!/usr/bin/python3
 import sys
 import argparse
+import cProfile
 import amazfit_exporter
+import amazfit_exporter_batch
+import amazfit_exporter_watch
 import amazfit_exporter_config
+import amazfit_exporter_index
+import amazfit_exporter_stats
+import amazfit_exporter_output
+import amazfit_exporter_simplify
+import amazfit_exporter_summary
+from amazfit_exporter_db import SportDatabase, connect, database_uri
+from amazfit_exporter_manifest import read_last_update_time, write_last_update_time
 import datetime
 import logging
+import sqlite3
 import time
 import os
 
 # Set logger
 logger = logging.getLogger(__name__)
 
+# Dates are given in UTC like the dates of the exported activities. A date
+# without time selects the whole day.
+def parse_date(value, end_of_day=False):
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    timestamp = int(date.timestamp() * 1000)
+    if end_of_day and len(value) == 10:
+        timestamp += 24 * 60 * 60 * 1000 - 1
+    return timestamp
+
+def parse_since(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: '%s'" % value)
+
+def parse_until(value):
+    try:
+        return parse_date(value, end_of_day=True)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: '%s'" % value)
+
+def parse_activity_types(value):
+    try:
+        return amazfit_exporter_index.parse_activity_types(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
 # Create command line argument parser
 parser = argparse.ArgumentParser(description='Export data from Amazfit Pace and Stratos database.')
 
-# Path to database. Mandatory argument.
-parser.add_argument('database', type=str, help='path to the database')
+# Path to database. Mandatory argument. Several databases or glob patterns start a batch export.
+parser.add_argument('database', nargs='+', type=str, help="path to the database, or to a directory of '*.db' files in watch mode. Several databases or glob patterns are exported into subdirectories of the output directory named after the database files")
 
 # Output directory argument
 parser.add_argument('-o', '--output', metavar='PATH', dest='output', type=str, default='./', help="path to the output directory (default: './')")
 
 # Export format argument
-parser.add_argument('--export-formats', nargs='+', metavar='FORMAT', choices=amazfit_exporter_config.AVAILABLE_EXPORT_FORMATS.keys(), help='define list of export formats (default: all). Available formats: %(choices)s')
+parser.add_argument('--export-formats', nargs='+', metavar='FORMAT', choices=amazfit_exporter_config.AVAILABLE_EXPORT_FORMATS.keys(), help='define list of export formats (default: ' + ', '.join(amazfit_exporter_config.DEFAULT_EXPORT_FORMATS) + '). Available formats: %(choices)s')
 
 # Exclude data from export options
 parser.add_argument('--no-hr', '--no-heart-rate', dest='no_heart_rate', action='store_true', default=False, help='disable heart rate export')
 parser.add_argument('--no-cadence', dest='no_cadence', action='store_true', default=False, help='disable cadence export')
 parser.add_argument('--no-calories', dest='no_calories', action='store_true', default=False, help='disable calories export')
 
+# Export behaviour options
+parser.add_argument('--csv-partition', metavar='PARTITION', dest='csv_partition', choices=amazfit_exporter_config.AVAILABLE_CSV_PARTITIONS.keys(), default='activity', help="define how the CSV export is split into files (default: 'activity'). Available partitions: %(choices)s")
+parser.add_argument('--hr-tolerance', metavar='MS', dest='heart_rate_tolerance', type=int, default=0, help='match trackpoints to the nearest heart rate sample within MS milliseconds (default: 0, exact second only)')
+parser.add_argument('--simplify', metavar='METRES', dest='simplify_tolerance', type=float, default=0, help='drop trackpoints which are less than METRES away from the simplified track (Ramer-Douglas-Peucker) in the TCX, GPX and FIT export (default: 0, keep all)')
+parser.add_argument('--decimate', metavar='SECONDS', dest='decimate_interval', type=int, default=0, help='export at most one trackpoint every SECONDS seconds in the TCX, GPX and FIT export. Heart rate and cadence are averaged over the dropped trackpoints (default: 0, keep all)')
+parser.add_argument('--laps', metavar='SPLIT', dest='lap_split', choices=amazfit_exporter_summary.AVAILABLE_LAP_SPLITS.keys(), default=None, help='split the TCX and FIT activities into laps of one kilometre or mile instead of a single lap. Available splits: %(choices)s')
+parser.add_argument('--streaming', dest='streaming', action='store_true', default=False, help='load and export one activity at a time to keep memory usage low')
+parser.add_argument('--working-copy', nargs='?', metavar='PATH', dest='working_copy', const=':memory:', default=None, help='export from an indexed copy of the database, stored at PATH or in memory if PATH is omitted')
+parser.add_argument('--xml-writer', metavar='WRITER', dest='xml_writer', choices=amazfit_exporter_config.AVAILABLE_XML_WRITERS.keys(), default='tree', help="define how the XML documents are written (default: 'tree'). Available writers: %(choices)s")
+parser.add_argument('--no-pretty-print', dest='pretty_print', action='store_false', default=True, help='write the XML documents without indentation to reduce their size')
+parser.add_argument('--compress', metavar='COMPRESSION', dest='compression', choices=amazfit_exporter_output.AVAILABLE_COMPRESSIONS.keys(), default=None, help='compress the exported files, e.g. 1546300800137.tcx.gz, or the members of the bundle. Available compressions: %(choices)s')
+parser.add_argument('--bundle', metavar='ARCHIVE', dest='bundle', choices=amazfit_exporter_output.AVAILABLE_BUNDLES.keys(), default=None, help='write all files of a run into one archive in the output directory instead of single files. Available archives: %(choices)s')
+parser.add_argument('--force', dest='force', action='store_true', default=False, help='rewrite all exported files, even if they are unchanged since the last export')
+parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int, default=1, help='number of worker processes exporting activities in parallel (default: 1)')
+
+# Selection options
+parser.add_argument('--since', metavar='DATE', dest='since', type=parse_since, default=None, help='export only the activities started at or after DATE (UTC), e.g. 2019-01-01 or 2019-01-01T12:00. Selected activities are exported regardless of the last synced activity, which is not changed')
+parser.add_argument('--until', metavar='DATE', dest='until', type=parse_until, default=None, help='export only the activities started until DATE (UTC), a date without time includes the whole day')
+parser.add_argument('--type', nargs='+', metavar='TYPE', dest='activity_types', type=parse_activity_types, default=None, help='export only activities of these types, given as number or as sport: ' + ', '.join(sorted(set(amazfit_exporter_config.SPORT_MAPPING.values()))))
+parser.add_argument('--ids', nargs='+', metavar='ID', dest='activity_ids', type=int, default=None, help='export only the activities with these ids (track_id)')
+
+# Watch mode options
+parser.add_argument('--watch', dest='watch', action='store_true', default=False, help='keep running and export new activities whenever the database changes, without asking for the begin time')
+parser.add_argument('--interval', metavar='SECONDS', dest='interval', type=int, default=10, help='seconds between two checks for changed databases in watch mode (default: 10)')
+
+# Report options
+parser.add_argument('--report', dest='report', action='store_true', default=False, help='print the distance, time, maximum speed and laps of the activities exported into the output directory from its summary index, without exporting')
+
+# Instrumentation options
+parser.add_argument('--stats-json', metavar='PATH', dest='stats_json', type=str, default=None, help='write the time of every export stage and counters of the exported data as JSON to PATH')
+parser.add_argument('--profile', metavar='PATH', dest='profile', type=str, default=None, help="profile the export with cProfile and write the statistics to PATH, which can be read with 'python -m pstats PATH'. Worker processes are not profiled")
+
 # Logging level options
 parser.add_argument('-v', '--verbose', dest='verbose',  action='store_true', default=False, help='print more information about runtime progress')
 parser.add_argument('-d', '--debug', dest='debug',  action='store_true', default=False, help="print debug information about runtime progress. This is more detailed than '--verbose'")
 
 # Version option
 parser.add_argument('--version', action='version', version='Amazfit Exporter 3.0')
-  
-args = parser.parse_args()
-
-# First set logging level
-if args.debug:
-    logging.getLogger().setLevel(logging.DEBUG)
-elif args.verbose:
-    logging.getLogger().setLevel(logging.INFO)
-
-logger.debug("Input args: %r", args)
-
-db = os.path.abspath(args.database)
-dest = os.path.abspath(args.output)
-
-# Set export formats if defined
-if args.export_formats:
-    amazfit_exporter_config.export_formats = args.export_formats 
-logger.info("Selected export formats: %r", amazfit_exporter_config.export_formats)
-
-amazfit_exporter_config.no_heart_rate = args.no_heart_rate
-logger.info("Disable heart rate: %s", amazfit_exporter_config.no_heart_rate)
-amazfit_exporter_config.no_cadence = args.no_cadence
-logger.info("Disable cadence: %s", amazfit_exporter_config.no_cadence)
-amazfit_exporter_config.no_calories = args.no_calories
-logger.info("Disable calories: %s", amazfit_exporter_config.no_calories)
-
-last_update_time = -1
-
-print("Exporting database '" + db + "' to '" + dest + "'.")
-
-# Check if the db file exists
-if not os.path.isfile(db):
-    logger.error("Error: Database not found! Check path to database: '%s'", db)
-    sys.exit(1)
-
-last_update_file_path = os.path.join(dest, "lstupd.txt")
-if os.path.isfile(last_update_file_path):
-    last_update_file = open(last_update_file_path,'r')
-    last_update_time = int(last_update_file.read().strip() or -1)
-    last_update_file.close()
-
-if last_update_time >= 0:
-    updtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(last_update_time/1000)))
-    print('The last synced activity was at: '+ str(updtime))
-    update_begin_time = input('Press <Enter> to accept, 0 to resync everything >> ') or (last_update_time + 1 if last_update_time >= 0 else 0)
-else:
-    print('No previous sync found: Exporting everything')
-    update_begin_time = 0
-
-new_last_update_time = amazfit_exporter.start_export(db,dest,int(update_begin_time))
-
-# Completed without crashing, check if new activity was synced, so update the last update file for next time
-if new_last_update_time >= 0:
-    last_update_file = open(last_update_file_path,'w')
-    last_update_file.write(str(new_last_update_time))
-    last_update_file.close()
-else:
-    print ("Nothing to sync")
+
+# Print the summaries of the output directories of the databases, which are
+# named like in the batch export
+def report(args, databases, dest):
+    if not amazfit_exporter_batch.is_batch(args.database):
+        amazfit_exporter_summary.print_summaries(dest)
+        return
+    namespaces = amazfit_exporter_batch.get_namespaces(databases, args.database)
+    for db in databases:
+        amazfit_exporter_summary.print_summaries(os.path.join(dest, namespaces[db]))
+
+# Unreadable databases are reported by the export
+def has_new_activities(db, begin_time):
+    try:
+        database = SportDatabase(connect(database_uri(db)))
+    except sqlite3.DatabaseError:
+        return True
+    try:
+        return database.get_last_track_id() >= begin_time
+    except sqlite3.DatabaseError:
+        return True
+    finally:
+        database.close()
+
+# Run the export selected by the command line arguments
+def export(args, databases, dest):
+    if args.report:
+        report(args, databases, dest)
+        return
+    if args.watch:
+        # The databases can also be drop directories in watch mode
+        for db in databases:
+            if not os.path.exists(db):
+                logger.error("Error: Database not found! Check path to database: '%s'", db)
+                sys.exit(1)
+        amazfit_exporter_watch.watch(databases, dest, max(args.interval, 1), args.database)
+        return
+
+    if amazfit_exporter_batch.is_batch(args.database):
+        # Every database continues after its own checkpoint, without asking,
+        # also if a glob pattern matches a single database
+        if amazfit_exporter_batch.batch_export(databases, dest, args.database):
+            sys.exit(1)
+        return
+
+    db = databases[0]
+
+    print("Exporting database '" + db + "' to '" + dest + "'.")
+
+    # Check if the db file exists
+    if not os.path.isfile(db):
+        logger.error("Error: Database not found! Check path to database: '%s'", db)
+        sys.exit(1)
+
+    # A selection is exported without asking and keeps the last update file
+    if amazfit_exporter_index.is_selective():
+        if amazfit_exporter.start_export(db, dest, 0) < 0:
+            print("No activity selected")
+        return
+
+    last_update_time = read_last_update_time(dest)
+
+    if last_update_time >= 0:
+        updtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(last_update_time/1000)))
+        print('The last synced activity was at: '+ str(updtime))
+        update_begin_time = input('Press <Enter> to accept, 0 to resync everything >> ') or (last_update_time + 1 if last_update_time >= 0 else 0)
+    else:
+        print('No previous sync found: Exporting everything')
+        update_begin_time = 0
+
+    # Most scheduled runs have nothing to sync. They only read the highest
+    # track_id and end before the writers and the data are loaded.
+    if not has_new_activities(db, int(update_begin_time)):
+        print("Nothing to sync")
+        return
+
+    new_last_update_time = amazfit_exporter.start_export(db,dest,int(update_begin_time))
+
+    # Completed without crashing, check if new activity was synced, so update the last update file for next time
+    if new_last_update_time >= 0:
+        write_last_update_time(dest, new_last_update_time)
+    elif not amazfit_exporter_config.failed_track_ids:
+        print ("Nothing to sync")
+    # Failed exports of the worker processes are retried by the next export
+    if amazfit_exporter_config.failed_track_ids:
+        sys.exit(1)
+
+# The export is only started when run as a script, since worker processes
+# of the parallel export import this module again on some platforms
+def main():
+    args = parser.parse_args()
+
+    # Logging is configured by the command line tool, so importing the exporter
+    # modules does not change the logging of other programs
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    # First set logging level
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    elif args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    logger.debug("Input args: %r", args)
+
+    databases = amazfit_exporter_batch.expand_databases(args.database)
+    dest = os.path.abspath(args.output)
+
+    # Set export formats if defined
+    if args.export_formats:
+        amazfit_exporter_config.export_formats = args.export_formats 
+    logger.info("Selected export formats: %r", amazfit_exporter_config.export_formats)
+
+    amazfit_exporter_config.no_heart_rate = args.no_heart_rate
+    logger.info("Disable heart rate: %s", amazfit_exporter_config.no_heart_rate)
+    amazfit_exporter_config.no_cadence = args.no_cadence
+    logger.info("Disable cadence: %s", amazfit_exporter_config.no_cadence)
+    amazfit_exporter_config.heart_rate_tolerance = max(args.heart_rate_tolerance, 0)
+    logger.info("Heart rate tolerance: %d ms", amazfit_exporter_config.heart_rate_tolerance)
+    amazfit_exporter_config.no_calories = args.no_calories
+    logger.info("Disable calories: %s", amazfit_exporter_config.no_calories)
+    amazfit_exporter_config.simplify_tolerance = max(args.simplify_tolerance, 0)
+    logger.info("Simplify tolerance: %s m", amazfit_exporter_config.simplify_tolerance)
+    amazfit_exporter_config.decimate_interval = max(args.decimate_interval, 0)
+    logger.info("Decimate interval: %d s", amazfit_exporter_config.decimate_interval)
+    amazfit_exporter_config.lap_split = args.lap_split
+    logger.info("Lap split: %s", amazfit_exporter_config.lap_split)
+    amazfit_exporter_config.streaming = args.streaming
+    logger.info("Streaming export: %s", amazfit_exporter_config.streaming)
+    if args.working_copy and args.working_copy != ':memory:':
+        args.working_copy = os.path.abspath(args.working_copy)
+    amazfit_exporter_config.working_copy = args.working_copy
+    logger.info("Working copy: %s", amazfit_exporter_config.working_copy)
+    amazfit_exporter_config.xml_writer = args.xml_writer
+    logger.info("XML writer: %s", amazfit_exporter_config.xml_writer)
+    amazfit_exporter_config.csv_partition = args.csv_partition
+    logger.info("CSV partition: %s", amazfit_exporter_config.csv_partition)
+    amazfit_exporter_config.pretty_print = args.pretty_print
+    logger.info("Pretty print: %s", amazfit_exporter_config.pretty_print)
+    amazfit_exporter_config.compression = args.compression
+    logger.info("Compression: %s", amazfit_exporter_config.compression)
+    amazfit_exporter_config.bundle = args.bundle
+    logger.info("Bundle: %s", amazfit_exporter_config.bundle)
+    amazfit_exporter_config.force = args.force
+    logger.info("Force export: %s", amazfit_exporter_config.force)
+    amazfit_exporter_config.jobs = max(args.jobs, 1)
+    logger.info("Export jobs: %d", amazfit_exporter_config.jobs)
+    amazfit_exporter_config.since = args.since
+    logger.info("Since: %s", amazfit_exporter_config.since)
+    amazfit_exporter_config.until = args.until
+    logger.info("Until: %s", amazfit_exporter_config.until)
+    if args.activity_types:
+        amazfit_exporter_config.activity_types = set().union(*args.activity_types)
+    logger.info("Activity types: %s", amazfit_exporter_config.activity_types)
+    if args.activity_ids:
+        amazfit_exporter_config.activity_ids = set(args.activity_ids)
+    logger.info("Activity ids: %s", amazfit_exporter_config.activity_ids)
+    if args.watch and amazfit_exporter_index.is_selective():
+        parser.error("--since, --until, --type and --ids can not be used in watch mode")
+    # A month partition always contains every activity of its month
+    if amazfit_exporter_index.is_selective() and 'CSV' in amazfit_exporter_config.export_formats and amazfit_exporter_config.csv_partition == 'month':
+        parser.error("--since, --until, --type and --ids can not be used with --csv-partition month")
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        export(args, databases, dest)
+        if amazfit_exporter_simplify.is_simplified():
+            amazfit_exporter_simplify.print_report()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            logger.info("Write profile to '%s'", args.profile)
+            profiler.dump_stats(args.profile)
+        if args.stats_json:
+            amazfit_exporter_stats.stats.save(args.stats_json)
+
+if __name__ == '__main__':
+    main()
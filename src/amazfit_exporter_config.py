@@ -1,22 +1,110 @@
 #!/usr/bin/python3
-import logging, sys
-
-logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+import contextvars
+import copy
+import sys
+import types
 
 AVAILABLE_EXPORT_FORMATS = {
     'TCX': 'Training Center XML',
-    'GPX': 'GPS Exchange Format'
+    'GPX': 'GPS Exchange Format',
+    'FIT': 'Flexible and Interoperable Data Transfer',
+    'CSV': 'Comma-separated trackpoints for analytics'
 }
 
-export_formats = AVAILABLE_EXPORT_FORMATS.keys()
+# The FIT and analytics exports have to be selected explicitly, so existing
+# runs keep their output
+DEFAULT_EXPORT_FORMATS = ['TCX', 'GPX']
+
+export_formats = DEFAULT_EXPORT_FORMATS
+
+AVAILABLE_CSV_PARTITIONS = {
+    'activity': 'one file per activity',
+    'month': 'one file per month with all activities of the month'
+}
+
+csv_partition = 'activity'
+
+AVAILABLE_XML_WRITERS = {
+    'tree': 'build the whole document in memory and write it at once',
+    'stream': 'write the document incrementally while it is generated',
+    'template': 'render the document from precompiled templates without lxml'
+}
+
+xml_writer = 'tree'
+
+# indent the XML documents, switch off to reduce the size of the files
+pretty_print = True
+
+# compression of the exported files, see amazfit_exporter_output.AVAILABLE_COMPRESSIONS
+compression = None
+
+# write the files of a run into one archive instead of single files, see
+# amazfit_exporter_output.AVAILABLE_BUNDLES
+bundle = None
 
 no_heart_rate = False
 no_cadence = False
 no_calories = False
 
+# maximum distance in milliseconds between a trackpoint and its heart rate sample
+heart_rate_tolerance = 0
+
+# maximum distance in metres of a dropped trackpoint from the simplified
+# track, 0 keeps all trackpoints
+simplify_tolerance = 0
+
+# minimum seconds between two exported trackpoints, 0 keeps all trackpoints
+decimate_interval = 0
+
+# split the TCX and FIT activities into laps of one km or mile, one of
+# amazfit_exporter_summary.AVAILABLE_LAP_SPLITS, None for a single lap
+lap_split = None
+
+# load and write one activity at a time instead of loading all data up front
+streaming = False
+
+# path of an indexed copy of the database (':memory:' for an in-memory copy),
+# None to read the database directly
+working_copy = None
+
+# rewrite all exported files, even if they are unchanged according to the manifest
+force = False
+
+# number of worker processes for the export
+jobs = 1
+
+# select the exported activities from the activity index instead of exporting
+# everything since the last export: track_ids from since to until (inclusive),
+# a set of activity types and a set of track_ids, None selects all
+since = None
+until = None
+activity_types = None
+activity_ids = None
+
 activities = []
-trackpoint_data = []
-heart_rate_data = []
+# track_ids of the exports which failed in worker processes, see
+# amazfit_exporter.export_database
+failed_track_ids = []
+# trackpoints grouped by track_id
+trackpoints = {}
+# amazfit_exporter_heart_rate.HeartRateData of the loaded activities
+heart_rate_data = None
+# amazfit_exporter_manifest.ExportManifest of the output directory
+manifest = None
+# amazfit_exporter_output.ExportOutput of the output directory
+output = None
+# amazfit_exporter_index.ActivityIndex of the output directory
+activity_index = None
+# (trackpoints, amazfit_exporter_summary.ActivitySummary by track_id) of the
+# loaded trackpoints
+summaries = None
+# (trackpoints, fingerprint of the activity data by track_id) of the loaded
+# trackpoints, see amazfit_exporter_manifest.get_activity_data_fingerprint
+data_fingerprints = None
+
+# The options and run state above, every exporter of the library API starts
+# from them, see amazfit_exporter.Exporter
+DEFAULTS = {name: value for name, value in globals().items() if name.islower() and not name.startswith('_') and not isinstance(value, types.ModuleType)}
 
 # Map Amazfit DB to strings
 SPORT_MAPPING = {
@@ -33,3 +121,36 @@ SPORT_MAPPING = {
     10: "Biking", # Indoor Biking
 }
 
+# The options and run state of the exporter running in the current thread or
+# task, None for the module attributes used by the command line tool
+current_config = contextvars.ContextVar('current_config', default=None)
+
+def get_defaults():
+    return copy.deepcopy(DEFAULTS)
+
+# The options and run state are read and written through the module as before.
+# While an exporter of the library API runs, they are looked up in its
+# configuration, so exporters in different threads do not share any state.
+class ConfigModule(types.ModuleType):
+
+    def __getattribute__(self, name):
+        config = current_config.get()
+        if config is not None and name in config:
+            return config[name]
+        return super().__getattribute__(name)
+
+    def __setattr__(self, name, value):
+        config = current_config.get()
+        if config is not None and name in config:
+            config[name] = value
+        else:
+            super().__setattr__(name, value)
+
+# The lookup costs time on every access, so it is only installed by the first
+# exporter of the library API. The command line tool reads the module directly.
+# The module class is replaced for the whole process and is never restored.
+# Code which runs outside of an exporter, e.g. the command line functions
+# called from the same process, still reads and writes the module attributes,
+# only with the cost of the lookup.
+def enable_contexts():
+    sys.modules[__name__].__class__ = ConfigModule
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+import csv
+from datetime import datetime, timezone
+import hashlib
+import io
+import logging
+import os
+import amazfit_exporter_config
+from amazfit_exporter_heart_rate import get_trackpoint_timestamp, match_trackpoints
+from amazfit_exporter_cadence import match_cadences
+from amazfit_exporter_manifest import get_activity_fingerprint
+from amazfit_exporter_output import create_output_directory, get_output_path, open_output_file
+from amazfit_exporter_stats import stats
+
+# One row per trackpoint with the values of the TCX export
+CSV_COLUMNS = ['track_id', 'time', 'latitude', 'longitude', 'altitude', 'heart_rate', 'cadence', 'sport']
+
+logger = logging.getLogger(__name__)
+
+def local_date_to_utc(date):
+    return datetime.utcfromtimestamp(int(date / 1000))
+
+def get_sport_type(activity):
+    # Try to map Amazfit types to TCX types. If there's no match use "Other"
+    return amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+
+# Join the trackpoints of the activity with their heart rate and cadence values
+def get_activity_trackpoints(activity):
+    trackpoints = amazfit_exporter_config.trackpoints.get(activity['track_id'], [])
+    with stats.stage("csv.match"):
+        heart_rates = match_trackpoints(trackpoints)
+        cadences = match_cadences(get_sport_type(activity), heart_rates)
+    stats.count("csv.trackpoints", len(trackpoints))
+    stats.count("csv.heart_rate_matches", len(heart_rates) - heart_rates.count(None))
+    return list(zip(trackpoints, heart_rates, cadences))
+
+# Missing values are written as empty fields
+def get_trackpoint_row(identifier, sport_type, trackpoint, heart_rate, cadence):
+    altitude = trackpoint.altitude
+    # only use realistic altitude values
+    if not altitude > -20:
+        altitude = ""
+
+    heart_rate_bpm = ""
+    # include only positive bpm values
+    if heart_rate is not None and not amazfit_exporter_config.no_heart_rate and int(heart_rate[0]) > 0:
+        heart_rate_bpm = int(heart_rate[0])
+
+    timestamp = local_date_to_utc(get_trackpoint_timestamp(trackpoint)).isoformat() + "Z"
+    return identifier, timestamp, trackpoint.latitude, trackpoint.longitude, altitude, heart_rate_bpm, "" if cadence is None else cadence, sport_type
+
+def write_activity_rows(writer, activity):
+    identifier = activity['track_id']
+    sport_type = get_sport_type(activity)
+    writer.writerows(get_trackpoint_row(identifier, sport_type, trackpoint, heart_rate, cadence) for trackpoint, heart_rate, cadence in get_activity_trackpoints(activity))
+
+def create_csv_writer(output_file):
+    # csv writes text, the output files are opened in binary mode
+    text_file = io.TextIOWrapper(output_file, encoding='utf-8', newline='')
+    writer = csv.writer(text_file, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    return text_file, writer
+
+# Month partitions are named by the UTC month of the activities, e.g. '2019-01'
+def get_month(activity):
+    return local_date_to_utc(activity['track_id']).strftime('%Y-%m')
+
+# First and last track_id of a month partition
+def get_month_range(month):
+    begin = datetime.strptime(month, '%Y-%m').replace(tzinfo=timezone.utc)
+    if begin.month == 12:
+        end = begin.replace(year=begin.year + 1, month=1)
+    else:
+        end = begin.replace(month=begin.month + 1)
+    return int(begin.timestamp() * 1000), int(end.timestamp() * 1000) - 1
+
+# The fingerprint of a month partition combines the fingerprints of its activities
+def get_month_fingerprint(activity_fingerprints):
+    return hashlib.sha256("".join(activity_fingerprints).encode()).hexdigest()
+
+# Write a month partition from the loaded trackpoints of its activities
+def month_to_csv(csv_dest, month, activities, fingerprint):
+    output_path = get_output_path(os.path.join(csv_dest, month + ".csv"))
+    manifest = amazfit_exporter_config.manifest
+    if manifest is not None and manifest.is_current(output_path, fingerprint):
+        logger.info("Skip unchanged month %s", month)
+        stats.count("csv.files_skipped")
+        return
+    with stats.stage("csv.render"), open_output_file(output_path) as output_file:
+        text_file, writer = create_csv_writer(output_file)
+        for activity in activities:
+            write_activity_rows(writer, activity)
+        text_file.flush()
+        text_file.detach()
+    stats.count("csv.files_written")
+    if manifest is not None:
+        manifest.record(output_path, fingerprint)
+
+def create_csv_dest(dest):
+    csv_dest = dest + "/CSV/"
+    create_output_directory(os.path.dirname(csv_dest))
+    return csv_dest
+
+def activity_to_csv(csv_dest, activity):
+    identifier = activity['track_id']
+    output_path = get_output_path(os.path.join(csv_dest, str(identifier) + ".csv"))
+    # Skip activities which are unchanged since the last export
+    manifest = amazfit_exporter_config.manifest
+    if manifest is not None:
+        with stats.stage("csv.fingerprint"):
+            fingerprint = get_activity_fingerprint('CSV', activity)
+        if manifest.is_current(output_path, fingerprint):
+            logger.info("Skip unchanged activity %d", identifier)
+            stats.count("csv.files_skipped")
+            return
+    # The rows are written while they are generated
+    with stats.stage("csv.render"), open_output_file(output_path) as output_file:
+        text_file, writer = create_csv_writer(output_file)
+        write_activity_rows(writer, activity)
+        text_file.flush()
+        text_file.detach()
+    stats.count("csv.files_written")
+    if manifest is not None:
+        manifest.record(output_path, fingerprint)
+
+def db_to_csv(dest):
+    logger.info("Started csv export")
+    print("CSV export:")
+    csv_dest = create_csv_dest(dest)
+    for activity in amazfit_exporter_config.activities:
+        identifier = activity['track_id']
+        print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other"))
+        activity_to_csv(csv_dest, activity)
+    logger.info("Finished csv export")
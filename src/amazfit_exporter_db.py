@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import pathlib
+import queue
+import sqlite3
+from amazfit_exporter_heart_rate import HeartRateData, get_trackpoint_timestamp
+from amazfit_exporter_trackpoints import FETCH_SIZE, Trackpoints, read_trackpoints
+
+# The exporter uses only a handful of statements, all of them stay prepared
+CACHED_STATEMENTS = 32
+
+# The database is only read, so a large page cache, memory mapped I/O and
+# temporary tables for sorting in memory are used
+READ_ONLY_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA cache_size = -65536;
+    PRAGMA temp_store = MEMORY;"""
+
+# Indexes for the queries of the exporter. The watch database has none of them.
+WORKING_COPY_INDEXES = """
+    CREATE INDEX IF NOT EXISTS heart_rate_time ON heart_rate(time);
+    CREATE INDEX IF NOT EXISTS location_data_track_id_timestamp ON location_data(track_id, timestamp);"""
+
+ACTIVITIES_QUERY = "SELECT track_id, start_time, end_time, calorie, type, content FROM sport_summary WHERE track_id >= ? AND (type BETWEEN 1 AND 15)"
+
+ACTIVITIES_BETWEEN_QUERY = "SELECT track_id, start_time, end_time, calorie, type, content FROM sport_summary WHERE track_id BETWEEN ? AND ? AND (type BETWEEN 1 AND 15) ORDER BY track_id"
+
+# The highest track_id decides if there is anything to sync
+LAST_TRACK_ID_QUERY = "SELECT MAX(track_id) FROM sport_summary WHERE (type BETWEEN 1 AND 15)"
+
+ACTIVITY_QUERY = "SELECT track_id, start_time, end_time, calorie, type, content FROM sport_summary WHERE track_id = ?"
+
+# Lists of track_ids are passed as a JSON array, so the number of selected
+# activities is not limited by the number of SQL parameters
+SELECTED_ACTIVITIES_QUERY = "SELECT track_id, start_time, end_time, calorie, type, content FROM sport_summary WHERE track_id IN (SELECT value FROM json_each(?)) AND (type BETWEEN 1 AND 15) ORDER BY track_id"
+
+# All activities for the activity index
+ACTIVITY_INDEX_QUERY = "SELECT track_id, start_time, end_time, type FROM sport_summary WHERE (type BETWEEN 1 AND 15) ORDER BY track_id"
+
+TRACKPOINT_COUNTS_QUERY = "SELECT track_id, COUNT(*) AS trackpoints FROM location_data WHERE track_id IN (SELECT value FROM json_each(?)) AND point_type > 0 GROUP BY track_id"
+
+# Number of heart rate samples between the start and end time of the given
+# activities, in one pass over the samples. The samples and the start and end
+# times are sorted into one sequence with a running count of the samples: a
+# start is sorted before the samples of the same time and an end after them,
+# so end minus start is the number of samples within the activity, also for
+# overlapping activities.
+HEART_RATE_COUNTS_QUERY = """
+    WITH activity AS (
+        SELECT track_id, start_time, end_time FROM sport_summary WHERE track_id IN (SELECT value FROM json_each(?))),
+    event AS (
+        SELECT time, 0 AS kind, NULL AS track_id FROM heart_rate
+        WHERE time BETWEEN (SELECT MIN(start_time) FROM activity) AND (SELECT MAX(end_time) FROM activity)
+        UNION ALL SELECT start_time, -1, track_id FROM activity
+        UNION ALL SELECT end_time, 1, track_id FROM activity),
+    running AS (
+        SELECT track_id, kind, SUM(kind = 0) OVER (ORDER BY time, kind ROWS UNBOUNDED PRECEDING) AS samples FROM event)
+    SELECT track_id, SUM(kind * samples) AS heart_rate_samples FROM running WHERE kind != 0 GROUP BY track_id"""
+
+# Sorted by track_id, so the trackpoints can be grouped by activity in a single pass
+TRACKPOINTS_QUERY = "SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id >= ? AND point_type > 0 ORDER BY track_id, timestamp"
+
+# Only the trackpoints of the selected activities
+WORKING_COPY_TRACKPOINTS_QUERY = "SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id IN (SELECT track_id FROM sport_summary WHERE track_id >= ? AND (type BETWEEN 1 AND 15)) AND point_type > 0 ORDER BY track_id, timestamp"
+
+# Only the trackpoints of the activities selected from the activity index
+SELECTED_TRACKPOINTS_QUERY = "SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id IN (SELECT value FROM json_each(?)) AND point_type > 0 ORDER BY track_id, timestamp"
+
+ACTIVITY_TRACKPOINTS_QUERY = "SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id = ? AND point_type > 0 ORDER BY timestamp"
+
+# Sorted by time and rowid, so the first sample of each timestamp is kept
+HEART_RATES_QUERY = "SELECT time, rate, step_count FROM heart_rate WHERE time >= ? ORDER BY time, rowid"
+
+# The heart rate samples within the trackpoints of every selected activity.
+# Duplicate timestamps are removed by grouping, the bare columns of a MIN()
+# aggregate are taken from the first sample of each timestamp.
+WORKING_COPY_HEART_RATES_QUERY = """
+    WITH windows AS (
+        SELECT location_data.track_id + MIN(location_data.timestamp) / 1000 * 1000 - :tolerance AS begin_time,
+            location_data.track_id + MAX(location_data.timestamp) / 1000 * 1000 + :tolerance AS end_time
+        FROM sport_summary JOIN location_data ON location_data.track_id = sport_summary.track_id
+        WHERE sport_summary.track_id >= :begin_time AND (sport_summary.type BETWEEN 1 AND 15) AND location_data.point_type > 0
+        GROUP BY location_data.track_id)
+    SELECT time, rate, step_count FROM (
+        SELECT heart_rate.time, heart_rate.rate, heart_rate.step_count, MIN(heart_rate.rowid)
+        FROM windows JOIN heart_rate ON heart_rate.time BETWEEN windows.begin_time AND windows.end_time
+        GROUP BY heart_rate.time)
+    ORDER BY time"""
+
+ACTIVITY_HEART_RATES_QUERY = "SELECT time, rate, step_count FROM heart_rate WHERE time BETWEEN ? AND ? ORDER BY time, rowid"
+
+logger = logging.getLogger(__name__)
+
+def database_uri(db):
+    return pathlib.Path(db).as_uri() + "?mode=ro"
+
+# Open a read-only connection with the statement cache for the exporter queries
+def connect(uri, check_same_thread=True):
+    return sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS, check_same_thread=check_same_thread)
+
+# The heart rate samples of activities exported one after another, read from
+# one cursor sorted by time instead of a range query per activity, which scans
+# the whole heart_rate table without the indexes of a working copy. Only the
+# samples from the begin of the last window on are kept. A window which begins
+# before the last window starts a new cursor.
+class HeartRateCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+        self.begin_time = None
+        # (time, rate, step_count) read from the cursor, sorted by time
+        self.rows = collections.deque()
+
+    def drop_rows(self, begin_time):
+        rows = self.rows
+        while rows and rows[0][0] < begin_time:
+            rows.popleft()
+
+    def get(self, begin_time, end_time):
+        return HeartRateData(self.get_rows(begin_time, end_time))
+
+    def get_rows(self, begin_time, end_time):
+        if self.cursor is None or begin_time < self.begin_time:
+            self.close()
+            self.cursor = self.connection.cursor()
+            self.cursor.row_factory = None
+            self.cursor.execute(HEART_RATES_QUERY, (begin_time,))
+        self.begin_time = begin_time
+        rows = self.rows
+        self.drop_rows(begin_time)
+        # read until the first sample after the window
+        while not rows or rows[-1][0] <= end_time:
+            batch = self.cursor.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+            # a batch before the window is dropped as a whole
+            if batch[-1][0] < begin_time:
+                continue
+            rows.extend(batch)
+            self.drop_rows(begin_time)
+        return itertools.takewhile(lambda row: row[0] <= end_time, rows)
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        self.rows.clear()
+
+# Read-only access to a sport database. Every instance has its own connection,
+# so instances can be used by different threads or processes.
+class SportDatabase:
+
+    def __init__(self, connection, indexed=False):
+        self.connection = connection
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(READ_ONLY_PRAGMAS)
+        # only working copies have the indexes for the range queries
+        self.indexed = indexed
+
+    def close(self):
+        self.connection.close()
+
+    # The watch database is opened read-only, so it is copied to a database
+    # in memory or a local file where the indexes can be created
+    def create_working_copy(self, path):
+        logger.info("Create working copy of the database at '%s'", path)
+        working_connection = sqlite3.connect(path, cached_statements=CACHED_STATEMENTS)
+        self.connection.backup(working_connection)
+        working_connection.executescript(WORKING_COPY_INDEXES)
+        working_connection.commit()
+        return SportDatabase(working_connection, indexed=True)
+
+    def get_activities(self, begin_time):
+        # Use begin_time to load only data beyond that time
+        return self.connection.execute(ACTIVITIES_QUERY, (begin_time,)).fetchall()
+
+    def get_activities_between(self, begin_time, end_time):
+        return self.connection.execute(ACTIVITIES_BETWEEN_QUERY, (begin_time, end_time)).fetchall()
+
+    # The highest track_id of the database, -1 without activities
+    def get_last_track_id(self):
+        last_track_id = self.connection.execute(LAST_TRACK_ID_QUERY).fetchone()[0]
+        return -1 if last_track_id is None else last_track_id
+
+    def get_activity(self, track_id):
+        return self.connection.execute(ACTIVITY_QUERY, (track_id,)).fetchone()
+
+    # Activities of the given track_ids which are still in the database
+    def get_selected_activities(self, track_ids):
+        return self.connection.execute(SELECTED_ACTIVITIES_QUERY, (json.dumps(track_ids),)).fetchall()
+
+    def get_index_activities(self):
+        return self.connection.execute(ACTIVITY_INDEX_QUERY).fetchall()
+
+    # Number of trackpoints of the given activities by track_id
+    def get_trackpoint_counts(self, track_ids):
+        return dict(self.connection.execute(TRACKPOINT_COUNTS_QUERY, (json.dumps(track_ids),)).fetchall())
+
+    # Number of heart rate samples of the given activities by track_id
+    def get_heart_rate_counts(self, track_ids):
+        return dict(self.connection.execute(HEART_RATE_COUNTS_QUERY, (json.dumps(track_ids),)).fetchall())
+
+    # The trackpoints are stored in columns, so their rows are read as plain
+    # tuples instead of sqlite3.Row objects
+    def execute_tuples(self, query, parameters):
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        return cursor.execute(query, parameters)
+
+    # amazfit_exporter_trackpoints.Trackpoints of all activities since
+    # begin_time grouped by track_id
+    def get_trackpoints(self, begin_time):
+        return read_trackpoints(self.execute_tuples(WORKING_COPY_TRACKPOINTS_QUERY if self.indexed else TRACKPOINTS_QUERY, (begin_time,)))
+
+    # Trackpoints of the given activities grouped by track_id
+    def get_selected_trackpoints(self, track_ids):
+        return read_trackpoints(self.execute_tuples(SELECTED_TRACKPOINTS_QUERY, (json.dumps(track_ids),)))
+
+    def get_activity_trackpoints(self, track_id):
+        return read_trackpoints(self.execute_tuples(ACTIVITY_TRACKPOINTS_QUERY, (track_id,))).get(track_id, Trackpoints(track_id))
+
+    def get_heart_rates(self, begin_time, tolerance=0):
+        if self.indexed:
+            return HeartRateData(self.connection.execute(WORKING_COPY_HEART_RATES_QUERY, {'begin_time': begin_time, 'tolerance': tolerance}))
+        return HeartRateData(self.connection.execute(HEART_RATES_QUERY, (begin_time,)))
+
+    def open_heart_rate_cursor(self):
+        return HeartRateCursor(self.connection)
+
+    # Activities exported one after another read their samples from a
+    # HeartRateCursor, a single activity with a range query
+    def get_activity_heart_rates(self, trackpoints, tolerance=0, heart_rate_cursor=None):
+        if not trackpoints:
+            return HeartRateData()
+        # Trackpoints are sorted by timestamp, so the first and last trackpoint define
+        # the time window, extended by the matching tolerance.
+        begin_time = get_trackpoint_timestamp(trackpoints[0]) - tolerance
+        end_time = get_trackpoint_timestamp(trackpoints[-1]) + tolerance
+        if heart_rate_cursor is not None:
+            return heart_rate_cursor.get(begin_time, end_time)
+        return HeartRateData(self.connection.execute(ACTIVITY_HEART_RATES_QUERY, (begin_time, end_time)))
+
+    # Heart rate samples from the first to the last trackpoint of every selected
+    # activity, trackpoints is grouped by track_id like get_selected_trackpoints.
+    # Overlapping windows are merged and the samples between the windows are
+    # skipped by one HeartRateCursor.
+    def get_selected_heart_rates(self, trackpoints, tolerance=0):
+        windows = sorted(
+            [get_trackpoint_timestamp(activity_trackpoints[0]) - tolerance, get_trackpoint_timestamp(activity_trackpoints[-1]) + tolerance]
+            for activity_trackpoints in trackpoints.values() if activity_trackpoints)
+        merged = []
+        for begin_time, end_time in windows:
+            if merged and begin_time <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end_time)
+            else:
+                merged.append([begin_time, end_time])
+        heart_rate_data = HeartRateData()
+        heart_rate_cursor = self.open_heart_rate_cursor()
+        try:
+            for begin_time, end_time in merged:
+                heart_rate_data.extend(heart_rate_cursor.get_rows(begin_time, end_time))
+        finally:
+            heart_rate_cursor.close()
+        return heart_rate_data
+
+# Pool of read-only connections to the same database for threads. Idle
+# connections are kept, so prepared statements and caches stay warm.
+class ConnectionPool:
+
+    def __init__(self, uri, size, indexed=False):
+        self.uri = uri
+        self.size = size
+        self.indexed = indexed
+        self.idle = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def database(self):
+        try:
+            database = self.idle.get_nowait()
+        except queue.Empty:
+            database = SportDatabase(connect(self.uri, check_same_thread=False), self.indexed)
+        try:
+            yield database
+        finally:
+            if self.idle.qsize() < self.size:
+                self.idle.put(database)
+            else:
+                database.close()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+from array import array
+from datetime import datetime
+import logging
+import os
+import struct
+import sys
+import amazfit_exporter_config
+from amazfit_exporter_heart_rate import get_trackpoint_timestamp, match_trackpoints
+from amazfit_exporter_cadence import match_cadences
+from amazfit_exporter_manifest import get_activity_fingerprint
+from amazfit_exporter_output import create_output_directory, get_output_path, open_output_file
+from amazfit_exporter_simplify import is_simplified, simplify_trackpoints
+from amazfit_exporter_stats import stats
+from amazfit_exporter_summary import get_activity_summary
+
+# FIT protocol 1.0 is sufficient for the exported messages
+FIT_PROTOCOL_VERSION = 0x10
+FIT_PROFILE_VERSION = 2100
+
+# FIT timestamps are seconds since 1989-12-31 00:00:00 UTC
+FIT_EPOCH = 631065600
+
+# Base types of the FIT protocol with their struct format
+ENUM = 0x00
+UINT8 = 0x02
+UINT16 = 0x84
+SINT32 = 0x85
+UINT32 = 0x86
+BASE_TYPE_FORMATS = {
+    ENUM: 'B',
+    UINT8: 'B',
+    UINT16: 'H',
+    SINT32: 'i',
+    UINT32: 'I'
+}
+
+# Positions are stored in semicircles
+SEMICIRCLES_PER_DEGREE = 2 ** 31 / 180
+
+# Invalid values mark fields without a value
+INVALID_UINT8 = 0xFF
+INVALID_UINT16 = 0xFFFF
+INVALID_SINT32 = 0x7FFFFFFF
+INVALID_UINT32 = 0xFFFFFFFF
+
+# Distances are stored in centimetres and speeds in millimetres per second
+DISTANCE_SCALE = 100
+SPEED_SCALE = 1000
+
+# Values of the FIT profile
+FILE_TYPE_ACTIVITY = 4
+MANUFACTURER_DEVELOPMENT = 255
+EVENT_TIMER = 0
+EVENT_SESSION = 8
+EVENT_LAP = 9
+EVENT_ACTIVITY = 26
+EVENT_TYPE_START = 0
+EVENT_TYPE_STOP = 1
+EVENT_TYPE_STOP_ALL = 4
+ACTIVITY_TYPE_MANUAL = 0
+LAP_TRIGGER_MANUAL = 0
+LAP_TRIGGER_DISTANCE = 2
+
+# Map the TCX sport types to FIT sports
+FIT_SPORTS = {
+    "Running": 1,
+    "Biking": 2,
+    "Other": 0
+}
+
+logger = logging.getLogger(__name__)
+
+# A message type with a fixed set of fields. Every message type of a file uses
+# its own local message number, so its definition is written only once.
+class FitMessage:
+
+    def __init__(self, local_message, global_message, fields):
+        # fields is a list of (field number, base type)
+        self.definition = struct.pack('<BBBHB', 0x40 | local_message, 0, 0, global_message, len(fields))
+        for field_number, base_type in fields:
+            self.definition += struct.pack('<BBB', field_number, struct.calcsize('<' + BASE_TYPE_FORMATS[base_type]), base_type)
+        self.header = local_message
+        self.data = struct.Struct('<B' + ''.join(BASE_TYPE_FORMATS[base_type] for _, base_type in fields))
+
+    def pack(self, *values):
+        return self.data.pack(self.header, *values)
+
+FILE_ID_MESSAGE = FitMessage(0, 0, [
+    (0, ENUM),  # type
+    (1, UINT16),  # manufacturer
+    (2, UINT16),  # product
+    (4, UINT32)])  # time_created
+
+EVENT_MESSAGE = FitMessage(1, 21, [
+    (253, UINT32),  # timestamp
+    (0, ENUM),  # event
+    (1, ENUM)])  # event_type
+
+RECORD_MESSAGE = FitMessage(2, 20, [
+    (253, UINT32),  # timestamp
+    (0, SINT32),  # position_lat
+    (1, SINT32),  # position_long
+    (2, UINT16),  # altitude
+    (3, UINT8),  # heart_rate
+    (4, UINT8),  # cadence
+    (5, UINT32)])  # distance
+
+LAP_MESSAGE = FitMessage(3, 19, [
+    (253, UINT32),  # timestamp
+    (2, UINT32),  # start_time
+    (7, UINT32),  # total_elapsed_time
+    (8, UINT32),  # total_timer_time
+    (9, UINT32),  # total_distance
+    (11, UINT16),  # total_calories
+    (14, UINT16),  # max_speed
+    (15, UINT8),  # avg_heart_rate
+    (16, UINT8),  # max_heart_rate
+    (0, ENUM),  # event
+    (1, ENUM),  # event_type
+    (24, ENUM),  # lap_trigger
+    (25, ENUM)])  # sport
+
+SESSION_MESSAGE = FitMessage(4, 18, [
+    (253, UINT32),  # timestamp
+    (2, UINT32),  # start_time
+    (7, UINT32),  # total_elapsed_time
+    (8, UINT32),  # total_timer_time
+    (9, UINT32),  # total_distance
+    (11, UINT16),  # total_calories
+    (15, UINT16),  # max_speed
+    (16, UINT8),  # avg_heart_rate
+    (17, UINT8),  # max_heart_rate
+    (25, UINT16),  # first_lap_index
+    (26, UINT16),  # num_laps
+    (0, ENUM),  # event
+    (1, ENUM),  # event_type
+    (5, ENUM)])  # sport
+
+ACTIVITY_MESSAGE = FitMessage(5, 34, [
+    (253, UINT32),  # timestamp
+    (0, UINT32),  # total_timer_time
+    (1, UINT16),  # num_sessions
+    (2, ENUM),  # type
+    (3, ENUM),  # event
+    (4, ENUM)])  # event_type
+
+# The FIT CRC is CRC-16 with the reflected polynomial 0xA001. It is computed
+# with tables instead of the nibble table of the FIT SDK.
+def create_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = create_crc_table()
+
+# The CRC of two bytes b0 and b1 is crc_word_table[crc ^ (b0 | b1 << 8)], which
+# halves the iterations. The table is created on first use.
+crc_word_table = None
+
+def create_crc_word_table():
+    table = array('H', bytes(2 * 65536))
+    for value in range(65536):
+        crc = (value >> 8) ^ CRC_TABLE[value & 0xFF]
+        table[value] = (crc >> 8) ^ CRC_TABLE[crc & 0xFF]
+    return table
+
+def fit_crc(data, crc=0):
+    global crc_word_table
+    if crc_word_table is None:
+        crc_word_table = create_crc_word_table()
+    table = crc_word_table
+    length = len(data) - len(data) % 2
+    words = array('H', data[:length])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    for word in words:
+        crc = table[crc ^ word]
+    if length < len(data):
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ data[-1]) & 0xFF]
+    return crc
+
+def local_date_to_utc(date):
+    return datetime.utcfromtimestamp(int(date / 1000))
+
+def get_fit_timestamp(date):
+    return int(date / 1000) - FIT_EPOCH
+
+def get_sport_type(activity):
+    # Try to map Amazfit types to TCX types. If there's no match use "Other"
+    return amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+
+# Join the trackpoints of the activity with their heart rate, cadence and
+# distance values
+def get_activity_trackpoints(activity, summary):
+    trackpoints = amazfit_exporter_config.trackpoints.get(activity['track_id'], [])
+    with stats.stage("fit.match"):
+        heart_rates = match_trackpoints(trackpoints)
+        cadences = match_cadences(get_sport_type(activity), heart_rates)
+    stats.count("fit.trackpoints", len(trackpoints))
+    stats.count("fit.heart_rate_matches", len(heart_rates) - heart_rates.count(None))
+    matched = list(zip(trackpoints, heart_rates, cadences, summary.distances))
+    if not is_simplified():
+        return matched
+    with stats.stage("fit.simplify"):
+        simplified = simplify_trackpoints(matched)
+    stats.count("fit.trackpoints_dropped", len(matched) - len(simplified))
+    return simplified
+
+# The same values as in the TCX and GPX export, converted to FIT units
+def get_record_values(trackpoint, heart_rate, cadence, distance):
+    timestamp = get_fit_timestamp(get_trackpoint_timestamp(trackpoint))
+    latitude = get_fit_position(trackpoint.latitude)
+    longitude = get_fit_position(trackpoint.longitude)
+
+    altitude = INVALID_UINT16
+    # only use realistic altitude values, FIT stores (altitude + 500) * 5
+    if trackpoint.altitude > -20:
+        altitude = min(max(int((trackpoint.altitude + 500) * 5 + 0.5), 0), INVALID_UINT16 - 1)
+
+    heart_rate_bpm = INVALID_UINT8
+    # include only positive bpm values
+    if heart_rate is not None and not amazfit_exporter_config.no_heart_rate and int(heart_rate[0]) > 0:
+        heart_rate_bpm = min(int(heart_rate[0]), INVALID_UINT8 - 1)
+
+    if cadence is None:
+        cadence = INVALID_UINT8
+    else:
+        cadence = min(cadence, INVALID_UINT8 - 1)
+
+    return timestamp, latitude, longitude, altitude, heart_rate_bpm, cadence, get_fit_distance(distance)
+
+# 180 degrees are 2**31 semicircles, which is out of the sint32 range, the
+# largest valid value is one below the invalid value
+def get_fit_position(degrees):
+    return min(max(round(float(degrees) * SEMICIRCLES_PER_DEGREE), -2 ** 31), INVALID_SINT32 - 1)
+
+def get_fit_distance(distance):
+    return min(int(distance * DISTANCE_SCALE + 0.5), INVALID_UINT32 - 1)
+
+def get_fit_speed(speed):
+    return min(int(speed * SPEED_SCALE + 0.5), INVALID_UINT16 - 1)
+
+# Average and maximum of the heart rates of a lap or session
+def get_heart_rate_summary(heart_rates):
+    if not heart_rates:
+        return INVALID_UINT8, INVALID_UINT8
+    return round(sum(heart_rates) / len(heart_rates)), max(heart_rates)
+
+# Encode the record messages of all trackpoints. Returns the encoded records
+# and the heart rates of every lap for the lap and session summary.
+def encode_fit_records(activity, summary):
+    pack = RECORD_MESSAGE.data.pack
+    header = RECORD_MESSAGE.header
+    records = [RECORD_MESSAGE.definition]
+    lap_heart_rates = [array('B') for _ in summary.laps]
+    for trackpoint, heart_rate, cadence, distance in get_activity_trackpoints(activity, summary):
+        values = get_record_values(trackpoint, heart_rate, cadence, distance)
+        if values[4] != INVALID_UINT8:
+            lap_heart_rates[summary.get_lap_index(distance)].append(values[4])
+        records.append(pack(header, *values))
+    return b"".join(records), lap_heart_rates
+
+# One lap message for every lap of the activity summary
+def encode_fit_laps(activity, summary, lap_heart_rates, calories, sport):
+    lap_trigger = LAP_TRIGGER_MANUAL if summary.lap_split is None else LAP_TRIGGER_DISTANCE
+    data = bytearray(LAP_MESSAGE.definition)
+    for lap, heart_rates in zip(summary.laps, lap_heart_rates):
+        # the times are counted from the start of the activity like in the TCX
+        # export, so the lap times add up to the time of the activity
+        total_time = ((lap.end_time - activity['start_time']) // 1000 - (lap.start_time - activity['start_time']) // 1000) * 1000
+        average_heart_rate, maximum_heart_rate = get_heart_rate_summary(heart_rates)
+        data += LAP_MESSAGE.pack(
+            get_fit_timestamp(lap.end_time), get_fit_timestamp(lap.start_time), total_time, total_time,
+            get_fit_distance(lap.end_distance - lap.start_distance), summary.get_lap_calories(calories, lap), get_fit_speed(lap.max_speed),
+            average_heart_rate, maximum_heart_rate, EVENT_LAP, EVENT_TYPE_STOP, lap_trigger, sport)
+    return data
+
+def encode_fit_activity(activity):
+    sport = FIT_SPORTS[get_sport_type(activity)]
+    start_time = get_fit_timestamp(activity['start_time'])
+    end_time = get_fit_timestamp(activity['end_time'])
+    # times are stored in milliseconds, the TCX export uses whole seconds
+    total_time = (activity['end_time'] - activity['start_time']) // 1000 * 1000
+    if amazfit_exporter_config.no_calories:
+        calories = 0
+    else:
+        calories = min(int(activity['calorie'] / 1000), INVALID_UINT16 - 1)
+
+    summary = get_activity_summary(activity)
+    records, lap_heart_rates = encode_fit_records(activity, summary)
+    average_heart_rate, maximum_heart_rate = get_heart_rate_summary([heart_rate for heart_rates in lap_heart_rates for heart_rate in heart_rates])
+
+    data = bytearray()
+    data += FILE_ID_MESSAGE.definition
+    data += FILE_ID_MESSAGE.pack(FILE_TYPE_ACTIVITY, MANUFACTURER_DEVELOPMENT, 0, get_fit_timestamp(activity['track_id']))
+    data += EVENT_MESSAGE.definition
+    data += EVENT_MESSAGE.pack(start_time, EVENT_TIMER, EVENT_TYPE_START)
+    data += records
+    data += EVENT_MESSAGE.pack(end_time, EVENT_TIMER, EVENT_TYPE_STOP_ALL)
+    data += encode_fit_laps(activity, summary, lap_heart_rates, calories, sport)
+    data += SESSION_MESSAGE.definition
+    data += SESSION_MESSAGE.pack(
+        end_time, start_time, total_time, total_time, get_fit_distance(summary.distance), calories, get_fit_speed(summary.max_speed),
+        average_heart_rate, maximum_heart_rate, 0, len(summary.laps), EVENT_SESSION, EVENT_TYPE_STOP, sport)
+    data += ACTIVITY_MESSAGE.definition
+    data += ACTIVITY_MESSAGE.pack(end_time, total_time, 1, ACTIVITY_TYPE_MANUAL, EVENT_ACTIVITY, EVENT_TYPE_STOP)
+    return data
+
+def fit_document(output_file, activity):
+    data = encode_fit_activity(activity)
+    header = struct.pack('<BBHI4s', 14, FIT_PROTOCOL_VERSION, FIT_PROFILE_VERSION, len(data), b".FIT")
+    header += struct.pack('<H', fit_crc(header))
+    output_file.write(header)
+    output_file.write(data)
+    output_file.write(struct.pack('<H', fit_crc(data, fit_crc(header))))
+
+def create_fit_dest(dest):
+    fit_dest = dest + "/FIT/"
+    create_output_directory(os.path.dirname(fit_dest))
+    return fit_dest
+
+def activity_to_fit(fit_dest, activity):
+    identifier = activity['track_id']
+    output_path = get_output_path(os.path.join(fit_dest, str(identifier) + ".fit"))
+    # Skip activities which are unchanged since the last export
+    manifest = amazfit_exporter_config.manifest
+    if manifest is not None:
+        with stats.stage("fit.fingerprint"):
+            fingerprint = get_activity_fingerprint('FIT', activity)
+        if manifest.is_current(output_path, fingerprint):
+            logger.info("Skip unchanged activity %d", identifier)
+            stats.count("fit.files_skipped")
+            return
+    # The binary records are encoded and written at once
+    with stats.stage("fit.render"), open_output_file(output_path) as output_file:
+        fit_document(output_file, activity)
+    stats.count("fit.files_written")
+    if manifest is not None:
+        manifest.record(output_path, fingerprint)
+
+def db_to_fit(dest):
+    logger.info("Started fit export")
+    print("FIT export:")
+    fit_dest = create_fit_dest(dest)
+    for activity in amazfit_exporter_config.activities:
+        identifier = activity['track_id']
+        print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other"))
+        activity_to_fit(fit_dest, activity)
+    logger.info("Finished fit export")
@@ -1,11 +1,18 @@
 #!/usr/bin/python3
-import collections
+import contextlib
 from time import ctime
 from datetime import datetime
 import logging
 import os
+from xml.sax.saxutils import escape, quoteattr
 from lxml import etree
 import amazfit_exporter_config
+from amazfit_exporter_heart_rate import get_trackpoint_timestamp, match_trackpoints
+from amazfit_exporter_cadence import match_cadences
+from amazfit_exporter_manifest import get_activity_fingerprint
+from amazfit_exporter_output import CompactTemplateOutput, create_output_directory, get_output_path, open_output_file
+from amazfit_exporter_simplify import is_simplified, simplify_trackpoints
+from amazfit_exporter_stats import stats
 
 GPX_NAMESPACE = "http://www.topografix.com/GPX/1/1"
 GPX_LOCATION = "https://www.topografix.com/GPX/1/1/gpx.xsd"
@@ -33,17 +40,31 @@ GPX_SCHEMA_LOCATION = GPX_NAMESPACE + " " +\
     GPXDATA_EXTENSION_NAMESPACE + " " +\
     GPXDATA_EXTENSION_LOCATION
 
-# Trackpoints are recorded every 1-3 seconds
-# The last 20 values should be sufficient to calculate cadence
-STEPS_FOR_CADENCE = collections.deque(maxlen=20)
-
-sport_type = None
-
 logger = logging.getLogger(__name__)
 
 def local_date_to_utc(date):
     return datetime.utcfromtimestamp(int(date / 1000))
 
+def get_sport_type(activity):
+    # Map Amazfit types to sport names. If there's no match use "Other"
+    return amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+
+# Join the trackpoints of the activity with their heart rate and cadence values
+def get_activity_trackpoints(activity):
+    trackpoints = amazfit_exporter_config.trackpoints.get(activity['track_id'], [])
+    with stats.stage("gpx.match"):
+        heart_rates = match_trackpoints(trackpoints)
+        cadences = match_cadences(get_sport_type(activity), heart_rates)
+    stats.count("gpx.trackpoints", len(trackpoints))
+    stats.count("gpx.heart_rate_matches", len(heart_rates) - heart_rates.count(None))
+    matched = list(zip(trackpoints, heart_rates, cadences))
+    if not is_simplified():
+        return matched
+    with stats.stage("gpx.simplify"):
+        simplified = simplify_trackpoints(matched)
+    stats.count("gpx.trackpoints_dropped", len(matched) - len(simplified))
+    return simplified
+
 def create_element(tag, text=None, namespace=None):
     namespace = GPX_NSMAP[namespace]
     tag = "{%s}%s" % (namespace, tag)
@@ -66,8 +87,7 @@ def create_gpx_document():
     return document
 
 def add_track(parent_element, activity):
-    global sport_type
-    sport_type = amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+    sport_type = get_sport_type(activity)
     # Use track_id (the starting time) as identifier
     identifier = local_date_to_utc(activity['track_id'])
 
@@ -80,72 +100,54 @@ def add_track(parent_element, activity):
 
 def add_segment(parent_element, activity):
 
-    STEPS_FOR_CADENCE.clear()
-
     track_element = create_sub_element(parent_element, "trkseg")
 
-    gen = (trackpoint for trackpoint in amazfit_exporter_config.trackpoints if trackpoint['track_id'] == activity['track_id'])
-    for trackpoint in gen:
-        add_trackpoint(track_element, trackpoint)
+    for trackpoint, heart_rate, cadence in get_activity_trackpoints(activity):
+        add_trackpoint(track_element, trackpoint, heart_rate, cadence)
+
+def get_trackpoint_values(trackpoint, heart_rate, cadence):
+    latitude = trackpoint.latitude
+    longitude = trackpoint.longitude
+    altitude = trackpoint.altitude
+
+    timestamp = local_date_to_utc(get_trackpoint_timestamp(trackpoint))
+
+    # use realistic altitude values
+    if not altitude > -20:
+        altitude = None
+
+    heart_rate_bpm = None
+    # include only positive bpm values
+    if heart_rate is not None and not amazfit_exporter_config.no_heart_rate and int(heart_rate[0]) > 0:
+        heart_rate_bpm = int(heart_rate[0])
+
+    return timestamp.isoformat() + "Z", str(latitude), str(longitude), altitude, heart_rate_bpm, cadence
+
+def add_trackpoint(parent_element, trackpoint, heart_rate, cadence):
+    timestamp, latitude, longitude, altitude, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence)
 
-def add_trackpoint(parent_element, trackpoint):
     trackpoint_element = create_sub_element(parent_element, "trkpt")
-    # reduce precision of timestamp by setting last three digits to zero to find corresponding heart rate
-    timestamp_str = str(trackpoint['timestamp'])
-    imprecise_timestamp = int(timestamp_str[0:len(timestamp_str)-3] + "000")
-     
-    latitude = trackpoint['latitude']
-    longitude = trackpoint['longitude']
-    altitude = trackpoint['altitude']
-
-    raw_timestamp = trackpoint['track_id'] + imprecise_timestamp
-    heart_rate = amazfit_exporter_config.heart_rate_data.get(raw_timestamp, None)
-    timestamp = local_date_to_utc(raw_timestamp)
-
-    trackpoint_element.set("lat", str(latitude))
-    trackpoint_element.set("lon", str(longitude))
+    trackpoint_element.set("lat", latitude)
+    trackpoint_element.set("lon", longitude)
     
-    # use realistic altitude values
-    if altitude > -20:
+    if altitude is not None:
         create_sub_element(trackpoint_element, "ele", str(altitude))
 
-    create_sub_element(trackpoint_element, "time", timestamp.isoformat() + "Z")
+    create_sub_element(trackpoint_element, "time", timestamp)
 
-    if heart_rate is not None:
-        # the creation of the extension elements is done on demand, since there
-        # are many conditions if hr and cadence elements are created. This solves
-        # the problem of empty extension elements.
-        extensions_element = None
-        trackpointextension_element = None
-        
-        heart_rate_bpm = int(heart_rate[0])
-        # include only positive bpm values
-        if not amazfit_exporter_config.no_heart_rate and heart_rate_bpm > 0:
-            if extensions_element is None:
-                extensions_element = create_sub_element(trackpoint_element, "extensions")
-                trackpointextension_element = create_sub_element(extensions_element, "TrackPointExtension", namespace="gpxtpx")
+    # the extension elements are only created if there is a heart rate or
+    # cadence value. This solves the problem of empty extension elements.
+    if heart_rate_bpm is not None or cadence is not None:
+        extensions_element = create_sub_element(trackpoint_element, "extensions")
+        trackpointextension_element = create_sub_element(extensions_element, "TrackPointExtension", namespace="gpxtpx")
+        if heart_rate_bpm is not None:
             create_sub_element(trackpointextension_element, "hr", str(heart_rate_bpm), "gpxtpx")
-            create_sub_element(extensions_element, "hr", str(heart_rate_bpm), "gpxdata")
-        
-        # cadence just for sport type 'Running'
-        if not amazfit_exporter_config.no_cadence and sport_type == "Running":   
-            if extensions_element is None:
-                extensions_element = create_sub_element(trackpoint_element, "extensions")
-                trackpointextension_element = create_sub_element(extensions_element, "TrackPointExtension", namespace="gpxtpx")
-            STEPS_FOR_CADENCE.append(heart_rate[1])
-            cadence = int(sum(STEPS_FOR_CADENCE) * (60 / len(STEPS_FOR_CADENCE)))
-            create_sub_element(trackpointextension_element, "cad", text=str(cadence), namespace="gpxtpx")
-            create_sub_element(extensions_element, "cadence", text=str(cadence), namespace="gpxdata")
-    else:
-        # sometimes values are missing. Interpolate cadence from the last recorded values.
-        if not amazfit_exporter_config.no_cadence and sport_type == "Running" and STEPS_FOR_CADENCE:
-            logger.debug("Heart rate and cadence value missing. Interpolate cadence.")
-            extensions_element = create_sub_element(trackpoint_element, "extensions")
-            trackpointextension_element = create_sub_element(extensions_element, "TrackPointExtension", namespace="gpxtpx")
-            cadence = int(sum(STEPS_FOR_CADENCE) * (60 / len(STEPS_FOR_CADENCE)))
+        if cadence is not None:
             create_sub_element(trackpointextension_element, "cad", text=str(cadence), namespace="gpxtpx")
+        if heart_rate_bpm is not None:
+            create_sub_element(extensions_element, "hr", str(heart_rate_bpm), "gpxdata")
+        if cadence is not None:
             create_sub_element(extensions_element, "cadence", text=str(cadence), namespace="gpxdata")
-            STEPS_FOR_CADENCE.popleft()        
 
 def add_creator(parent_element):
     creator_element = create_sub_element(parent_element, "Creator")
@@ -177,19 +179,223 @@ def add_author(parent_element):
     create_sub_element(author_element, "PartNumber", "000-00000-00")
 
 def document_to_string(document):
-    return etree.tostring(document.getroot(), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+    return etree.tostring(document.getroot(), xml_declaration=True, encoding="UTF-8", pretty_print=amazfit_exporter_config.pretty_print)
+
+# The stream functions write the same document as the tree functions above
+# directly to the output file. Indentation is written explicitly to match the
+# pretty printed output of the tree.
+@contextlib.contextmanager
+def stream_element(xf, depth, tag, namespace=None, attrib=None, nsmap=None):
+    pretty_print = amazfit_exporter_config.pretty_print
+    if depth > 0 and pretty_print:
+        xf.write("\n" + "  " * depth)
+    with xf.element("{%s}%s" % (GPX_NSMAP[namespace], tag), attrib or {}, nsmap=nsmap):
+        yield
+        if pretty_print:
+            xf.write("\n" + "  " * depth)
+
+def stream_sub_element(xf, depth, tag, text=None, namespace=None, attrib=None):
+    if amazfit_exporter_config.pretty_print:
+        xf.write("\n" + "  " * depth)
+    with xf.element("{%s}%s" % (GPX_NSMAP[namespace], tag), attrib or {}):
+        if text is not None:
+            xf.write(text)
+
+# xmlfile writes an element without content as start and end tag, the tree
+# writes an empty element. The tag is written without namespace, so it is in
+# the default namespace of the document without repeating the declaration.
+def stream_empty_element(xf, depth, tag):
+    if amazfit_exporter_config.pretty_print:
+        xf.write("\n" + "  " * depth)
+    xf.write(etree.Element(tag))
+
+def stream_gpx_document(output_file, activity):
+    with etree.xmlfile(output_file, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        attrib = {
+            "version": "1.1",
+            "creator": "Amazfit Exporter",
+            ("{%s}" % XML_SCHEMA_NAMESPACE) + "schemaLocation": GPX_SCHEMA_LOCATION}
+        with stream_element(xf, 0, "gpx", attrib=attrib, nsmap=GPX_NSMAP):
+            stream_track(xf, 1, activity)
+    if amazfit_exporter_config.pretty_print:
+        output_file.write(b"\n")
+
+def stream_track(xf, depth, activity):
+    sport_type = get_sport_type(activity)
+    identifier = local_date_to_utc(activity['track_id'])
+
+    with stream_element(xf, depth, "trk"):
+        stream_sub_element(xf, depth + 1, "name", sport_type + " at " + identifier.isoformat())
+        stream_segment(xf, depth + 1, activity)
+
+def stream_segment(xf, depth, activity):
+    trackpoints = get_activity_trackpoints(activity)
+    if not trackpoints:
+        stream_empty_element(xf, depth, "trkseg")
+        return
+    with stream_element(xf, depth, "trkseg"):
+        for trackpoint, heart_rate, cadence in trackpoints:
+            stream_trackpoint(xf, depth + 1, trackpoint, heart_rate, cadence)
+
+def stream_trackpoint(xf, depth, trackpoint, heart_rate, cadence):
+    timestamp, latitude, longitude, altitude, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence)
+
+    with stream_element(xf, depth, "trkpt", attrib={"lat": latitude, "lon": longitude}):
+        if altitude is not None:
+            stream_sub_element(xf, depth + 1, "ele", str(altitude))
+
+        stream_sub_element(xf, depth + 1, "time", timestamp)
+
+        if heart_rate_bpm is not None or cadence is not None:
+            with stream_element(xf, depth + 1, "extensions"):
+                with stream_element(xf, depth + 2, "TrackPointExtension", namespace="gpxtpx"):
+                    if heart_rate_bpm is not None:
+                        stream_sub_element(xf, depth + 3, "hr", str(heart_rate_bpm), "gpxtpx")
+                    if cadence is not None:
+                        stream_sub_element(xf, depth + 3, "cad", str(cadence), "gpxtpx")
+                if heart_rate_bpm is not None:
+                    stream_sub_element(xf, depth + 2, "hr", str(heart_rate_bpm), "gpxdata")
+                if cadence is not None:
+                    stream_sub_element(xf, depth + 2, "cadence", str(cadence), "gpxdata")
+
+# The template functions render the pretty printed document from precompiled
+# byte templates without creating any lxml elements. Without pretty printing
+# the indentation is removed from the rendered templates.
+TEMPLATE_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+TEMPLATE_DOCUMENT_START = (
+    "<gpx xmlns=%s xmlns:xsi=%s xmlns:gpxtpx=%s xmlns:gpxdata=%s version=\"1.1\" creator=\"Amazfit Exporter\" xsi:schemaLocation=%s>\n" % (
+        quoteattr(GPX_NAMESPACE),
+        quoteattr(XML_SCHEMA_NAMESPACE),
+        quoteattr(TRACK_POINT_EXTENSION_NAMESPACE),
+        quoteattr(GPXDATA_EXTENSION_NAMESPACE),
+        quoteattr(GPX_SCHEMA_LOCATION))).encode()
+
+TEMPLATE_TRACK_START = (
+    b"  <trk>\n"
+    b"    <name>%s</name>\n")
+
+TEMPLATE_TRACKPOINT = b"      <trkpt lat=%s lon=%s>\n"
+
+TEMPLATE_ALTITUDE = b"        <ele>%s</ele>\n"
+
+TEMPLATE_TIME = b"        <time>%s</time>\n"
+
+TEMPLATE_EXTENSIONS_START = (
+    b"        <extensions>\n"
+    b"          <gpxtpx:TrackPointExtension>\n")
+
+TEMPLATE_TRACK_POINT_EXTENSION_HEART_RATE = b"            <gpxtpx:hr>%d</gpxtpx:hr>\n"
+
+TEMPLATE_TRACK_POINT_EXTENSION_CADENCE = b"            <gpxtpx:cad>%d</gpxtpx:cad>\n"
+
+TEMPLATE_TRACK_POINT_EXTENSION_END = b"          </gpxtpx:TrackPointExtension>\n"
+
+TEMPLATE_GPXDATA_HEART_RATE = b"          <gpxdata:hr>%d</gpxdata:hr>\n"
+
+TEMPLATE_GPXDATA_CADENCE = b"          <gpxdata:cadence>%d</gpxdata:cadence>\n"
+
+TEMPLATE_EXTENSIONS_END = b"        </extensions>\n"
+
+TEMPLATE_TRACKPOINT_END = b"      </trkpt>\n"
+
+TEMPLATE_DOCUMENT_END = (
+    b"  </trk>\n"
+    b"</gpx>\n")
+
+# Number of rendered trackpoints which are written to the file at once
+TEMPLATE_CHUNK_SIZE = 1000
+
+def template_gpx_document(output_file, activity):
+    sport_type = get_sport_type(activity)
+    identifier = local_date_to_utc(activity['track_id'])
+
+    output_file.write(TEMPLATE_DECLARATION)
+    if not amazfit_exporter_config.pretty_print:
+        output_file = CompactTemplateOutput(output_file)
+    output_file.write(TEMPLATE_DOCUMENT_START)
+    output_file.write(TEMPLATE_TRACK_START % escape(sport_type + " at " + identifier.isoformat()).encode())
+
+    trackpoints = get_activity_trackpoints(activity)
+    if trackpoints:
+        output_file.write(b"    <trkseg>\n")
+        chunk = []
+        for trackpoint, heart_rate, cadence in trackpoints:
+            chunk.append(template_trackpoint(trackpoint, heart_rate, cadence))
+            if len(chunk) == TEMPLATE_CHUNK_SIZE:
+                output_file.write(b"".join(chunk))
+                chunk.clear()
+        output_file.write(b"".join(chunk))
+        output_file.write(b"    </trkseg>\n")
+    else:
+        output_file.write(b"    <trkseg/>\n")
+
+    output_file.write(TEMPLATE_DOCUMENT_END)
+
+def template_trackpoint(trackpoint, heart_rate, cadence):
+    timestamp, latitude, longitude, altitude, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence)
+
+    rendered = TEMPLATE_TRACKPOINT % (quoteattr(latitude).encode(), quoteattr(longitude).encode())
+    if altitude is not None:
+        rendered += TEMPLATE_ALTITUDE % str(altitude).encode()
+    rendered += TEMPLATE_TIME % timestamp.encode()
+    if heart_rate_bpm is not None or cadence is not None:
+        rendered += TEMPLATE_EXTENSIONS_START
+        if heart_rate_bpm is not None:
+            rendered += TEMPLATE_TRACK_POINT_EXTENSION_HEART_RATE % heart_rate_bpm
+        if cadence is not None:
+            rendered += TEMPLATE_TRACK_POINT_EXTENSION_CADENCE % cadence
+        rendered += TEMPLATE_TRACK_POINT_EXTENSION_END
+        if heart_rate_bpm is not None:
+            rendered += TEMPLATE_GPXDATA_HEART_RATE % heart_rate_bpm
+        if cadence is not None:
+            rendered += TEMPLATE_GPXDATA_CADENCE % cadence
+        rendered += TEMPLATE_EXTENSIONS_END
+    return rendered + TEMPLATE_TRACKPOINT_END
+
+def create_gpx_dest(dest):
+    gpx_dest = dest + "/GPX/"
+    create_output_directory(os.path.dirname(gpx_dest))
+    return gpx_dest
+
+def activity_to_gpx(gpx_dest, activity):
+    identifier = activity['track_id']
+    output_path = get_output_path(os.path.join(gpx_dest, str(identifier) + ".gpx"))
+    # Skip activities which are unchanged since the last export
+    manifest = amazfit_exporter_config.manifest
+    if manifest is not None:
+        with stats.stage("gpx.fingerprint"):
+            fingerprint = get_activity_fingerprint('GPX', activity)
+        if manifest.is_current(output_path, fingerprint):
+            logger.info("Skip unchanged activity %d", identifier)
+            stats.count("gpx.files_skipped")
+            return
+    if amazfit_exporter_config.xml_writer == 'tree':
+        with stats.stage("gpx.build"):
+            document = create_gpx_document()
+            add_track(document.getroot(), activity)
+        with stats.stage("gpx.serialize"):
+            data = document_to_string(document)
+        with stats.stage("gpx.write"), open_output_file(output_path) as output_file:
+            output_file.write(data)
+    else:
+        # The stream and template writers serialize and write at the same time
+        with stats.stage("gpx.render"), open_output_file(output_path) as output_file:
+            if amazfit_exporter_config.xml_writer == 'stream':
+                stream_gpx_document(output_file, activity)
+            else:
+                template_gpx_document(output_file, activity)
+    stats.count("gpx.files_written")
+    if manifest is not None:
+        manifest.record(output_path, fingerprint)
 
 def db_to_gpx(dest):
     logger.info("Started gpx export")
     print("GPX export:")
-    gpx_dest = dest + "/GPX/"
-    os.makedirs(os.path.dirname(gpx_dest), exist_ok=True)
+    gpx_dest = create_gpx_dest(dest)
     for activity in amazfit_exporter_config.activities:
-        document = create_gpx_document()
-        add_track(document.getroot(), activity)
         identifier = activity['track_id']
-        with open(os.path.join(gpx_dest, str(identifier) + ".gpx"), 'wb') as output_file:
-            print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type']))
-            output_file.write(document_to_string(document))
-            output_file.close()
+        print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other"))
+        activity_to_gpx(gpx_dest, activity)
     logger.info("Finished gpx export")
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+from array import array
+from bisect import bisect_left
+import amazfit_exporter_config
+
+# Heart rate samples stored as parallel columns sorted by time. This replaces
+# the dict with one tuple per sample and allows to match trackpoints to the
+# nearest heart rate sample instead of the exact second.
+class HeartRateData:
+
+    def __init__(self, rows=()):
+        self.times = array('q')
+        self.rates = array('d')
+        self.step_counts = array('d')
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.times)
+
+    # rows have to be (time, rate, step_count) sorted by time. Only the first
+    # sample of each timestamp is kept.
+    def extend(self, rows):
+        last_time = self.times[-1] if self.times else None
+        for time, rate, step_count in rows:
+            if time == last_time:
+                continue
+            last_time = time
+            self.times.append(time)
+            # missing values are stored as 0, which is never exported
+            self.rates.append(rate or 0)
+            self.step_counts.append(step_count or 0)
+
+    # Match sorted timestamps to the heart rate samples. Returns a (rate, step_count)
+    # tuple or None for every timestamp. A tolerance of 0 only matches samples
+    # with the exact same timestamp.
+    def match(self, timestamps, tolerance=0):
+        times = self.times
+        count = len(times)
+        matches = []
+        index = 0
+        for timestamp in timestamps:
+            # the timestamps are sorted, so the search can start at the last match
+            index = bisect_left(times, timestamp - tolerance, index)
+            best = None
+            best_distance = tolerance + 1
+            position = index
+            while position < count and times[position] <= timestamp + tolerance:
+                distance = abs(times[position] - timestamp)
+                if distance < best_distance:
+                    best = position
+                    best_distance = distance
+                position += 1
+            if best is None:
+                matches.append(None)
+            else:
+                matches.append((self.rates[best], self.step_counts[best]))
+        return matches
+
+# The heart rate samples are recorded every full second, so the trackpoint
+# timestamps are truncated to seconds before matching
+def get_trackpoint_timestamp(trackpoint):
+    return trackpoint.track_id + trackpoint.timestamp // 1000 * 1000
+
+# The timestamps are taken from the column of the amazfit_exporter_trackpoints.Trackpoints
+def match_trackpoints(trackpoints):
+    if not trackpoints:
+        return []
+    track_id = trackpoints.track_id
+    timestamps = [track_id + timestamp // 1000 * 1000 for timestamp in trackpoints.timestamps]
+    return amazfit_exporter_config.heart_rate_data.match(timestamps, amazfit_exporter_config.heart_rate_tolerance)
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+import logging
+import os
+import sqlite3
+import time
+import amazfit_exporter_config
+
+# The activity index is stored next to the manifest in the output directory
+ACTIVITY_INDEX_FILE = "activity_index.db"
+
+ACTIVITY_INDEX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS activity (
+        track_id INTEGER PRIMARY KEY,
+        start_time INTEGER,
+        end_time INTEGER,
+        type INTEGER,
+        trackpoints INTEGER,
+        heart_rate_samples INTEGER);
+    CREATE INDEX IF NOT EXISTS activity_type ON activity(type, track_id);
+    CREATE TABLE IF NOT EXISTS activity_export (
+        track_id INTEGER,
+        format TEXT,
+        exported_time INTEGER,
+        PRIMARY KEY (track_id, format));
+"""
+
+logger = logging.getLogger(__name__)
+
+def is_selective():
+    return amazfit_exporter_config.since is not None or amazfit_exporter_config.until is not None or \
+        amazfit_exporter_config.activity_types is not None or amazfit_exporter_config.activity_ids is not None
+
+# Activity types of a number or of a sport name like 'Biking', which matches
+# every type mapped to the sport
+def parse_activity_types(value):
+    if value.isdigit():
+        return {int(value)}
+    types = {activity_type for activity_type in range(1, 16) if amazfit_exporter_config.SPORT_MAPPING.get(activity_type, "Other").lower() == value.lower()}
+    if not types:
+        raise ValueError("unknown activity type: " + value)
+    return types
+
+# Activities of the sport databases exported into an output directory with
+# their number of trackpoints and heart rate samples and the time of their
+# last export per format. New activities are added from the sport database
+# before every export and counted before an export of a selection,
+# activities removed from the sport database are kept.
+# The connection is opened on first use and can be closed between exports.
+class ActivityIndex:
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.path = os.path.join(dest, ACTIVITY_INDEX_FILE)
+        self.connection = None
+
+    def get_connection(self):
+        if self.connection is None:
+            os.makedirs(self.dest, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.executescript(ACTIVITY_INDEX_SCHEMA)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Add the activities of the sport database which are not indexed yet,
+    # without their counts. This only reads the activities, so it is done by
+    # every export and the exports are always marked for indexed activities.
+    # Returns the track_ids of the activities of the sport database.
+    def add(self, database):
+        connection = self.get_connection()
+        indexed = {row[0] for row in connection.execute("SELECT track_id FROM activity")}
+        activities = database.get_index_activities()
+        new_activities = [activity for activity in activities if activity['track_id'] not in indexed]
+        if new_activities:
+            logger.info("Add %d activities to the activity index", len(new_activities))
+            with connection:
+                connection.executemany("INSERT INTO activity VALUES (?, ?, ?, ?, NULL, NULL)", (
+                    (activity['track_id'], activity['start_time'], activity['end_time'], activity['type']) for activity in new_activities))
+        return [activity['track_id'] for activity in activities]
+
+    # Add the new activities and count the trackpoints and heart rate samples
+    # of the activities which are not counted yet, in one scan each, see
+    # HEART_RATE_COUNTS_QUERY. This is only needed for a selection.
+    def update(self, database):
+        track_ids = set(self.add(database))
+        connection = self.get_connection()
+        track_ids = [row[0] for row in connection.execute("SELECT track_id FROM activity WHERE trackpoints IS NULL") if row[0] in track_ids]
+        if not track_ids:
+            return
+        logger.info("Count the trackpoints and heart rate samples of %d activities", len(track_ids))
+        trackpoint_counts = database.get_trackpoint_counts(track_ids)
+        heart_rate_counts = database.get_heart_rate_counts(track_ids)
+        with connection:
+            connection.executemany("UPDATE activity SET trackpoints = ?, heart_rate_samples = ? WHERE track_id = ?", (
+                (trackpoint_counts.get(track_id, 0), heart_rate_counts.get(track_id, 0), track_id) for track_id in track_ids))
+
+    # track_ids of the indexed activities since begin_time which match the
+    # selection of the configuration
+    def select(self, begin_time):
+        conditions = ["track_id >= ?"]
+        parameters = [begin_time]
+        if amazfit_exporter_config.since is not None:
+            conditions.append("track_id >= ?")
+            parameters.append(amazfit_exporter_config.since)
+        if amazfit_exporter_config.until is not None:
+            conditions.append("track_id <= ?")
+            parameters.append(amazfit_exporter_config.until)
+        for name, values in (("type", amazfit_exporter_config.activity_types), ("track_id", amazfit_exporter_config.activity_ids)):
+            if values is not None:
+                conditions.append(name + " IN (" + ", ".join("?" * len(values)) + ")")
+                parameters.extend(sorted(values))
+        query = "SELECT track_id FROM activity WHERE " + " AND ".join(conditions) + " ORDER BY track_id"
+        return [row[0] for row in self.get_connection().execute(query, parameters)]
+
+    def mark_exported(self, export_format, track_ids):
+        exported_time = int(time.time() * 1000)
+        with self.get_connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO activity_export VALUES (?, ?, ?)", ((track_id, export_format, exported_time) for track_id in track_ids))
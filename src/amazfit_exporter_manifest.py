@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import amazfit_exporter_config
+from amazfit_exporter_heart_rate import match_trackpoints
+from amazfit_exporter_trackpoints import Trackpoints
+
+# The highest exported track_id, exports continue after this activity
+LAST_UPDATE_FILE = "lstupd.txt"
+
+# The manifest is stored next to lstupd.txt in the output directory
+MANIFEST_FILE = "manifest.json"
+
+# Increase when the output of the exporters changes, so all files are rewritten.
+# Version 3 keys the members of bundles apart from the single files.
+MANIFEST_VERSION = 3
+
+# Configuration values which change the content of the exported files of a
+# format. The XML options only apply to TCX and GPX, the laps and calories
+# only to the formats with a summary.
+FINGERPRINT_CONFIG = {
+    'TCX': ('no_heart_rate', 'no_cadence', 'no_calories', 'heart_rate_tolerance', 'xml_writer', 'pretty_print', 'simplify_tolerance', 'decimate_interval', 'lap_split'),
+    'GPX': ('no_heart_rate', 'no_cadence', 'heart_rate_tolerance', 'xml_writer', 'pretty_print', 'simplify_tolerance', 'decimate_interval'),
+    'FIT': ('no_heart_rate', 'no_cadence', 'no_calories', 'heart_rate_tolerance', 'simplify_tolerance', 'decimate_interval', 'lap_split'),
+    'CSV': ('no_heart_rate', 'no_cadence', 'heart_rate_tolerance')
+}
+
+logger = logging.getLogger(__name__)
+
+# Temporary files are only readable by the owner, exported files get the
+# permissions of a file created by open()
+def get_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+FILE_MODE = get_file_mode()
+
+# Write a file through a temporary file in the same directory, which replaces
+# the destination only after it was written completely
+@contextlib.contextmanager
+def atomic_output_file(path):
+    directory, name = os.path.split(path)
+    descriptor, temporary_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as output_file:
+            yield output_file
+        os.chmod(temporary_path, FILE_MODE)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+def read_last_update_time(dest):
+    last_update_file_path = os.path.join(dest, LAST_UPDATE_FILE)
+    if not os.path.isfile(last_update_file_path):
+        return -1
+    with open(last_update_file_path, 'r') as last_update_file:
+        return int(last_update_file.read().strip() or -1)
+
+# The checkpoint is replaced atomically, so an interrupted export never leaves
+# an empty or partially written checkpoint
+def write_last_update_time(dest, last_update_time):
+    os.makedirs(dest, exist_ok=True)
+    with atomic_output_file(os.path.join(dest, LAST_UPDATE_FILE)) as last_update_file:
+        last_update_file.write(str(last_update_time).encode())
+
+# Fingerprint of the data of an activity: the activity, its trackpoints and
+# the matched heart rate samples. It is hashed once for all export formats of
+# the loaded trackpoints and dropped with them, like the summaries.
+def get_activity_data_fingerprint(activity):
+    if amazfit_exporter_config.data_fingerprints is None or amazfit_exporter_config.data_fingerprints[0] is not amazfit_exporter_config.trackpoints:
+        amazfit_exporter_config.data_fingerprints = (amazfit_exporter_config.trackpoints, {})
+    data_fingerprints = amazfit_exporter_config.data_fingerprints[1]
+    identifier = activity['track_id']
+    if identifier not in data_fingerprints:
+        digest = hashlib.sha256()
+        digest.update(repr(tuple(activity)).encode())
+        trackpoints = amazfit_exporter_config.trackpoints.get(identifier) or Trackpoints(identifier)
+        digest.update(repr(list(trackpoints.get_rows())).encode())
+        if amazfit_exporter_config.heart_rate_data is not None:
+            digest.update(repr(match_trackpoints(trackpoints)).encode())
+        data_fingerprints[identifier] = digest.hexdigest()
+    return data_fingerprints[identifier]
+
+# Fingerprint of everything an exported file is generated from: the data of
+# the activity and the export options of the format
+def get_activity_fingerprint(export_format, activity):
+    options = (MANIFEST_VERSION, export_format) + tuple(getattr(amazfit_exporter_config, name) for name in FINGERPRINT_CONFIG[export_format])
+    return hashlib.sha256((repr(options) + get_activity_data_fingerprint(activity)).encode()).hexdigest()
+
+# Fingerprints of the exported files, keyed by their path relative to the
+# output directory. Files are only rewritten when their fingerprint changed.
+# Members of a bundle are keyed by the bundle type and their path, e.g.
+# 'zip:TCX/1546300800137.tcx', so they never stand for a single file of the
+# same name.
+class ExportManifest:
+
+    def __init__(self, dest, force=False):
+        self.dest = dest
+        # force rewrites every file, but still records the new fingerprints
+        self.force = force
+        self.entries = {}
+        # entries recorded since the last call of pop_updates
+        self.updates = {}
+        self.path = os.path.join(dest, MANIFEST_FILE)
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as manifest_file:
+                    self.entries = json.load(manifest_file)
+            except ValueError:
+                logger.warning("Warning: Export manifest '%s' is corrupt, all activities are exported", self.path)
+
+    def get_key(self, path):
+        return os.path.relpath(path, self.dest).replace(os.sep, '/')
+
+    def get_entry_key(self, path):
+        if amazfit_exporter_config.bundle is None:
+            return self.get_key(path)
+        return amazfit_exporter_config.bundle + ":" + self.get_key(path)
+
+    # The bundles of earlier runs can not be checked like a single file, so
+    # the members of a bundle are always written
+    def is_current(self, path, fingerprint):
+        if self.force or amazfit_exporter_config.bundle is not None or not os.path.isfile(path):
+            return False
+        return self.entries.get(self.get_entry_key(path)) == fingerprint
+
+    def record(self, path, fingerprint):
+        key = self.get_entry_key(path)
+        self.entries[key] = fingerprint
+        self.updates[key] = fingerprint
+
+    def discard(self, path):
+        key = self.get_entry_key(path)
+        self.entries.pop(key, None)
+        self.updates.pop(key, None)
+
+    def pop_updates(self):
+        updates = self.updates
+        self.updates = {}
+        return updates
+
+    def merge(self, updates):
+        self.entries.update(updates)
+        self.updates.update(updates)
+
+    def save(self):
+        if not self.updates:
+            return
+        os.makedirs(self.dest, exist_ok=True)
+        with atomic_output_file(self.path) as manifest_file:
+            manifest_file.write(json.dumps(self.entries, indent=1, sort_keys=True).encode())
+        self.updates = {}
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import logging
+import os
+import time
+import amazfit_exporter_config
+from amazfit_exporter_manifest import FILE_MODE, atomic_output_file
+from amazfit_exporter_stats import stats
+
+AVAILABLE_COMPRESSIONS = {
+    'gzip': 'compress every file with gzip, e.g. 1546300800137.tcx.gz'
+}
+
+AVAILABLE_BUNDLES = {
+    'zip': 'write the files of a run into one zip archive',
+    'tar': 'write the files of a run into one tar archive'
+}
+
+# Extensions of the compressed files and of the bundles with and without compression
+COMPRESSION_EXTENSIONS = {'gzip': '.gz'}
+BUNDLE_EXTENSIONS = {('zip', None): '.zip', ('zip', 'gzip'): '.zip', ('tar', None): '.tar', ('tar', 'gzip'): '.tar.gz'}
+
+# Bundles are named by the start of the run, e.g. export_20190101_120000.zip
+BUNDLE_NAME_FORMAT = "export_%Y%m%d_%H%M%S"
+
+# Level 6 is the default of the gzip tool, level 9 of the gzip module is much
+# slower for little gain on XML
+COMPRESSION_LEVEL = 6
+
+# Number of background threads compressing and writing the files. zlib and the
+# file system calls release the GIL, so they overlap with the XML generation.
+OUTPUT_THREADS = min(4, os.cpu_count() or 1)
+
+# Files waiting for the background threads at most, bounds the memory of the
+# buffered documents
+MAX_PENDING_FILES = 2 * OUTPUT_THREADS
+
+logger = logging.getLogger(__name__)
+
+# Removes the indentation of the rendered templates, so the template writers
+# write the same document as lxml without pretty printing. Every write starts
+# at the beginning of a line.
+class CompactTemplateOutput:
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+
+    def write(self, data):
+        return self.output_file.write(b"".join(line.lstrip(b" ") for line in data.split(b"\n")))
+
+def write_compressed_file(path, data):
+    # mtime 0 keeps the compressed files reproducible
+    data = gzip.compress(data, COMPRESSION_LEVEL, mtime=0)
+    with atomic_output_file(path) as output_file:
+        output_file.write(data)
+
+# Exported files of an output directory. Without compression and bundle the
+# files are written directly. Otherwise the documents are buffered in memory
+# and compressed and written by background threads, a bundle is written by a
+# single thread in the order of the files.
+# In worker processes (worker=True) compressed files are written immediately
+# and bundle members are collected for the main process, see pop_members.
+class ExportOutput:
+
+    def __init__(self, manifest, worker=False):
+        self.manifest = manifest
+        self.dest = manifest.dest
+        self.worker = worker
+        self.executor = None
+        # (path, future) of the files which are not written yet
+        self.pending = collections.deque()
+        self.bundle = None
+        self.bundle_path = None
+        self.bundle_stack = None
+        # (name, data) of the bundle members collected by a worker process
+        self.members = []
+
+    def is_buffered(self):
+        return amazfit_exporter_config.compression is not None or amazfit_exporter_config.bundle is not None
+
+    # The path of an exported file, a compressed file gets the extension of
+    # the compression. Files in a bundle keep their names.
+    def get_path(self, path):
+        if amazfit_exporter_config.compression is None or amazfit_exporter_config.bundle is not None:
+            return path
+        return path + COMPRESSION_EXTENSIONS[amazfit_exporter_config.compression]
+
+    @contextlib.contextmanager
+    def open(self, path):
+        if not self.is_buffered():
+            with atomic_output_file(path) as output_file:
+                yield output_file
+            return
+        buffer = io.BytesIO()
+        yield buffer
+        self.submit(path, buffer.getvalue())
+
+    def submit(self, path, data):
+        if amazfit_exporter_config.bundle is not None:
+            name = self.manifest.get_key(path)
+            if self.worker:
+                self.members.append((name, data))
+                return
+            self.wait_pending(MAX_PENDING_FILES - 1)
+            self.pending.append((path, self.get_executor(1).submit(self.add_member, name, data)))
+        elif self.worker:
+            write_compressed_file(path, data)
+        else:
+            self.wait_pending(MAX_PENDING_FILES - 1)
+            self.pending.append((path, self.get_executor(OUTPUT_THREADS).submit(write_compressed_file, path, data)))
+
+    def get_executor(self, threads):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="output")
+        return self.executor
+
+    # Wait until at most count files are pending. The manifest entry of a file
+    # which could not be written is removed, so it is exported again.
+    def wait_pending(self, count=0):
+        if len(self.pending) <= count:
+            return
+        with stats.stage("output.wait"):
+            while len(self.pending) > count:
+                path, future = self.pending.popleft()
+                try:
+                    future.result()
+                except BaseException:
+                    self.manifest.discard(path)
+                    raise
+
+    # Bundle members collected by a worker process since the last call
+    def pop_members(self):
+        members = self.members
+        self.members = []
+        return members
+
+    def merge(self, members):
+        for name, data in members:
+            self.submit(os.path.join(self.dest, name), data)
+
+    def get_bundle_path(self):
+        name = time.strftime(BUNDLE_NAME_FORMAT)
+        extension = BUNDLE_EXTENSIONS[(amazfit_exporter_config.bundle, amazfit_exporter_config.compression)]
+        path = os.path.join(self.dest, name + extension)
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(self.dest, "%s_%d%s" % (name, suffix, extension))
+            suffix += 1
+        return path
+
+    # The bundle is created with the first member, so a run without exported
+    # files does not leave an empty bundle. Runs in the background thread.
+    # The archive modules are only imported for bundles, they are slow to import.
+    def open_bundle(self):
+        import tarfile
+        import zipfile
+        os.makedirs(self.dest, exist_ok=True)
+        self.bundle_path = self.get_bundle_path()
+        self.bundle_stack = contextlib.ExitStack()
+        bundle_file = self.bundle_stack.enter_context(atomic_output_file(self.bundle_path))
+        if amazfit_exporter_config.bundle == 'zip':
+            compression = zipfile.ZIP_STORED if amazfit_exporter_config.compression is None else zipfile.ZIP_DEFLATED
+            self.bundle = self.bundle_stack.enter_context(zipfile.ZipFile(bundle_file, 'w', compression, compresslevel=COMPRESSION_LEVEL))
+        else:
+            mode = 'w|' if amazfit_exporter_config.compression is None else 'w|gz'
+            self.bundle = self.bundle_stack.enter_context(tarfile.open(fileobj=bundle_file, mode=mode))
+
+    def add_member(self, name, data):
+        import tarfile
+        import zipfile
+        if self.bundle is None:
+            self.open_bundle()
+        modified = time.time()
+        if isinstance(self.bundle, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime(modified)[:6])
+            info.compress_type = self.bundle.compression
+            info.external_attr = FILE_MODE << 16
+            self.bundle.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = modified
+            info.mode = FILE_MODE
+            self.bundle.addfile(info, io.BytesIO(data))
+
+    # Wait for the pending files and finish the bundle. The output can be used
+    # again afterwards, e.g. by the next cycle of the watch mode.
+    def close(self):
+        try:
+            self.wait_pending()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.bundle_stack is not None:
+                logger.info("Finished bundle '%s'", self.bundle_path)
+                print("Bundle: " + self.bundle_path)
+                self.bundle_stack.close()
+                self.bundle = None
+                self.bundle_stack = None
+
+# Keeps the exported files in memory instead of writing them, for the library
+# API, see amazfit_exporter.Exporter
+class MemoryOutput:
+
+    def __init__(self):
+        # path -> data of the files exported since the last call of pop_files
+        self.files = {}
+
+    def get_path(self, path):
+        return path
+
+    @contextlib.contextmanager
+    def open(self, path):
+        buffer = io.BytesIO()
+        yield buffer
+        self.files[path] = buffer.getvalue()
+
+    def pop_files(self):
+        files = self.files
+        self.files = {}
+        return files
+
+# Files in a bundle or in memory do not need a directory
+def create_output_directory(path):
+    if amazfit_exporter_config.bundle is None and not isinstance(amazfit_exporter_config.output, MemoryOutput):
+        os.makedirs(path, exist_ok=True)
+
+# Open an exported file through the output of the current output directory
+def open_output_file(path):
+    output = amazfit_exporter_config.output
+    if output is None:
+        return atomic_output_file(path)
+    return output.open(path)
+
+def get_output_path(path):
+    output = amazfit_exporter_config.output
+    if output is None:
+        return path
+    return output.get_path(path)
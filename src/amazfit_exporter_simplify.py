@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+from array import array
+import logging
+import math
+import amazfit_exporter_config
+from amazfit_exporter_stats import stats
+
+# Mean earth radius in metres, the trackpoints are projected onto a plane
+# around the start of the activity
+EARTH_RADIUS = 6371000.0
+
+# Formats whose trackpoints are simplified, the analytics export keeps all
+SIMPLIFIED_FORMATS = ('TCX', 'GPX', 'FIT')
+
+logger = logging.getLogger(__name__)
+
+def is_simplified():
+    return amazfit_exporter_config.simplify_tolerance > 0 or amazfit_exporter_config.decimate_interval > 0
+
+# Keep the first trackpoint of every decimate_interval seconds and the last
+# trackpoint of the activity. Returns the indices of the kept trackpoints.
+def decimate(trackpoints, interval):
+    indices = []
+    next_timestamp = None
+    for index, (trackpoint, *_) in enumerate(trackpoints):
+        if next_timestamp is None or trackpoint.timestamp >= next_timestamp:
+            indices.append(index)
+            next_timestamp = trackpoint.timestamp + interval * 1000
+    if indices and indices[-1] != len(trackpoints) - 1:
+        indices.append(len(trackpoints) - 1)
+    return indices
+
+# Equirectangular projection of the trackpoints in metres, which is exact
+# enough for the distances between neighbouring trackpoints
+def project(trackpoints, indices):
+    origin = math.radians(float(trackpoints[indices[0]][0].latitude))
+    scale = EARTH_RADIUS * math.cos(origin)
+    xs = array('d', (math.radians(float(trackpoints[index][0].longitude)) * scale for index in indices))
+    ys = array('d', (math.radians(float(trackpoints[index][0].latitude)) * EARTH_RADIUS for index in indices))
+    return xs, ys
+
+# Ramer-Douglas-Peucker: keep the trackpoints which are more than tolerance
+# metres away from the line between the kept neighbours. The segments are
+# processed with a stack instead of recursion, so long activities do not hit
+# the recursion limit. The distances of a segment are computed in one list
+# comprehension, which is much faster than a loop over the indices.
+def douglas_peucker(xs, ys, tolerance):
+    count = len(xs)
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    segments = [(0, count - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        length = math.hypot(dx, dy)
+        if length > 0:
+            # the cross product is the distance to the line times its length
+            offset = dx * y1 - dy * x1
+            distances = [abs(dy * x - dx * y + offset) for x, y in zip(xs[first + 1:last], ys[first + 1:last])]
+            threshold = tolerance * length
+        else:
+            # a segment of a loop which ends at its start
+            distances = [math.hypot(x - x1, y - y1) for x, y in zip(xs[first + 1:last], ys[first + 1:last])]
+            threshold = tolerance
+        farthest_distance = max(distances)
+        if farthest_distance > threshold:
+            farthest = first + 1 + distances.index(farthest_distance)
+            keep[farthest] = 1
+            segments.append((first, farthest))
+            segments.append((farthest, last))
+    return [index for index in range(count) if keep[index]]
+
+# Every kept trackpoint gets the mean heart rate and cadence of itself and the
+# dropped trackpoints up to the next kept trackpoint. Further values, like the
+# distance of the TCX trackpoints, are kept unchanged.
+def aggregate(trackpoints, indices):
+    simplified = []
+    for position, index in enumerate(indices):
+        end = indices[position + 1] if position + 1 < len(indices) else len(trackpoints)
+        trackpoint, heart_rate, cadence, *values = trackpoints[index]
+        if end - index > 1:
+            rates = [rate[0] for _, rate, *_ in trackpoints[index:end] if rate is not None and rate[0] > 0]
+            if rates:
+                heart_rate = (int(sum(rates) / len(rates) + 0.5), 0 if heart_rate is None else heart_rate[1])
+            cadences = [value for _, _, value, *_ in trackpoints[index:end] if value is not None]
+            cadence = int(sum(cadences) / len(cadences) + 0.5) if cadences else None
+        simplified.append((trackpoint, heart_rate, cadence, *values))
+    return simplified
+
+# Simplify the (trackpoint, heart rate, cadence, ...) tuples of an activity
+def simplify_trackpoints(trackpoints):
+    if len(trackpoints) < 3:
+        return trackpoints
+    indices = list(range(len(trackpoints)))
+    if amazfit_exporter_config.decimate_interval > 0:
+        indices = decimate(trackpoints, amazfit_exporter_config.decimate_interval)
+    if amazfit_exporter_config.simplify_tolerance > 0 and len(indices) > 2:
+        xs, ys = project(trackpoints, indices)
+        indices = [indices[index] for index in douglas_peucker(xs, ys, amazfit_exporter_config.simplify_tolerance)]
+    logger.debug("Simplified %d trackpoints to %d", len(trackpoints), len(indices))
+    return aggregate(trackpoints, indices)
+
+# Simplification of the exported trackpoints per format, from the counters of
+# the statistics
+def print_report():
+    print("Simplification:")
+    for export_format in SIMPLIFIED_FORMATS:
+        name = export_format.lower()
+        trackpoints = stats.counters.get(name + ".trackpoints", 0)
+        if not trackpoints or export_format not in amazfit_exporter_config.export_formats:
+            continue
+        dropped = stats.counters.get(name + ".trackpoints_dropped", 0)
+        seconds = stats.stages.get(name + ".simplify", (0, 0.0))[1]
+        print("\t%s: %d of %d trackpoints kept, %.1f%% dropped, %.2f s" % (export_format, trackpoints - dropped, trackpoints, 100 * dropped / trackpoints, seconds))
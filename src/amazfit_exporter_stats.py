@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Time spent in the stages of the export and counters of the processed data.
+# Stages are timed per call, e.g. once per query or once per exported file,
+# never per trackpoint. Stages can be nested, e.g. the heart rate matching is
+# part of building a document. The threads of one exporter of the library API
+# share its statistics, so every update and read holds the lock.
+class ExportStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.RLock()
+        # stage name -> [calls, seconds]
+        self.stages = {}
+        # counter name -> value
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, 1, time.perf_counter() - started)
+
+    def add_stage(self, name, calls, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Stages and counters collected since the last call, e.g. by a worker process
+    def pop_updates(self):
+        with self.lock:
+            updates = (self.stages, self.counters)
+            self.stages = {}
+            self.counters = {}
+        return updates
+
+    def merge(self, updates):
+        stages, counters = updates
+        with self.lock:
+            for name, (calls, seconds) in stages.items():
+                self.add_stage(name, calls, seconds)
+            for name, value in counters.items():
+                self.count(name, value)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'seconds': round(time.perf_counter() - self.started, 6),
+                'stages': {name: {'calls': calls, 'seconds': round(seconds, 6)} for name, (calls, seconds) in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    def save(self, path):
+        logger.info("Write export statistics to '%s'", path)
+        with open(path, 'w') as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2)
+            stats_file.write("\n")
+
+# Statistics of the exporter of the library API running in the current thread
+# or task, see amazfit_exporter.Exporter
+current_stats = contextvars.ContextVar('current_stats', default=None)
+
+# Statistics of the current process, or of the exporter running in the current
+# thread or task
+class ContextStats:
+
+    def __init__(self):
+        self.process_stats = ExportStats()
+
+    def __getattr__(self, name):
+        return getattr(current_stats.get() or self.process_stats, name)
+
+stats = ContextStats()
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+from array import array
+import collections
+from datetime import datetime, timedelta
+import itertools
+import math
+import os
+import sqlite3
+import amazfit_exporter_config
+from amazfit_exporter_heart_rate import get_trackpoint_timestamp
+from amazfit_exporter_stats import stats
+from amazfit_exporter_trackpoints import Trackpoints
+
+# Mean earth radius in metres of the haversine formula
+EARTH_RADIUS = 6371000.0
+
+AVAILABLE_LAP_SPLITS = {
+    'km': 1000.0,
+    'mile': 1609.344
+}
+
+# Speeds are measured over at least this many seconds, so GPS noise between
+# two trackpoints does not produce unrealistic maximum speeds
+SPEED_WINDOW = 5
+
+# The summary index is stored next to the manifest in the output directory
+SUMMARY_INDEX_FILE = "summary.db"
+
+SUMMARY_INDEX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS activity_summary (
+        track_id INTEGER PRIMARY KEY,
+        type INTEGER,
+        start_time INTEGER,
+        end_time INTEGER,
+        trackpoints INTEGER,
+        distance REAL,
+        max_speed REAL,
+        lap_split TEXT);
+    CREATE TABLE IF NOT EXISTS activity_lap (
+        track_id INTEGER,
+        lap INTEGER,
+        start_time INTEGER,
+        end_time INTEGER,
+        distance REAL,
+        max_speed REAL,
+        PRIMARY KEY (track_id, lap));
+"""
+
+SUMMARIES_QUERY = "SELECT track_id, type, start_time, end_time, trackpoints, distance, max_speed, lap_split, (SELECT COUNT(*) FROM activity_lap WHERE activity_lap.track_id = activity_summary.track_id) AS laps FROM activity_summary ORDER BY track_id"
+
+# Times are in milliseconds like in the sport database, distances in metres
+# from the start of the activity
+Lap = collections.namedtuple('Lap', ['start_time', 'end_time', 'start_distance', 'end_distance', 'max_speed'])
+
+# Summary indexes of the output directories of this process
+summary_indexes = {}
+
+# Summaries recorded since the last save, by output directory and track_id.
+# They are written in one transaction per output directory, worker processes
+# return them to the main process instead, see pop_summary_updates.
+summary_updates = {}
+
+# Cumulative haversine distance of every trackpoint. The formula is evaluated
+# with list comprehensions over the coordinate columns of the
+# amazfit_exporter_trackpoints.Trackpoints instead of a loop over the trackpoints.
+def get_distances(trackpoints):
+    if not trackpoints:
+        return array('d')
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    latitudes = [radians(latitude) for latitude in trackpoints.latitudes]
+    longitudes = [radians(longitude) for longitude in trackpoints.longitudes]
+    cosines = [cos(latitude) for latitude in latitudes]
+    steps = [
+        2 * EARTH_RADIUS * asin(min(1.0, sqrt(sin((latitude2 - latitude1) / 2) ** 2 + cosine1 * cosine2 * sin((longitude2 - longitude1) / 2) ** 2)))
+        for latitude1, latitude2, longitude1, longitude2, cosine1, cosine2
+        in zip(latitudes, latitudes[1:], longitudes, longitudes[1:], cosines, cosines[1:])]
+    return array('d', itertools.accumulate(steps, initial=0.0))
+
+# Speed in m/s at every trackpoint since the latest trackpoint at least
+# SPEED_WINDOW seconds before, 0 for the trackpoints of the first seconds
+def get_speeds(trackpoints, distances):
+    times = trackpoints.timestamps
+    window = SPEED_WINDOW * 1000
+    speeds = array('d', bytes(8 * len(times)))
+    first = 0
+    for index, time in enumerate(times):
+        while first + 1 < index and time - times[first + 1] >= window:
+            first += 1
+        if time - times[first] >= window:
+            speeds[index] = (distances[index] - distances[first]) * 1000 / (time - times[first])
+    return speeds
+
+# Without lap_split the activity has one lap. Otherwise a new lap starts at
+# the first trackpoint of every lap_split metres.
+def get_laps(activity, trackpoints, distances, speeds, lap_split):
+    total_distance = distances[-1] if distances else 0.0
+    if lap_split is None or not trackpoints:
+        return [Lap(activity['start_time'], activity['end_time'], 0.0, total_distance, max(speeds, default=0.0))], [None]
+    keys = [int(distance // lap_split) for distance in distances]
+    starts = [0] + [index for index in range(1, len(keys)) if keys[index] != keys[index - 1]]
+    # trackpoints can be recorded after the end of the activity, the laps
+    # always end within the activity
+    times = [min(max(get_trackpoint_timestamp(trackpoints[start]), activity['start_time']), activity['end_time']) for start in starts]
+    laps = []
+    for position, start in enumerate(starts):
+        last = position + 1 == len(starts)
+        end = len(trackpoints) if last else starts[position + 1]
+        start_time = activity['start_time'] if position == 0 else times[position]
+        end_time = activity['end_time'] if last else times[position + 1]
+        start_distance = 0.0 if position == 0 else distances[start]
+        end_distance = total_distance if last else distances[end]
+        laps.append(Lap(start_time, end_time, start_distance, end_distance, max(speeds[start:end])))
+    return laps, [keys[start] for start in starts]
+
+# Distance, maximum speed and laps of an activity
+class ActivitySummary:
+
+    def __init__(self, activity, trackpoints, lap_split=None):
+        self.activity = activity
+        self.trackpoints = len(trackpoints)
+        self.distances = get_distances(trackpoints)
+        self.distance = self.distances[-1] if self.distances else 0.0
+        speeds = get_speeds(trackpoints, self.distances)
+        self.max_speed = max(speeds, default=0.0)
+        self.lap_split = lap_split
+        self.laps, keys = get_laps(activity, trackpoints, self.distances, speeds, lap_split)
+        self.lap_indexes = {key: index for index, key in enumerate(keys)}
+
+    # Index of the lap of a trackpoint at distance metres
+    def get_lap_index(self, distance):
+        if self.lap_split is None:
+            return 0
+        return self.lap_indexes[int(distance // self.lap_split)]
+
+    # The calories of the activity are shared by the laps by their distance
+    def get_lap_calories(self, calories, lap):
+        if len(self.laps) == 1 or self.distance <= 0:
+            return int(calories)
+        return int(calories * lap.end_distance / self.distance) - int(calories * lap.start_distance / self.distance)
+
+# The summary is computed once for all export formats of the loaded
+# trackpoints and recorded in the summary index of the output directory. The
+# summaries are dropped with the trackpoints they were computed from.
+def get_activity_summary(activity):
+    if amazfit_exporter_config.summaries is None or amazfit_exporter_config.summaries[0] is not amazfit_exporter_config.trackpoints:
+        amazfit_exporter_config.summaries = (amazfit_exporter_config.trackpoints, {})
+    summaries = amazfit_exporter_config.summaries[1]
+    identifier = activity['track_id']
+    if identifier not in summaries:
+        trackpoints = amazfit_exporter_config.trackpoints.get(identifier) or Trackpoints(identifier)
+        lap_split = amazfit_exporter_config.lap_split
+        with stats.stage("summary.compute"):
+            summaries[identifier] = ActivitySummary(activity, trackpoints, None if lap_split is None else AVAILABLE_LAP_SPLITS[lap_split])
+        if amazfit_exporter_config.manifest is not None:
+            record_summary(amazfit_exporter_config.manifest.dest, summaries[identifier])
+    return summaries[identifier]
+
+# The rows of a summary for the summary index of dest
+def record_summary(dest, summary):
+    activity = summary.activity
+    identifier = activity['track_id']
+    summary_updates.setdefault(dest, {})[identifier] = (
+        (identifier, activity['type'], activity['start_time'], activity['end_time'], summary.trackpoints, summary.distance, summary.max_speed, amazfit_exporter_config.lap_split),
+        [(identifier, index, lap.start_time, lap.end_time, lap.end_distance - lap.start_distance, lap.max_speed) for index, lap in enumerate(summary.laps)])
+
+def pop_summary_updates():
+    updates = dict(summary_updates)
+    summary_updates.clear()
+    return updates
+
+def merge_summary_updates(updates):
+    for dest, summaries in updates.items():
+        summary_updates.setdefault(dest, {}).update(summaries)
+
+# Summaries of the exported activities by track_id, so reports do not have
+# to read the exported files or compute the distances again. The summaries of
+# a run are written by the main process at its end, see save_summary_indexes.
+class SummaryIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SUMMARY_INDEX_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # summaries are the rows of record_summary by track_id
+    def record(self, summaries):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO activity_summary VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (summary for summary, _ in summaries.values()))
+            self.connection.executemany("DELETE FROM activity_lap WHERE track_id = ?", ((identifier,) for identifier in summaries))
+            self.connection.executemany("INSERT INTO activity_lap VALUES (?, ?, ?, ?, ?, ?)", (lap for _, laps in summaries.values() for lap in laps))
+
+    def get_summaries(self):
+        return self.connection.execute(SUMMARIES_QUERY).fetchall()
+
+def get_summary_index(dest):
+    if dest not in summary_indexes:
+        os.makedirs(dest, exist_ok=True)
+        summary_indexes[dest] = SummaryIndex(os.path.join(dest, SUMMARY_INDEX_FILE))
+    return summary_indexes[dest]
+
+# Write the summaries recorded since the last save, one transaction per
+# output directory
+def save_summary_indexes():
+    with stats.stage("summary.index"):
+        for dest, summaries in pop_summary_updates().items():
+            get_summary_index(dest).record(summaries)
+
+def close_summary_indexes():
+    try:
+        save_summary_indexes()
+    finally:
+        for summary_index in summary_indexes.values():
+            summary_index.close()
+        summary_indexes.clear()
+
+def local_date_to_utc(date):
+    return datetime.utcfromtimestamp(int(date / 1000))
+
+# Print the summaries of the activities exported into dest
+def print_summaries(dest):
+    path = os.path.join(dest, SUMMARY_INDEX_FILE)
+    print("Summaries of '" + dest + "':")
+    if not os.path.isfile(path):
+        print("\tNo exported activities")
+        return
+    summary_index = SummaryIndex(path)
+    try:
+        for summary in summary_index.get_summaries():
+            print("\tDate: %s, id: %d, type: %s:%s, distance: %.2f km, time: %s, max speed: %.1f km/h, laps: %d" % (
+                local_date_to_utc(summary['track_id']).isoformat(),
+                summary['track_id'],
+                summary['type'],
+                amazfit_exporter_config.SPORT_MAPPING.get(summary['type'], "Other"),
+                summary['distance'] / 1000,
+                timedelta(seconds=(summary['end_time'] - summary['start_time']) // 1000),
+                summary['max_speed'] * 3.6,
+                summary['laps']))
+    finally:
+        summary_index.close()
@@ -1,11 +1,19 @@
 #!/usr/bin/python3
-import collections
+import contextlib
 from time import ctime
 from datetime import datetime
 import logging
 import os
+from xml.sax.saxutils import escape, quoteattr
 from lxml import etree
 import amazfit_exporter_config
+from amazfit_exporter_heart_rate import get_trackpoint_timestamp, match_trackpoints
+from amazfit_exporter_cadence import match_cadences
+from amazfit_exporter_manifest import get_activity_fingerprint
+from amazfit_exporter_output import CompactTemplateOutput, create_output_directory, get_output_path, open_output_file
+from amazfit_exporter_simplify import is_simplified, simplify_trackpoints
+from amazfit_exporter_stats import stats
+from amazfit_exporter_summary import get_activity_summary
 
 TRAINING_CENTER_DATABASE_NAMESPACE = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
 TRAINING_CENTER_DATABASE_LOCATION = "https://www8.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd"
@@ -26,17 +34,40 @@ TDC_SCHEMA_LOCATION = TRAINING_CENTER_DATABASE_NAMESPACE + " " + \
     ACTIVITY_EXTENSION_V2_NAMESPACE + " " + \
     ACTIVITY_EXTENSION_V2_LOCATION
 
-# Trackpoints are recorded every 1-3 seconds
-# The last 20 values should be sufficient to calculate cadence
-STEPS_FOR_CADENCE = collections.deque(maxlen=20)
-
-sport_type = None
-
 logger = logging.getLogger(__name__)
 
 def local_date_to_utc(date):
     return datetime.utcfromtimestamp(int(date / 1000))
 
+def get_sport_type(activity):
+    # Try to map Amazfit types to TCX types. If there's no match use "Other"
+    return amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+
+# Join the trackpoints of the activity with their heart rate, cadence and
+# distance values
+def get_activity_trackpoints(activity, summary):
+    trackpoints = amazfit_exporter_config.trackpoints.get(activity['track_id'], [])
+    with stats.stage("tcx.match"):
+        heart_rates = match_trackpoints(trackpoints)
+        cadences = match_cadences(get_sport_type(activity), heart_rates)
+    stats.count("tcx.trackpoints", len(trackpoints))
+    stats.count("tcx.heart_rate_matches", len(heart_rates) - heart_rates.count(None))
+    matched = list(zip(trackpoints, heart_rates, cadences, summary.distances))
+    if not is_simplified():
+        return matched
+    with stats.stage("tcx.simplify"):
+        simplified = simplify_trackpoints(matched)
+    stats.count("tcx.trackpoints_dropped", len(matched) - len(simplified))
+    return simplified
+
+# The laps of the activity summary with the trackpoints of every lap
+def get_activity_laps(activity):
+    summary = get_activity_summary(activity)
+    lap_trackpoints = [[] for _ in summary.laps]
+    for values in get_activity_trackpoints(activity, summary):
+        lap_trackpoints[summary.get_lap_index(values[3])].append(values)
+    return summary, list(zip(summary.laps, lap_trackpoints))
+
 def create_element(tag, text=None, namespace=None):
     namespace = TDC_NSMAP[namespace]
     tag = "{%s}%s" % (namespace, tag)
@@ -57,9 +88,7 @@ def create_tcd_document():
     return document
 
 def add_activity(parent_element, activity):
-    global sport_type
-    # Try to map Amazfit types to TCX types. If there's no match use "Other"
-    sport_type = amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other")
+    sport_type = get_sport_type(activity)
     # Use track_id (the starting time) as identifier
     identifier = local_date_to_utc(activity['track_id'])
 
@@ -68,89 +97,85 @@ def add_activity(parent_element, activity):
     activity_element.set("Sport", sport_type)
     create_sub_element(activity_element, "Id", identifier.isoformat() + "Z")
 
-    # Currently every activity has only one lap
-    add_lap(activity_element, activity)
+    summary, laps = get_activity_laps(activity)
+    for lap, trackpoints in laps:
+        add_lap(activity_element, activity, summary, lap, trackpoints)
 
     add_creator(activity_element)
 
-def add_lap(parent_element, activity):
+def get_lap_values(activity, summary, lap):
+    # the times are counted from the start of the activity, so the lap times
+    # add up to the time of the activity
     start_time = activity['start_time']
-    end_time = activity['end_time']
-    total_time = (end_time - start_time) // 1000
-    total_distance = 0
+    total_time = (lap.end_time - start_time) // 1000 - (lap.start_time - start_time) // 1000
+    total_distance = lap.end_distance - lap.start_distance
     if amazfit_exporter_config.no_calories:
         calories = 0
     else:
         calories = activity['calorie'] / 1000
     intensity = "Active"
-    trigger_method = "Manual"
-    
-    STEPS_FOR_CADENCE.clear()
-
+    trigger_method = "Manual" if summary.lap_split is None else "Distance"
+    return [
+        ("TotalTimeSeconds", str(total_time)),
+        ("DistanceMeters", "%.1f" % total_distance),
+        ("MaximumSpeed", "%.2f" % lap.max_speed),
+        ("Calories", str(summary.get_lap_calories(calories, lap))),
+        ("Intensity", intensity),
+        ("TriggerMethod", trigger_method)]
+
+def add_lap(parent_element, activity, summary, lap, trackpoints):
     lap_element = create_sub_element(parent_element, "Lap")
-    lap_element.set("StartTime", local_date_to_utc(start_time).isoformat() + "Z")
+    lap_element.set("StartTime", local_date_to_utc(lap.start_time).isoformat() + "Z")
 
-    create_sub_element(lap_element, "TotalTimeSeconds", str(total_time))
-    create_sub_element(lap_element, "DistanceMeters", str(total_distance))
-    create_sub_element(lap_element, "Calories", str(int(calories)))
-    create_sub_element(lap_element, "Intensity", intensity)
-    create_sub_element(lap_element, "TriggerMethod", trigger_method)
+    for tag, text in get_lap_values(activity, summary, lap):
+        create_sub_element(lap_element, tag, text)
 
     track_element = create_sub_element(lap_element, "Track")
 
-    gen = (trackpoint for trackpoint in amazfit_exporter_config.trackpoints if trackpoint['track_id'] == activity['track_id'])
-    for trackpoint in gen:
-        add_trackpoint(track_element, trackpoint)
+    for trackpoint, heart_rate, cadence, distance in trackpoints:
+        add_trackpoint(track_element, trackpoint, heart_rate, cadence, distance)
 
-def add_trackpoint(parent_element, trackpoint):
-    trackpoint_element = create_sub_element(parent_element, "Trackpoint")
-    # reduce precision of timestamp by setting last three digits to zero to find corresponding heart rate
-    timestamp_str = str(trackpoint['timestamp'])
-    imprecise_timestamp = int(timestamp_str[0:len(timestamp_str)-3] + "000")
-     
-    latitude = trackpoint['latitude']
-    longitude = trackpoint['longitude']
-    altitude = trackpoint['altitude']
+def get_trackpoint_values(trackpoint, heart_rate, cadence, distance):
+    latitude = trackpoint.latitude
+    longitude = trackpoint.longitude
+    altitude = trackpoint.altitude
+
+    timestamp = local_date_to_utc(get_trackpoint_timestamp(trackpoint))
+
+    # only use realistic altitude values
+    if not altitude > -20:
+        altitude = None
+
+    heart_rate_bpm = None
+    # include only positive bpm values
+    if heart_rate is not None and not amazfit_exporter_config.no_heart_rate and int(heart_rate[0]) > 0:
+        heart_rate_bpm = int(heart_rate[0])
 
-    raw_timestamp = trackpoint['track_id'] + imprecise_timestamp
-    heart_rate = amazfit_exporter_config.heart_rate_data.get(raw_timestamp, None)
-    timestamp = local_date_to_utc(raw_timestamp)
+    return timestamp.isoformat() + "Z", str(latitude), str(longitude), altitude, "%.1f" % distance, heart_rate_bpm, cadence
 
-    create_sub_element(trackpoint_element, "Time", timestamp.isoformat() + "Z")
+def add_trackpoint(parent_element, trackpoint, heart_rate, cadence, distance):
+    timestamp, latitude, longitude, altitude, distance, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence, distance)
+
+    trackpoint_element = create_sub_element(parent_element, "Trackpoint")
+    create_sub_element(trackpoint_element, "Time", timestamp)
 
     position_element = create_sub_element(trackpoint_element, "Position")
-    create_sub_element(position_element, "LatitudeDegrees", str(latitude))
-    create_sub_element(position_element, "LongitudeDegrees", str(longitude))
+    create_sub_element(position_element, "LatitudeDegrees", latitude)
+    create_sub_element(position_element, "LongitudeDegrees", longitude)
 
-    # only use realistic altitude values
-    if altitude > -20:
+    if altitude is not None:
         create_sub_element(trackpoint_element, "AltitudeMeters", str(altitude))
 
-    if heart_rate is not None:
-        heart_rate_bpm = int(heart_rate[0])
-        # include only positive bpm values
-        if not amazfit_exporter_config.no_heart_rate and heart_rate_bpm > 0:
-            heart_rate_element = create_sub_element(trackpoint_element, "HeartRateBpm")
-            create_sub_element(heart_rate_element, "Value", str(heart_rate_bpm))
-
-        # cadence just for sport type 'Running'
-        if not amazfit_exporter_config.no_cadence and sport_type == "Running":            
-            extensions_element = create_sub_element(trackpoint_element, "Extensions")
-            trackpointextension_element = create_sub_element(extensions_element, "TPX", namespace="ae")
-            STEPS_FOR_CADENCE.append(heart_rate[1])
-            cadence = int(sum(STEPS_FOR_CADENCE) * (60 / len(STEPS_FOR_CADENCE)))
-            create_sub_element(trackpointextension_element, "RunCadence", text=str(cadence), namespace="ae")
-    else:
-        # sometimes values are missing. Interpolate cadence from the last recorded values.
-        if not amazfit_exporter_config.no_cadence and sport_type == "Running" and STEPS_FOR_CADENCE:
-            logger.debug("Heart rate and cadence value missing. Interpolate cadence.")
-            extensions_element = create_sub_element(trackpoint_element, "Extensions")
-            trackpointextension_element = create_sub_element(extensions_element, "TPX", namespace="ae")
-            cadence = int(sum(STEPS_FOR_CADENCE) * (60 / len(STEPS_FOR_CADENCE)))
-            create_sub_element(trackpointextension_element, "RunCadence", text=str(cadence), namespace="ae")
-            STEPS_FOR_CADENCE.popleft()
-        
+    create_sub_element(trackpoint_element, "DistanceMeters", distance)
+
+    if heart_rate_bpm is not None:
+        heart_rate_element = create_sub_element(trackpoint_element, "HeartRateBpm")
+        create_sub_element(heart_rate_element, "Value", str(heart_rate_bpm))
 
+    if cadence is not None:
+        extensions_element = create_sub_element(trackpoint_element, "Extensions")
+        trackpointextension_element = create_sub_element(extensions_element, "TPX", namespace="ae")
+        create_sub_element(trackpointextension_element, "RunCadence", text=str(cadence), namespace="ae")
 
 def add_creator(parent_element):
     creator_element = create_sub_element(parent_element, "Creator")
@@ -182,22 +207,288 @@ def add_author(parent_element):
     create_sub_element(author_element, "PartNumber", "000-00000-00")
 
 def document_to_string(document):
-    return etree.tostring(document.getroot(), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+    return etree.tostring(document.getroot(), xml_declaration=True, encoding="UTF-8", pretty_print=amazfit_exporter_config.pretty_print)
+
+# The stream functions write the same document as the tree functions above
+# directly to the output file. Indentation is written explicitly to match the
+# pretty printed output of the tree.
+@contextlib.contextmanager
+def stream_element(xf, depth, tag, namespace=None, attrib=None, nsmap=None):
+    pretty_print = amazfit_exporter_config.pretty_print
+    if depth > 0 and pretty_print:
+        xf.write("\n" + "  " * depth)
+    with xf.element("{%s}%s" % (TDC_NSMAP[namespace], tag), attrib or {}, nsmap=nsmap):
+        yield
+        if pretty_print:
+            xf.write("\n" + "  " * depth)
+
+def stream_sub_element(xf, depth, tag, text=None, namespace=None, attrib=None):
+    if amazfit_exporter_config.pretty_print:
+        xf.write("\n" + "  " * depth)
+    with xf.element("{%s}%s" % (TDC_NSMAP[namespace], tag), attrib or {}):
+        if text is not None:
+            xf.write(text)
+
+# xmlfile writes an element without content as start and end tag, the tree
+# writes an empty element. The tag is written without namespace, so it is in
+# the default namespace of the document without repeating the declaration.
+def stream_empty_element(xf, depth, tag):
+    if amazfit_exporter_config.pretty_print:
+        xf.write("\n" + "  " * depth)
+    xf.write(etree.Element(tag))
+
+def stream_tcd_document(output_file, activity):
+    with etree.xmlfile(output_file, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        attrib = {("{%s}" % XML_SCHEMA_NAMESPACE) + "schemaLocation": TDC_SCHEMA_LOCATION}
+        with stream_element(xf, 0, "TrainingCenterDatabase", attrib=attrib, nsmap=TDC_NSMAP):
+            with stream_element(xf, 1, "Activities"):
+                stream_activity(xf, 2, activity)
+            stream_author(xf, 1)
+    if amazfit_exporter_config.pretty_print:
+        output_file.write(b"\n")
+
+def stream_activity(xf, depth, activity):
+    sport_type = get_sport_type(activity)
+    identifier = local_date_to_utc(activity['track_id'])
+
+    with stream_element(xf, depth, "Activity", attrib={"Sport": sport_type}):
+        stream_sub_element(xf, depth + 1, "Id", identifier.isoformat() + "Z")
+        summary, laps = get_activity_laps(activity)
+        for lap, trackpoints in laps:
+            stream_lap(xf, depth + 1, activity, summary, lap, trackpoints)
+        stream_creator(xf, depth + 1)
+
+def stream_lap(xf, depth, activity, summary, lap, trackpoints):
+    start_time = local_date_to_utc(lap.start_time).isoformat() + "Z"
+    with stream_element(xf, depth, "Lap", attrib={"StartTime": start_time}):
+        for tag, text in get_lap_values(activity, summary, lap):
+            stream_sub_element(xf, depth + 1, tag, text)
+
+        if not trackpoints:
+            stream_empty_element(xf, depth + 1, "Track")
+            return
+        with stream_element(xf, depth + 1, "Track"):
+            for trackpoint, heart_rate, cadence, distance in trackpoints:
+                stream_trackpoint(xf, depth + 2, trackpoint, heart_rate, cadence, distance)
+
+def stream_trackpoint(xf, depth, trackpoint, heart_rate, cadence, distance):
+    timestamp, latitude, longitude, altitude, distance, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence, distance)
+
+    with stream_element(xf, depth, "Trackpoint"):
+        stream_sub_element(xf, depth + 1, "Time", timestamp)
+
+        with stream_element(xf, depth + 1, "Position"):
+            stream_sub_element(xf, depth + 2, "LatitudeDegrees", latitude)
+            stream_sub_element(xf, depth + 2, "LongitudeDegrees", longitude)
+
+        if altitude is not None:
+            stream_sub_element(xf, depth + 1, "AltitudeMeters", str(altitude))
+
+        stream_sub_element(xf, depth + 1, "DistanceMeters", distance)
+
+        if heart_rate_bpm is not None:
+            with stream_element(xf, depth + 1, "HeartRateBpm"):
+                stream_sub_element(xf, depth + 2, "Value", str(heart_rate_bpm))
+
+        if cadence is not None:
+            with stream_element(xf, depth + 1, "Extensions"):
+                with stream_element(xf, depth + 2, "TPX", namespace="ae"):
+                    stream_sub_element(xf, depth + 3, "RunCadence", str(cadence), namespace="ae")
+
+def stream_creator(xf, depth):
+    attrib = {("{%s}" % XML_SCHEMA_NAMESPACE) + "type": "Device_t"}
+    with stream_element(xf, depth, "Creator", attrib=attrib):
+        stream_sub_element(xf, depth + 1, "Name", "Huami Amazfit Pace")
+        stream_sub_element(xf, depth + 1, "UnitId", "0")
+        stream_sub_element(xf, depth + 1, "ProductID", "0")
+        with stream_element(xf, depth + 1, "Version"):
+            stream_sub_element(xf, depth + 2, "VersionMajor", "0")
+            stream_sub_element(xf, depth + 2, "VersionMinor", "0")
+
+def stream_author(xf, depth):
+    attrib = {("{%s}" % XML_SCHEMA_NAMESPACE) + "type": "Application_t"}
+    with stream_element(xf, depth, "Author", attrib=attrib):
+        stream_sub_element(xf, depth + 1, "Name", "Amazfit Exporter")
+        with stream_element(xf, depth + 1, "Build"):
+            with stream_element(xf, depth + 2, "Version"):
+                stream_sub_element(xf, depth + 3, "VersionMajor", "0")
+                stream_sub_element(xf, depth + 3, "VersionMinor", "0")
+        stream_sub_element(xf, depth + 1, "LangID", "en")
+        stream_sub_element(xf, depth + 1, "PartNumber", "000-00000-00")
+
+# The template functions render the pretty printed document from precompiled
+# byte templates without creating any lxml elements. Without pretty printing
+# the indentation is removed from the rendered templates.
+TEMPLATE_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+TEMPLATE_DOCUMENT_START = (
+    "<TrainingCenterDatabase xmlns=%s xmlns:ae=%s xmlns:xsi=%s xsi:schemaLocation=%s>\n"
+    "  <Activities>\n" % (
+        quoteattr(TRAINING_CENTER_DATABASE_NAMESPACE),
+        quoteattr(ACTIVITY_EXTENSION_V2_NAMESPACE),
+        quoteattr(XML_SCHEMA_NAMESPACE),
+        quoteattr(TDC_SCHEMA_LOCATION))).encode()
+
+TEMPLATE_ACTIVITY_START = (
+    b"    <Activity Sport=%s>\n"
+    b"      <Id>%s</Id>\n")
+
+TEMPLATE_LAP_START = b"      <Lap StartTime=%s>\n"
+
+TEMPLATE_LAP_VALUE = b"        <%s>%s</%s>\n"
+
+TEMPLATE_TRACKPOINT = (
+    b"          <Trackpoint>\n"
+    b"            <Time>%s</Time>\n"
+    b"            <Position>\n"
+    b"              <LatitudeDegrees>%s</LatitudeDegrees>\n"
+    b"              <LongitudeDegrees>%s</LongitudeDegrees>\n"
+    b"            </Position>\n")
+
+TEMPLATE_ALTITUDE = b"            <AltitudeMeters>%s</AltitudeMeters>\n"
+
+TEMPLATE_DISTANCE = b"            <DistanceMeters>%s</DistanceMeters>\n"
+
+TEMPLATE_HEART_RATE = (
+    b"            <HeartRateBpm>\n"
+    b"              <Value>%d</Value>\n"
+    b"            </HeartRateBpm>\n")
+
+TEMPLATE_CADENCE = (
+    b"            <Extensions>\n"
+    b"              <ae:TPX>\n"
+    b"                <ae:RunCadence>%d</ae:RunCadence>\n"
+    b"              </ae:TPX>\n"
+    b"            </Extensions>\n")
+
+TEMPLATE_TRACKPOINT_END = b"          </Trackpoint>\n"
+
+TEMPLATE_LAP_END = b"      </Lap>\n"
+
+TEMPLATE_ACTIVITY_END = (
+    b"      <Creator xsi:type=\"Device_t\">\n"
+    b"        <Name>Huami Amazfit Pace</Name>\n"
+    b"        <UnitId>0</UnitId>\n"
+    b"        <ProductID>0</ProductID>\n"
+    b"        <Version>\n"
+    b"          <VersionMajor>0</VersionMajor>\n"
+    b"          <VersionMinor>0</VersionMinor>\n"
+    b"        </Version>\n"
+    b"      </Creator>\n"
+    b"    </Activity>\n")
+
+TEMPLATE_DOCUMENT_END = (
+    b"  </Activities>\n"
+    b"  <Author xsi:type=\"Application_t\">\n"
+    b"    <Name>Amazfit Exporter</Name>\n"
+    b"    <Build>\n"
+    b"      <Version>\n"
+    b"        <VersionMajor>0</VersionMajor>\n"
+    b"        <VersionMinor>0</VersionMinor>\n"
+    b"      </Version>\n"
+    b"    </Build>\n"
+    b"    <LangID>en</LangID>\n"
+    b"    <PartNumber>000-00000-00</PartNumber>\n"
+    b"  </Author>\n"
+    b"</TrainingCenterDatabase>\n")
+
+# Number of rendered trackpoints which are written to the file at once
+TEMPLATE_CHUNK_SIZE = 1000
+
+def template_tcd_document(output_file, activity):
+    sport_type = get_sport_type(activity)
+    identifier = local_date_to_utc(activity['track_id']).isoformat() + "Z"
+
+    output_file.write(TEMPLATE_DECLARATION)
+    if not amazfit_exporter_config.pretty_print:
+        output_file = CompactTemplateOutput(output_file)
+    output_file.write(TEMPLATE_DOCUMENT_START)
+    output_file.write(TEMPLATE_ACTIVITY_START % (quoteattr(sport_type).encode(), identifier.encode()))
+    summary, laps = get_activity_laps(activity)
+    for lap, trackpoints in laps:
+        template_lap(output_file, activity, summary, lap, trackpoints)
+    output_file.write(TEMPLATE_ACTIVITY_END)
+    output_file.write(TEMPLATE_DOCUMENT_END)
+
+def template_lap(output_file, activity, summary, lap, trackpoints):
+    start_time = local_date_to_utc(lap.start_time).isoformat() + "Z"
+    output_file.write(TEMPLATE_LAP_START % quoteattr(start_time).encode())
+    for tag, text in get_lap_values(activity, summary, lap):
+        output_file.write(TEMPLATE_LAP_VALUE % (tag.encode(), escape(text).encode(), tag.encode()))
+
+    if trackpoints:
+        output_file.write(b"        <Track>\n")
+        chunk = []
+        for trackpoint, heart_rate, cadence, distance in trackpoints:
+            chunk.append(template_trackpoint(trackpoint, heart_rate, cadence, distance))
+            if len(chunk) == TEMPLATE_CHUNK_SIZE:
+                output_file.write(b"".join(chunk))
+                chunk.clear()
+        output_file.write(b"".join(chunk))
+        output_file.write(b"        </Track>\n")
+    else:
+        output_file.write(b"        <Track/>\n")
+    output_file.write(TEMPLATE_LAP_END)
+
+def template_trackpoint(trackpoint, heart_rate, cadence, distance):
+    timestamp, latitude, longitude, altitude, distance, heart_rate_bpm, cadence = get_trackpoint_values(trackpoint, heart_rate, cadence, distance)
+
+    rendered = TEMPLATE_TRACKPOINT % (timestamp.encode(), escape(latitude).encode(), escape(longitude).encode())
+    if altitude is not None:
+        rendered += TEMPLATE_ALTITUDE % str(altitude).encode()
+    rendered += TEMPLATE_DISTANCE % distance.encode()
+    if heart_rate_bpm is not None:
+        rendered += TEMPLATE_HEART_RATE % heart_rate_bpm
+    if cadence is not None:
+        rendered += TEMPLATE_CADENCE % cadence
+    return rendered + TEMPLATE_TRACKPOINT_END
+
+def create_tcx_dest(dest):
+    tcx_dest = dest + "/TCX/"
+    create_output_directory(os.path.dirname(tcx_dest))
+    return tcx_dest
+
+def activity_to_tcx(tcx_dest, activity):
+    logger.debug("Activity: %r", tuple(activity))
+    identifier = activity['track_id']
+    output_path = get_output_path(os.path.join(tcx_dest, str(identifier) + ".tcx"))
+    # Skip activities which are unchanged since the last export
+    manifest = amazfit_exporter_config.manifest
+    if manifest is not None:
+        with stats.stage("tcx.fingerprint"):
+            fingerprint = get_activity_fingerprint('TCX', activity)
+        if manifest.is_current(output_path, fingerprint):
+            logger.info("Skip unchanged activity %d", identifier)
+            stats.count("tcx.files_skipped")
+            return
+    if amazfit_exporter_config.xml_writer == 'tree':
+        with stats.stage("tcx.build"):
+            document = create_tcd_document()
+            element = create_sub_element(document.getroot(), "Activities")
+            add_activity(element, activity)
+            add_author(document.getroot())
+        with stats.stage("tcx.serialize"):
+            data = document_to_string(document)
+        with stats.stage("tcx.write"), open_output_file(output_path) as output_file:
+            output_file.write(data)
+    else:
+        # The stream and template writers serialize and write at the same time
+        with stats.stage("tcx.render"), open_output_file(output_path) as output_file:
+            if amazfit_exporter_config.xml_writer == 'stream':
+                stream_tcd_document(output_file, activity)
+            else:
+                template_tcd_document(output_file, activity)
+    stats.count("tcx.files_written")
+    if manifest is not None:
+        manifest.record(output_path, fingerprint)
 
 def db_to_tcx(dest):
     logger.info("Started tcx export")
     print("TCX export:")
-    tcx_dest = dest + "/TCX/"
-    os.makedirs(os.path.dirname(tcx_dest), exist_ok=True)
+    tcx_dest = create_tcx_dest(dest)
     for activity in amazfit_exporter_config.activities:
-        logger.debug("Activity: %r", tuple(activity))
-        document = create_tcd_document()
-        element = create_sub_element(document.getroot(), "Activities")
-        add_activity(element, activity)
-        add_author(document.getroot())
         identifier = activity['track_id']
-        with open(os.path.join(tcx_dest, str(identifier) + ".tcx"), 'wb') as output_file:
-            print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type']))
-            output_file.write(document_to_string(document))
-            output_file.close()  
+        print("\tDate: " + local_date_to_utc(identifier).isoformat() + ", id: " + str(identifier) + ', type: ' + str(activity['type']) + ':' + amazfit_exporter_config.SPORT_MAPPING.get(activity['type'], "Other"))
+        activity_to_tcx(tcx_dest, activity)
     logger.info("Finished tcx export")
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+from array import array
+import collections
+import itertools
+from operator import itemgetter
+
+# Trackpoints are read from the cursor in batches of this many rows, so the
+# rows of the database are never held in memory all at once
+FETCH_SIZE = 10000
+
+# A trackpoint with the values of a row of the trackpoint queries, latitude and
+# longitude as the text of the database
+Trackpoint = collections.namedtuple('Trackpoint', ['track_id', 'latitude', 'longitude', 'altitude', 'timestamp'])
+
+# Store a column of coordinates as doubles. The queries return the coordinates
+# as text, which is written verbatim to the exported files. The text has at
+# most 15 significant digits and repr of the parsed double gives the same text
+# again. Texts which can not be restored like this, e.g. an exponent or a
+# NULL, are kept in texts by their index.
+def extend_coordinates(column, texts, values):
+    start = len(column)
+    try:
+        numbers = list(map(float, values))
+    except TypeError:
+        numbers = [0.0 if value is None else float(value) for value in values]
+    column.extend(numbers)
+    restored = list(map(repr, numbers))
+    if restored == list(values):
+        return
+    for index in [index for index, (text, value) in enumerate(zip(restored, values)) if text != value]:
+        texts[start + index] = values[index]
+
+# Texts of a column of coordinates, see extend_coordinates
+def get_coordinate_texts(column, texts):
+    restored = list(map(repr, column))
+    for index, text in texts.items():
+        restored[index] = text
+    return restored
+
+# Trackpoints of one activity stored as parallel columns. A trackpoint costs
+# 32 bytes instead of a sqlite3.Row with two strings, a float and two ints.
+# Iterating and indexing return Trackpoint tuples with the same values as the
+# rows of the trackpoint queries, they are created on demand.
+class Trackpoints:
+
+    def __init__(self, track_id, rows=()):
+        self.track_id = track_id
+        self.timestamps = array('q')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.altitudes = array('d')
+        # index -> value of the values which the columns can not restore
+        self.latitude_texts = {}
+        self.longitude_texts = {}
+        self.altitude_values = {}
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    # rows are (track_id, latitude, longitude, altitude, timestamp) like the
+    # rows of the trackpoint queries
+    def extend(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        _, latitudes, longitudes, altitudes, timestamps = zip(*rows)
+        start = len(self.altitudes)
+        extend_coordinates(self.latitudes, self.latitude_texts, latitudes)
+        extend_coordinates(self.longitudes, self.longitude_texts, longitudes)
+        # integer and NULL altitudes keep their type
+        others = [index for index, altitude in enumerate(altitudes) if altitude.__class__ is not float]
+        if others:
+            for index in others:
+                self.altitude_values[start + index] = altitudes[index]
+            altitudes = [altitude if altitude.__class__ is float else 0.0 for altitude in altitudes]
+        self.altitudes.extend(altitudes)
+        self.timestamps.extend(timestamps)
+
+    def get_altitudes(self):
+        if not self.altitude_values:
+            return self.altitudes
+        altitudes = list(self.altitudes)
+        for index, altitude in self.altitude_values.items():
+            altitudes[index] = altitude
+        return altitudes
+
+    # Plain tuples of the trackpoints, e.g. for their fingerprint
+    def get_rows(self):
+        return zip(
+            itertools.repeat(self.track_id),
+            get_coordinate_texts(self.latitudes, self.latitude_texts),
+            get_coordinate_texts(self.longitudes, self.longitude_texts),
+            self.get_altitudes(),
+            self.timestamps)
+
+    def __iter__(self):
+        return map(Trackpoint._make, self.get_rows())
+
+    def __getitem__(self, index):
+        index = range(len(self))[index]
+        return Trackpoint(
+            self.track_id,
+            self.latitude_texts.get(index, repr(self.latitudes[index])),
+            self.longitude_texts.get(index, repr(self.longitudes[index])),
+            self.altitude_values.get(index, self.altitudes[index]),
+            self.timestamps[index])
+
+# Trackpoints grouped by track_id from a cursor of rows sorted by track_id,
+# read in batches of FETCH_SIZE rows
+def read_trackpoints(cursor):
+    activities = {}
+    current = None
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return activities
+        for track_id, group in itertools.groupby(rows, key=itemgetter(0)):
+            if current is None or current.track_id != track_id:
+                current = activities[track_id] = Trackpoints(track_id)
+            current.extend(group)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+import glob
+import logging
+import os
+import sqlite3
+import time
+import amazfit_exporter
+import amazfit_exporter_config
+from amazfit_exporter_batch import get_namespaces, is_batch
+from amazfit_exporter_index import ActivityIndex
+from amazfit_exporter_manifest import ExportManifest, read_last_update_time, write_last_update_time
+from amazfit_exporter_output import ExportOutput
+from amazfit_exporter_summary import close_summary_indexes, save_summary_indexes
+
+# Databases in a drop directory are found by their extension
+DATABASE_PATTERN = "*.db"
+
+logger = logging.getLogger(__name__)
+
+# A database in the drop directory with its own output directory, checkpoint,
+# manifest and activity index. Every export cycle writes its own bundle. The
+# connection stays open between the export cycles and is only reopened if the
+# file was replaced.
+class WatchedDatabase:
+
+    def __init__(self, path, dest):
+        self.path = path
+        self.dest = dest
+        self.manifest = ExportManifest(dest, amazfit_exporter_config.force)
+        self.output = ExportOutput(self.manifest)
+        self.activity_index = ActivityIndex(dest)
+        self.last_update_time = read_last_update_time(dest)
+        self.database = None
+        self.db_uri = None
+        # file signature of the last poll and of the last export
+        self.signature = None
+        self.exported_signature = None
+        # inode of the open connection
+        self.inode = None
+
+    def close(self):
+        self.activity_index.close()
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+
+    # A changed database is only exported when it did not change since the
+    # last poll, so files which are still being copied are not read
+    def poll(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.signature = None
+            return False
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        settled = signature == self.signature
+        self.signature = signature
+        return settled and signature != self.exported_signature
+
+    def open(self):
+        # A working copy has to be created again for every change, a replaced
+        # file needs a new connection. Otherwise the warm connection sees the changes.
+        if self.database is not None and not amazfit_exporter_config.working_copy and self.inode == self.signature[0]:
+            return
+        self.close()
+        logger.info("Open database '%s'", self.path)
+        self.database, self.db_uri = amazfit_exporter.open_database(self.path)
+        self.inode = self.signature[0]
+
+def find_databases(paths):
+    databases = []
+    for path in paths:
+        if os.path.isdir(path):
+            databases.extend(sorted(glob.glob(os.path.join(path, DATABASE_PATTERN))))
+        else:
+            databases.append(path)
+    return databases
+
+# Export the new activities of a changed database and move its checkpoint
+def export_new_activities(watched):
+    print("Exporting database '" + watched.path + "' to '" + watched.dest + "'.")
+    watched.open()
+    amazfit_exporter_config.manifest = watched.manifest
+    amazfit_exporter_config.output = watched.output
+    amazfit_exporter_config.activity_index = watched.activity_index
+    try:
+        new_last_update_time = amazfit_exporter.export_database(watched.database, watched.db_uri, watched.dest, watched.last_update_time + 1)
+    finally:
+        watched.output.close()
+    watched.exported_signature = watched.signature
+    watched.manifest.save()
+    save_summary_indexes()
+    if new_last_update_time > watched.last_update_time:
+        write_last_update_time(watched.dest, new_last_update_time)
+        watched.last_update_time = new_last_update_time
+    else:
+        print("Nothing to sync")
+
+# Poll database files or drop directories of databases and export new
+# activities until interrupted. A single database file is exported into dest,
+# otherwise every database gets its own subdirectory like in batch mode.
+# patterns are the glob patterns of the command line, see is_batch.
+# lxml, the connections and the manifests are loaded once, so a cycle only
+# costs the new data.
+def watch(paths, dest, interval, patterns=()):
+    logger.info("Started watching %r every %d seconds", paths, interval)
+    print("Watching " + ", ".join("'" + path + "'" for path in paths) + " for new activities, press Ctrl+C to stop.")
+    single_database = not is_batch(patterns or paths) and not os.path.isdir(paths[0])
+    watched_databases = {}
+    try:
+        while True:
+            databases = find_databases(paths)
+            # Close the connections of removed databases
+            for db in set(watched_databases) - set(databases):
+                watched_databases.pop(db).close()
+            namespaces = get_namespaces(databases, patterns)
+            for db in databases:
+                if db not in watched_databases:
+                    watched_databases[db] = WatchedDatabase(db, dest if single_database else os.path.join(dest, namespaces[db]))
+                watched = watched_databases[db]
+                if not watched.poll():
+                    continue
+                try:
+                    export_new_activities(watched)
+                except sqlite3.DatabaseError:
+                    # The database is retried with the next change
+                    logger.error("Error: Database not readable! Check database: '%s'", db)
+                    watched.exported_signature = watched.signature
+                    watched.close()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        for watched in watched_databases.values():
+            watched.close()
+            watched.manifest.save()
+        close_summary_indexes()
+        logger.info("Finished watching %r", paths)
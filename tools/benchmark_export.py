@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# Benchmark the export of a sport database per export format. Every run is a
+# separate exporter process, so the peak memory usage of each run is measured.
+# Arguments after the benchmark options are passed to the exporter, e.g.
+#   benchmark_export.py --activities 40 --points 5000 -- --xml-writer template
+# With --compare every format is also exported without the exporter options,
+# e.g. to measure the time and size saved by track simplification:
+#   benchmark_export.py --compare -- --simplify 5
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER = os.path.join(TOOLS_DIR, os.pardir, "src", "amazfit_exporter_cli.py")
+GENERATOR = os.path.join(TOOLS_DIR, "generate_sport_db.py")
+
+# Files of the output directory which are not exported files
+SIDECAR_FILES = {'lstupd.txt', 'manifest.json', 'summary.db', 'activity_index.db'}
+
+parser = argparse.ArgumentParser(description='Benchmark the export of a sport database.', usage='%(prog)s [options] [-- exporter options]')
+parser.add_argument('--database', metavar='PATH', dest='database', type=str, default=None, help='database to export (default: a database generated with --activities and --points)')
+parser.add_argument('--activities', metavar='N', dest='activities', type=int, default=20, help='number of activities of the generated database (default: 20)')
+parser.add_argument('--points', metavar='N', dest='points', type=int, default=2000, help='number of trackpoints per activity of the generated database (default: 2000)')
+parser.add_argument('--formats', metavar='FORMAT', dest='formats', nargs='+', default=['TCX', 'GPX'], help='export formats, each one is benchmarked separately (default: %(default)s)')
+parser.add_argument('--runs', metavar='N', dest='runs', type=int, default=3, help='runs per format, the fastest run is reported (default: 3)')
+parser.add_argument('--compare', dest='compare', action='store_true', default=False, help='also run every format without the exporter options and report the time and size saved by them')
+parser.add_argument('--json', metavar='PATH', dest='json', type=str, default=None, help='write the results as JSON to PATH')
+
+def get_output_size(output, stats_path):
+    size = 0
+    for directory, _, files in os.walk(output):
+        for name in files:
+            path = os.path.join(directory, name)
+            if path != stats_path and name not in SIDECAR_FILES:
+                size += os.path.getsize(path)
+    return size
+
+# Run the exporter and return the wall time, the peak RSS in MB (None if the
+# platform cannot measure it), the statistics of the export and the size of the
+# exported files in bytes
+def run_export(database, export_format, exporter_args, work_dir):
+    output = tempfile.mkdtemp(dir=work_dir)
+    stats_path = os.path.join(output, "stats.json")
+    command = [sys.executable, EXPORTER, database, '-o', output, '--export-formats', export_format, '--stats-json', stats_path] + exporter_args
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+        peak_rss = None
+    seconds = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError("Export failed: " + " ".join(command))
+    with open(stats_path, 'r') as stats_file:
+        stats = json.load(stats_file)
+    return seconds, peak_rss, stats, get_output_size(output, stats_path)
+
+def benchmark(args, exporter_args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        database = args.database
+        if database is None:
+            database = os.path.join(work_dir, "sport_data.db")
+            subprocess.run([sys.executable, GENERATOR, database, '--activities', str(args.activities), '--points', str(args.points)], check=True)
+        results = []
+        for export_format in args.formats:
+            runs = [run_export(database, export_format, exporter_args, work_dir) for _ in range(max(args.runs, 1))]
+            seconds, peak_rss, stats, output_size = min(runs, key=lambda run: run[0])
+            trackpoints = stats['counters'].get(export_format.lower() + '.trackpoints', 0)
+            result = {
+                'format': export_format,
+                'seconds': round(seconds, 3),
+                'export_seconds': stats['seconds'],
+                'trackpoints': trackpoints,
+                'trackpoints_per_second': round(trackpoints / stats['seconds']) if stats['seconds'] else None,
+                'peak_rss_mb': round(max(run[1] for run in runs), 1) if peak_rss is not None else None,
+                'output_bytes': output_size,
+                'stages': {name: stage['seconds'] for name, stage in stats['stages'].items()}
+            }
+            if args.compare:
+                baseline = min((run_export(database, export_format, [], work_dir) for _ in range(max(args.runs, 1))), key=lambda run: run[0])
+                result['baseline'] = {'seconds': round(baseline[0], 3), 'output_bytes': baseline[3]}
+            results.append(result)
+    return results
+
+def print_results(results):
+    print("%-6s %10s %10s %12s %14s %12s" % ("Format", "Wall [s]", "Export [s]", "Trackpoints", "Trackpoints/s", "Peak RSS [MB]"))
+    for result in results:
+        peak_rss = "-" if result['peak_rss_mb'] is None else "%.1f" % result['peak_rss_mb']
+        print("%-6s %10.3f %10.3f %12d %14s %12s" % (result['format'], result['seconds'], result['export_seconds'], result['trackpoints'], result['trackpoints_per_second'], peak_rss))
+        for name, seconds in sorted(result['stages'].items(), key=lambda stage: -stage[1]):
+            print("\t%-24s %8.3f s" % (name, seconds))
+        if 'baseline' in result:
+            baseline = result['baseline']
+            print("\tSaved by the exporter options: %.3f s (%.1f%%), %.1f MB (%.1f%%)" % (
+                baseline['seconds'] - result['seconds'],
+                100 * (baseline['seconds'] - result['seconds']) / baseline['seconds'],
+                (baseline['output_bytes'] - result['output_bytes']) / (1024 * 1024),
+                100 * (baseline['output_bytes'] - result['output_bytes']) / baseline['output_bytes'] if baseline['output_bytes'] else 0))
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Everything after '--' is passed to the exporter
+    exporter_args = []
+    if '--' in argv:
+        exporter_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    results = benchmark(args, exporter_args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+            json_file.write("\n")
+
+if __name__ == '__main__':
+    sys.exit(main())
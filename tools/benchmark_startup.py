@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Benchmark the startup of the exporter on a run with nothing to sync, like
+# most scheduled runs. A database is exported once, then the exporter is run
+# again on the same output directory with -X importtime and the wall time and
+# the slowest imports are reported. Arguments after the benchmark options are
+# passed to the exporter, e.g.
+#   benchmark_startup.py -- --export-formats FIT
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER = os.path.join(TOOLS_DIR, os.pardir, "src", "amazfit_exporter_cli.py")
+GENERATOR = os.path.join(TOOLS_DIR, "generate_sport_db.py")
+
+# Modules which are only needed to write the exported files, they should not
+# be imported by a run with nothing to sync
+WRITER_MODULES = ['lxml', 'jinja2', 'tarfile', 'zipfile', 'amazfit_exporter_tcx', 'amazfit_exporter_gpx', 'amazfit_exporter_fit']
+
+parser = argparse.ArgumentParser(description='Benchmark the startup of the exporter with nothing to sync.', usage='%(prog)s [options] [-- exporter options]')
+parser.add_argument('--database', metavar='PATH', dest='database', type=str, default=None, help='database to export (default: a small generated database)')
+parser.add_argument('--runs', metavar='N', dest='runs', type=int, default=5, help='runs, the fastest run is reported (default: 5)')
+parser.add_argument('--top', metavar='N', dest='top', type=int, default=15, help='number of the slowest imports to report (default: 15)')
+parser.add_argument('--json', metavar='PATH', dest='json', type=str, default=None, help='write the results as JSON to PATH')
+
+# The exporter asks for the begin of the sync, <Enter> accepts the last sync
+def run_exporter(database, output, exporter_args, python_args=()):
+    command = [sys.executable] + list(python_args) + [EXPORTER, database, '-o', output] + exporter_args
+    started = time.perf_counter()
+    process = subprocess.run(command, input="\n", stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError("Export failed: " + " ".join(command) + "\n" + process.stderr)
+    return seconds, process.stdout, process.stderr
+
+# Self and cumulative microseconds of every imported module from the
+# -X importtime lines on stderr, e.g.
+#   import time:       712 |       1450 |   amazfit_exporter_db
+def parse_import_times(stderr):
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line[len("import time:"):].split("|")
+        imports[name.strip()] = (int(self_time), int(cumulative_time))
+    return imports
+
+def benchmark(args, exporter_args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        database = args.database
+        if database is None:
+            database = os.path.join(work_dir, "sport_data.db")
+            subprocess.run([sys.executable, GENERATOR, database, '--activities', '2', '--points', '100'], check=True, stdout=subprocess.DEVNULL)
+        output = os.path.join(work_dir, "output")
+        run_exporter(database, output, exporter_args)
+        runs = [run_exporter(database, output, exporter_args) for _ in range(max(args.runs, 1))]
+        seconds, stdout, _ = min(runs, key=lambda run: run[0])
+        if "Nothing to sync" not in stdout:
+            raise RuntimeError("The second export was not empty:\n" + stdout)
+        _, _, stderr = run_exporter(database, output, exporter_args, ['-X', 'importtime'])
+    imports = parse_import_times(stderr)
+    slowest = sorted(imports.items(), key=lambda item: -item[1][0])[:args.top]
+    return {
+        'seconds': round(seconds, 3),
+        'import_seconds': round(sum(self_time for self_time, _ in imports.values()) / 1e6, 3),
+        'modules': len(imports),
+        'slowest_imports': [{'module': name, 'self_ms': round(self_time / 1000, 1), 'cumulative_ms': round(cumulative_time / 1000, 1)} for name, (self_time, cumulative_time) in slowest],
+        'writer_modules': [name for name in WRITER_MODULES if name in imports]
+    }
+
+def print_results(result):
+    print("Wall time: %.3f s, imports: %.3f s in %d modules" % (result['seconds'], result['import_seconds'], result['modules']))
+    print("%-40s %10s %10s" % ("Module", "Self [ms]", "Cum. [ms]"))
+    for module in result['slowest_imports']:
+        print("%-40s %10.1f %10.1f" % (module['module'], module['self_ms'], module['cumulative_ms']))
+    if result['writer_modules']:
+        print("Writer modules imported without exporting: " + ", ".join(result['writer_modules']))
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Everything after '--' is passed to the exporter
+    exporter_args = []
+    if '--' in argv:
+        exporter_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    result = benchmark(args, exporter_args)
+    print_results(result)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result, json_file, indent=2)
+            json_file.write("\n")
+
+if __name__ == '__main__':
+    sys.exit(main())
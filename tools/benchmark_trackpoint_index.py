@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Measure how matching the trackpoints to their activities scales with the
+# number of activities. Databases with the same total number of trackpoints are
+# generated for every number of activities. The trackpoints are matched once
+# with the scan of earlier versions, which filtered all trackpoints for every
+# activity, and once with the trackpoints grouped by track_id of
+# SportDatabase.get_trackpoints. The scan grows with activities x trackpoints,
+# the grouped trackpoints stay constant for the same number of trackpoints.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, os.pardir, "src"))
+GENERATOR = os.path.join(TOOLS_DIR, "generate_sport_db.py")
+
+from amazfit_exporter_db import SportDatabase, connect, database_uri
+
+# The unsorted trackpoint query of earlier versions
+SCAN_TRACKPOINTS_QUERY = "SELECT track_id, cast(latitude as text) as latitude, cast(longitude as text) as longitude, altitude, timestamp FROM location_data WHERE track_id >= ? AND point_type > 0"
+
+ACTIVITIES_QUERY = "SELECT track_id FROM sport_summary ORDER BY track_id"
+
+parser = argparse.ArgumentParser(description='Measure the matching of the trackpoints to their activities.')
+parser.add_argument('--trackpoints', metavar='N', dest='trackpoints', type=int, default=160000, help='total number of trackpoints of every generated database (default: 160000)')
+parser.add_argument('--activities', metavar='N', dest='activities', type=int, nargs='+', default=[25, 50, 100, 200, 400], help='numbers of activities of the generated databases (default: %(default)s)')
+parser.add_argument('--json', metavar='PATH', dest='json', type=str, default=None, help='write the results as JSON to PATH')
+
+# Trackpoints of every activity filtered from all trackpoints, like the TCX
+# and GPX writers of earlier versions
+def match_scan(database, track_ids):
+    trackpoints = database.connection.execute(SCAN_TRACKPOINTS_QUERY, (0,)).fetchall()
+    count = 0
+    for track_id in track_ids:
+        gen = (trackpoint for trackpoint in trackpoints if trackpoint['track_id'] == track_id)
+        for trackpoint in gen:
+            count += 1
+    return count
+
+def match_index(database, track_ids):
+    trackpoints = database.get_trackpoints(0)
+    count = 0
+    for track_id in track_ids:
+        count += len(trackpoints.get(track_id, ()))
+    return count
+
+def measure(database, track_ids, match):
+    started = time.perf_counter()
+    count = match(database, track_ids)
+    return count, time.perf_counter() - started
+
+def benchmark(args):
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for activities in args.activities:
+            path = os.path.join(work_dir, "sport_data_%d.db" % activities)
+            subprocess.run([sys.executable, GENERATOR, path, '--activities', str(activities), '--points', str(args.trackpoints // activities)], check=True, stdout=subprocess.DEVNULL)
+            database = SportDatabase(connect(database_uri(path)))
+            try:
+                track_ids = [row['track_id'] for row in database.connection.execute(ACTIVITIES_QUERY)]
+                scan_count, scan_seconds = measure(database, track_ids, match_scan)
+                index_count, index_seconds = measure(database, track_ids, match_index)
+            finally:
+                database.close()
+            if scan_count != index_count:
+                raise RuntimeError("%d activities: the scan matched %d trackpoints, the index %d" % (activities, scan_count, index_count))
+            results.append({
+                'activities': activities,
+                'trackpoints': index_count,
+                'scan_seconds': round(scan_seconds, 3),
+                'index_seconds': round(index_seconds, 3)
+            })
+    return results
+
+# The factor of the seconds compared with the smallest number of activities
+# shows the growth, the scan grows with the number of activities
+def print_results(results):
+    print("%10s %12s %10s %8s %10s %8s" % ("Activities", "Trackpoints", "Scan [s]", "Factor", "Index [s]", "Factor"))
+    first = results[0] if results else None
+    for result in results:
+        print("%10d %12d %10.3f %8.1f %10.3f %8.1f" % (
+            result['activities'], result['trackpoints'],
+            result['scan_seconds'], result['scan_seconds'] / first['scan_seconds'],
+            result['index_seconds'], result['index_seconds'] / first['index_seconds']))
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    results = benchmark(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+            json_file.write("\n")
+
+if __name__ == '__main__':
+    sys.exit(main())
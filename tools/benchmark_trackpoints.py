@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# Measure the memory of the loaded trackpoints per million trackpoints. The
+# trackpoints of a generated or given database are loaded once as lists of
+# sqlite3.Row objects, the representation of earlier versions, and once as the
+# columns of amazfit_exporter_trackpoints.Trackpoints. The memory is measured
+# with tracemalloc, the load time in a separate run without tracing.
+import argparse
+import gc
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, os.pardir, "src"))
+GENERATOR = os.path.join(TOOLS_DIR, "generate_sport_db.py")
+
+from amazfit_exporter_db import TRACKPOINTS_QUERY, SportDatabase, connect, database_uri
+
+parser = argparse.ArgumentParser(description='Measure the memory of the loaded trackpoints.')
+parser.add_argument('--database', metavar='PATH', dest='database', type=str, default=None, help='database to load (default: a database generated with --activities and --points)')
+parser.add_argument('--activities', metavar='N', dest='activities', type=int, default=50, help='number of activities of the generated database (default: 50)')
+parser.add_argument('--points', metavar='N', dest='points', type=int, default=20000, help='number of trackpoints per activity of the generated database (default: 20000)')
+parser.add_argument('--json', metavar='PATH', dest='json', type=str, default=None, help='write the results as JSON to PATH')
+
+def load_rows(database):
+    cursor = database.connection.execute(TRACKPOINTS_QUERY, (0,))
+    return {track_id: list(trackpoints) for track_id, trackpoints in itertools.groupby(cursor, key=lambda trackpoint: trackpoint['track_id'])}
+
+def load_columns(database):
+    return database.get_trackpoints(0)
+
+# Bytes allocated by the loaded trackpoints and the seconds to load them
+def measure(database, load):
+    gc.collect()
+    started = time.perf_counter()
+    trackpoints = load(database)
+    seconds = time.perf_counter() - started
+    del trackpoints
+    gc.collect()
+    tracemalloc.start()
+    trackpoints = load(database)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(activity_trackpoints) for activity_trackpoints in trackpoints.values())
+    return count, size, peak, seconds
+
+def benchmark(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = args.database
+        if path is None:
+            path = os.path.join(work_dir, "sport_data.db")
+            subprocess.run([sys.executable, GENERATOR, path, '--activities', str(args.activities), '--points', str(args.points)], check=True, stdout=subprocess.DEVNULL)
+        database = SportDatabase(connect(database_uri(path)))
+        try:
+            results = []
+            for name, load in (('rows', load_rows), ('columns', load_columns)):
+                count, size, peak, seconds = measure(database, load)
+                results.append({
+                    'representation': name,
+                    'trackpoints': count,
+                    'bytes_per_trackpoint': round(size / count, 1) if count else None,
+                    'mb_per_million': round(size / count * 1e6 / (1024 * 1024), 1) if count else None,
+                    'peak_mb_per_million': round(peak / count * 1e6 / (1024 * 1024), 1) if count else None,
+                    'load_seconds': round(seconds, 3)
+                })
+        finally:
+            database.close()
+    return results
+
+def print_results(results):
+    print("%-10s %12s %10s %14s %16s %10s" % ("Storage", "Trackpoints", "Bytes/tp", "MB/million", "Peak MB/million", "Load [s]"))
+    for result in results:
+        print("%-10s %12d %10s %14s %16s %10.3f" % (result['representation'], result['trackpoints'], result['bytes_per_trackpoint'], result['mb_per_million'], result['peak_mb_per_million'], result['load_seconds']))
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    results = benchmark(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+            json_file.write("\n")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Check that amazfit_exporter_cadence.cadence_series gives the same cadences
+# as the deque of the last step counts of the original TCX writer. Random
+# series of step counts with gaps of missing values are compared, including
+# series which start with a gap and gaps longer than the window.
+import argparse
+import collections
+import os
+import random
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, os.pardir, "src"))
+
+from amazfit_exporter_cadence import CADENCE_WINDOW, cadence_series
+
+parser = argparse.ArgumentParser(description='Compare the cadence calculation with the original algorithm.')
+parser.add_argument('--series', metavar='N', dest='series', type=int, default=2000, help='number of random series (default: 2000)')
+parser.add_argument('--seed', metavar='SEED', dest='seed', type=int, default=1, help='seed of the random series (default: 1)')
+
+# The cadences of the original TCX writer: a step count is appended to the
+# deque, a missing value repeats the cadence of the deque and drops its oldest
+# step count, an empty deque has no cadence
+def deque_cadences(step_counts, window=CADENCE_WINDOW):
+    steps = collections.deque(maxlen=window)
+    cadences = []
+    for step_count in step_counts:
+        if step_count is not None:
+            steps.append(step_count)
+            cadences.append(int(sum(steps) * (60 / len(steps))))
+        elif steps:
+            cadences.append(int(sum(steps) * (60 / len(steps))))
+            steps.popleft()
+        else:
+            cadences.append(None)
+    return cadences
+
+def random_step_counts(generator):
+    step_counts = []
+    for _ in range(generator.randint(0, 300)):
+        if generator.random() < 0.1:
+            # a gap, sometimes longer than the window
+            step_counts.extend([None] * generator.randint(1, 2 * CADENCE_WINDOW))
+        else:
+            step_counts.append(generator.randint(0, 4))
+    return step_counts
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    generator = random.Random(args.seed)
+    failed = 0
+    for _ in range(args.series):
+        step_counts = random_step_counts(generator)
+        for window in (1, 2, CADENCE_WINDOW):
+            if cadence_series(step_counts, window) != deque_cadences(step_counts, window):
+                failed += 1
+                print("Different cadences for window %d: %r" % (window, step_counts))
+    print("%d of %d series differ" % (failed, 3 * args.series))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# Check that the exported files are byte-identical to the golden output.
+# A database is generated with a fixed seed and exported with every
+# configuration, the SHA-256 digests of the exported files are compared with
+# golden_output.json. Run with --update after an intended change of the output.
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORTER = os.path.join(TOOLS_DIR, os.pardir, "src", "amazfit_exporter_cli.py")
+GENERATOR = os.path.join(TOOLS_DIR, "generate_sport_db.py")
+GOLDEN_OUTPUT = os.path.join(TOOLS_DIR, "golden_output.json")
+
+# Small database, which covers heart rate gaps and duplicates, missing altitudes,
+# an activity without trackpoints and all mapped sport types
+GENERATOR_ARGS = ['--activities', '8', '--points', '300', '--empty-activities', '1', '--seed', '1']
+
+# Exporter arguments of every checked configuration
+CONFIGURATIONS = {
+    'tree': [],
+    'stream': ['--xml-writer', 'stream'],
+    'template': ['--xml-writer', 'template'],
+    'streaming': ['--streaming'],
+    'jobs': ['--jobs', '2'],
+    'working-copy': ['--working-copy'],
+    'no-data': ['--no-hr', '--no-cadence', '--no-calories'],
+    'hr-tolerance': ['--hr-tolerance', '1500'],
+    'csv': ['--export-formats', 'CSV'],
+    'csv-month': ['--export-formats', 'CSV', '--csv-partition', 'month'],
+    'no-pretty-print': ['--no-pretty-print'],
+    'gzip': ['--compress', 'gzip'],
+    'simplify': ['--simplify', '5', '--decimate', '3'],
+    'laps': ['--laps', 'km'],
+    'selection': ['--since', '2019-01-03', '--until', '2019-01-07', '--type', 'Running', 'Biking']
+}
+
+# Formats of the configurations without --export-formats
+CHECKED_FORMATS = ['TCX', 'GPX', 'FIT']
+
+# Files of the output directory which are not part of the export
+IGNORED_FILES = {'manifest.json', 'summary.db', 'activity_index.db'}
+
+parser = argparse.ArgumentParser(description='Compare the exported files with the golden output.')
+parser.add_argument('--update', dest='update', action='store_true', default=False, help='write the digests of the current output as new golden output')
+parser.add_argument('--configurations', metavar='NAME', dest='configurations', nargs='+', choices=CONFIGURATIONS.keys(), default=list(CONFIGURATIONS), help='configurations to check (default: all). Available configurations: %(choices)s')
+
+def get_digests(output):
+    digests = {}
+    for directory, _, files in os.walk(output):
+        for name in files:
+            path = os.path.join(directory, name)
+            key = os.path.relpath(path, output).replace(os.sep, '/')
+            if key in IGNORED_FILES:
+                continue
+            with open(path, 'rb') as output_file:
+                digests[key] = hashlib.sha256(output_file.read()).hexdigest()
+    return dict(sorted(digests.items()))
+
+def export(database, configuration, work_dir):
+    output = tempfile.mkdtemp(dir=work_dir)
+    arguments = CONFIGURATIONS[configuration]
+    if '--export-formats' not in arguments:
+        arguments = ['--export-formats'] + CHECKED_FORMATS + arguments
+    subprocess.run([sys.executable, EXPORTER, database, '-o', output] + arguments, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+    return get_digests(output)
+
+def compare(configuration, golden, digests):
+    if configuration not in golden:
+        print("%s: no golden output" % configuration)
+        return False
+    expected = golden[configuration]
+    differences = sorted(name for name in set(expected) | set(digests) if expected.get(name) != digests.get(name))
+    if not differences:
+        print("%s: %d files identical" % (configuration, len(digests)))
+        return True
+    print("%s: %d of %d files differ" % (configuration, len(differences), len(set(expected) | set(digests))))
+    for name in differences:
+        print("\t" + name)
+    return False
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    golden = {}
+    if os.path.isfile(GOLDEN_OUTPUT):
+        with open(GOLDEN_OUTPUT, 'r') as golden_file:
+            golden = json.load(golden_file)
+    identical = True
+    with tempfile.TemporaryDirectory() as work_dir:
+        database = os.path.join(work_dir, "sport_data.db")
+        subprocess.run([sys.executable, GENERATOR, database] + GENERATOR_ARGS, stdout=subprocess.DEVNULL, check=True)
+        for configuration in args.configurations:
+            digests = export(database, configuration, work_dir)
+            if args.update:
+                golden[configuration] = digests
+                print("%s: updated %d files" % (configuration, len(digests)))
+            else:
+                identical = compare(configuration, golden, digests) and identical
+    if args.update:
+        with open(GOLDEN_OUTPUT, 'w') as golden_file:
+            json.dump(golden, golden_file, indent=1, sort_keys=True)
+            golden_file.write("\n")
+    return 0 if identical else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
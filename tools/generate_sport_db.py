@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Generate a synthetic sport_data.db with the schema of the Amazfit Stratos
+# for benchmarks and output checks. The same seed always generates the same
+# database.
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+# The empty database of the watch provides the real schema
+TEMPLATE_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sport_data_empty_stratos.db")
+
+# Sport types with a mapping in amazfit_exporter_config.SPORT_MAPPING
+DEFAULT_TYPES = [1, 2, 3, 5, 6, 9, 10]
+
+# Rows are inserted in batches of this size
+BATCH_SIZE = 10000
+
+parser = argparse.ArgumentParser(description='Generate a synthetic Amazfit Pace and Stratos sport database.')
+parser.add_argument('output', type=str, help='path of the generated database, an existing file is replaced')
+parser.add_argument('--activities', metavar='N', dest='activities', type=int, default=20, help='number of activities (default: 20)')
+parser.add_argument('--points', metavar='N', dest='points', type=int, default=2000, help='number of trackpoints per activity (default: 2000)')
+parser.add_argument('--empty-activities', metavar='N', dest='empty_activities', type=int, default=0, help='number of additional activities without trackpoints (default: 0)')
+parser.add_argument('--hr-interval', metavar='SECONDS', dest='hr_interval', type=int, default=1, help='seconds between two heart rate samples (default: 1)')
+parser.add_argument('--hr-gaps', metavar='RATE', dest='hr_gaps', type=float, default=0.1, help='fraction of missing heart rate samples (default: 0.1)')
+parser.add_argument('--hr-duplicates', metavar='RATE', dest='hr_duplicates', type=float, default=0.05, help='fraction of heart rate samples recorded twice for the same second (default: 0.05)')
+parser.add_argument('--types', metavar='TYPE', dest='types', type=int, nargs='+', default=DEFAULT_TYPES, help='sport types of the activities (default: %(default)s)')
+parser.add_argument('--start', metavar='DATE', dest='start', type=str, default='2019-01-01', help="date of the first activity, one activity is generated per day (default: '2019-01-01')")
+parser.add_argument('--seed', metavar='SEED', dest='seed', type=int, default=1, help='seed of the random generator (default: 1)')
+
+def insert_rows(connection, statement, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.executemany(statement, batch)
+            batch = []
+    connection.executemany(statement, batch)
+
+# Trackpoints of a walk around a random start position. Some trackpoints are
+# no GPS points (point_type 0) or have no altitude (-20).
+def generate_trackpoints(rnd, track_id, points):
+    latitude = 48 + rnd.random()
+    longitude = 11 + rnd.random()
+    altitude = rnd.uniform(400, 600)
+    timestamp = 0
+    for point_index in range(points):
+        timestamp += rnd.choice([1000, 2000, 3000]) + rnd.randint(-50, 50)
+        latitude += rnd.uniform(-1e-4, 1e-4)
+        longitude += rnd.uniform(-1e-4, 1e-4)
+        altitude += rnd.uniform(-1, 1)
+        yield (track_id, point_index, round(latitude, 8), round(longitude, 8), timestamp, altitude if rnd.random() > 0.05 else -20, rnd.choice([1, 1, 1, 2, 0]))
+
+# Heart rate samples every hr_interval seconds over the duration of the activity
+def generate_heart_rates(rnd, args, track_id, duration):
+    rate = rnd.randint(90, 130)
+    for second in range(0, duration // 1000 + 2, args.hr_interval):
+        if rnd.random() < args.hr_gaps:
+            continue
+        rate = min(max(rate + rnd.randint(-3, 3), 60), 200)
+        time = track_id + second * 1000
+        yield (track_id, rate, rnd.randint(0, 3), time)
+        if rnd.random() < args.hr_duplicates:
+            yield (track_id, rnd.randint(60, 200), rnd.randint(0, 3), time)
+
+def generate(args):
+    rnd = random.Random(args.seed)
+    start = int(datetime.strptime(args.start, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() * 1000)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    shutil.copyfile(TEMPLATE_DATABASE, args.output)
+    connection = sqlite3.connect(args.output)
+    trackpoints = 0
+    heart_rates = 0
+    # The activities without trackpoints follow the other activities, so they
+    # do not change the activities generated with the same seed
+    for activity in range(args.activities + args.empty_activities):
+        track_id = start + activity * 86400000 + rnd.randint(0, 999)
+        points = args.points if activity < args.activities else 0
+        location_data = list(generate_trackpoints(rnd, track_id, points))
+        duration = location_data[-1][4] if location_data else 0
+        connection.execute('INSERT INTO sport_summary(track_id, type, start_time, end_time, calorie, content) VALUES (?, ?, ?, ?, ?, ?)', (track_id, rnd.choice(args.types), track_id, track_id + duration, rnd.randint(10000, 900000), '{}'))
+        insert_rows(connection, 'INSERT INTO location_data(track_id, point_index, latitude, longitude, timestamp, altitude, point_type) VALUES (?, ?, ?, ?, ?, ?, ?)', location_data)
+        heart_rate_data = list(generate_heart_rates(rnd, args, track_id, duration))
+        insert_rows(connection, 'INSERT INTO heart_rate(track_id, rate, step_count, time) VALUES (?, ?, ?, ?)', heart_rate_data)
+        trackpoints += len(location_data)
+        heart_rates += len(heart_rate_data)
+    connection.commit()
+    connection.close()
+    print("Generated '%s': %d activities, %d trackpoints, %d heart rate samples" % (args.output, args.activities + args.empty_activities, trackpoints, heart_rates))
+
+def main(argv=None):
+    generate(parser.parse_args(argv))
+
+if __name__ == '__main__':
+    sys.exit(main())